@@ -1,2 +1,45 @@
-from ROIseries.feature_sommelier import feature_sommelier, feature_transformers, scoring_metrics
-from ROIseries.sub_routines import sub_routines
+import importlib
+import sys
+import types
+
+# the modules of ROIseries (ROIseries.<name>) are imported at their first access, so that import ROIseries stays
+# cheap, e.g. for workers which only need ROIseries.scoring_metrics
+_modules = {"feature_sommelier": "ROIseries.feature_sommelier.feature_sommelier",
+            "feature_transformers": "ROIseries.feature_sommelier.feature_transformers",
+            "scoring_metrics": "ROIseries.feature_sommelier.scoring_metrics",
+            "feature_store": "ROIseries.feature_sommelier.feature_store",
+            "curve_aggregation": "ROIseries.feature_sommelier.curve_aggregation",
+            "time_axis": "ROIseries.feature_sommelier.time_axis",
+            "sub_routines": "ROIseries.sub_routines.sub_routines",
+            "cookie_cutter": "ROIseries.cookie_cutter.cookie_cutter",
+            "cube_store": "ROIseries.cookie_cutter.cube_store",
+            "spectral_indexer": "ROIseries.spectral_indexer.spectral_indexer",
+            "spatial_mixer": "ROIseries.spatial_mixer.spatial_mixer",
+            "glcm_features": "ROIseries.glcm_features.glcm_features",
+            "temporal_blender": "ROIseries.temporal_blender.temporal_blender",
+            "step_cache": "ROIseries.eidetic_historian.step_cache",
+            "book_keeper": "ROIseries.book_keeper.book_keeper"}
+
+
+def __getattr__(name):
+    if name not in _modules:
+        raise AttributeError("module 'ROIseries' has no attribute '{}'".format(name))
+    module = importlib.import_module(_modules[name])
+    globals()[name] = module
+    return module
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_modules))
+
+
+class _Package(types.ModuleType):
+    def __setattr__(self, name, value):
+        # importing a subpackage (e.g. ROIseries.cookie_cutter) binds it to the package. ROIseries.<name> is the
+        # module of the same name though (ROIseries.cookie_cutter.cookie_cutter), keep it that way.
+        if name in _modules and getattr(value, "__name__", None) == "ROIseries." + name:
+            return
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
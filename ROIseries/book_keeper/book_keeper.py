@@ -0,0 +1,222 @@
+#
+#  ROIseries_book_keeper: tabular ground truth of the regions of interest
+#  Copyright (C) 2017 Niklas Keck
+#
+#  This file is part of ROIseries.
+#
+#  ROIseries is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  ROIseries is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with ROIseries.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+
+def gen_date(dates, pos_year, pos_month, pos_day, pos_hour=None, pos_minute=None, pos_second=None):
+    """
+    Extract dates from strings by the positions of their parts (as GEN_DATE), vectorized
+
+    Parameters
+    ----------
+    dates : iterable of strings, e.g. ['20160808', 'NA']
+    pos_year, pos_month, pos_day, pos_hour, pos_minute, pos_second : [first character, length] (as STRMID)
+
+    Returns
+    -------
+    DatetimeIndex, NaT for strings which are not a date (e.g. NA) or with year 0
+    """
+    if (pos_minute is not None and pos_hour is None) or (pos_second is not None and pos_minute is None):
+        raise ValueError("Specifying seconds without minutes and hours or minutes without hours is not supported")
+
+    dates = pd.Series(np.asarray(dates, dtype=object)).astype(str).str.strip()
+
+    def part(pos):
+        return dates.str.slice(pos[0], pos[0] + pos[1])
+
+    year = part(pos_year)
+    if pos_year[1] == 2:
+        print("warning: The year is not specified unambiguosly. 20XX will be assumed.")
+        year = "20" + year
+    parts = pd.DataFrame({"year": year, "month": part(pos_month), "day": part(pos_day)})
+    for name, pos in [("hour", pos_hour), ("minute", pos_minute), ("second", pos_second)]:
+        if pos is not None:
+            parts[name] = part(pos)
+
+    parts = parts.apply(pd.to_numeric, errors="coerce")
+    parts.loc[parts["year"] <= 0, "year"] = np.nan
+    valid = parts.notnull().all(axis=1)
+    result = pd.Series(pd.NaT, index=parts.index, dtype="datetime64[ns]")
+    if valid.any():
+        result[valid] = pd.to_datetime(parts[valid].astype(np.int64), errors="coerce")
+    return pd.DatetimeIndex(result)
+
+
+class GroundTruth(object):
+    """
+    Ground truth events of the ROIs as a columnar (id, event_type, date) table (as GROUNDTRUTH_FROM_CSV)
+
+    The table is sorted by id, event type and date. Labelling samples (ROI, time) is a batched lookup: the
+    events of each (id, event type) are a sorted segment, all samples are located with one searchsorted.
+
+    Example
+    -------
+    >>> types = ["before_harvest", "after_harvest", "before_ploughing", "after_ploughing"]
+    >>> aggregate = {"harvest": ["before_harvest", "after_harvest"],
+    ...              "ploughing": ["before_ploughing", "after_ploughing"]}
+    >>> gt = GroundTruth.from_csv("data/sentinel_2a/table/observations.csv", types, "ID", aggregate=aggregate)
+    >>> gt.summary()  # first, last and number of events per id and event type
+    >>> gt.label(ids, times, "harvest")  # count, last, days_since, within of each sample
+    """
+    def __init__(self, table, ids=None, aggregated=()):
+        """
+        Parameters
+        ----------
+        table : DataFrame with the columns id, event_type, date (datetime64), missing dates are dropped
+        ids : all ids (default: the ids of table, including the ones without any date), kept as ids_
+        aggregated : event types created by aggregate, which every id has (see to_dict)
+        """
+        self.ids_ = pd.Index(pd.unique(table["id"]) if ids is None else ids)
+        self.aggregated_ = list(aggregated)
+        table = table.loc[table["date"].notnull(), ["id", "event_type", "date"]]
+        self.table = table.sort_values(["id", "event_type", "date"], kind="mergesort").reset_index(drop=True)
+
+    @classmethod
+    def from_csv(cls, csv, types, id_colname, pos_year=(0, 4), pos_month=(4, 2), pos_day=(6, 2), aggregate=None):
+        """
+        Read the ground truth from a CSV with one row per ROI and one column of dates per event type
+
+        Parameters
+        ----------
+        csv : path to the CSV (or a buffer), e.g. data/sentinel_2a/table/observations.csv
+        types : names of the columns to read
+        id_colname : name of the column of the ids
+        pos_year, pos_month, pos_day : positions of the parts of the dates (see gen_date)
+        aggregate : dict new event type -> list of event types (see GroundTruth.aggregate)
+        """
+        df = pd.read_csv(csv, dtype={t: str for t in types}, keep_default_na=False)
+        missing = [c for c in [id_colname] + list(types) if c not in df.columns]
+        if missing:
+            raise ValueError("The following columns are not in the CSV: {}".format(missing))
+
+        # one row per cell: (id, type, date), NA cells get NaT and are dropped
+        long = pd.DataFrame({"id": np.repeat(df[id_colname].values, len(types)),
+                             "event_type": np.tile(np.asarray(types, dtype=object), len(df)),
+                             "date": gen_date(df[list(types)].values.ravel(), pos_year, pos_month, pos_day)})
+        result = cls(long)
+        return result.aggregate(aggregate) if aggregate is not None else result
+
+    def aggregate(self, aggregate):
+        """
+        Rename or combine event types, e.g. {"harvest": ["before_harvest", "after_harvest"]}
+
+        The dates of the combined types are the dates of the new type, event types not mentioned are kept.
+        """
+        mapping = {old: new for new, olds in aggregate.items() for old in olds}
+        table = self.table.copy()
+        table["event_type"] = table["event_type"].replace(mapping)
+        aggregated = [t for t in self.aggregated_ if t not in mapping] + list(aggregate)
+        return GroundTruth(table, self.ids_, aggregated)
+
+    @property
+    def ids(self):
+        return self.ids_
+
+    @property
+    def event_types(self):
+        return pd.Index(self.table["event_type"].unique())
+
+    def summary(self):
+        """
+        First, last and number of events per (id, event type)
+        """
+        return self.table.groupby(["id", "event_type"])["date"].agg(["min", "max", "count"]) \
+            .rename(columns={"min": "first", "max": "last"})
+
+    def intervals(self, event_type):
+        """
+        Interval [first, last] of the events of event_type of each id (Series id -> interval)
+        """
+        summary = self.summary().xs(event_type, level="event_type")
+        return pd.Series(pd.IntervalIndex.from_arrays(summary["first"], summary["last"], closed="both"),
+                         index=summary.index, name=event_type)
+
+    def to_dict(self):
+        """
+        Nested OrderedDict id -> event type -> array of dates, the structure of GROUNDTRUTH_FROM_CSV
+
+        As there, every id is kept (an empty OrderedDict if all its dates are NA) and every id has the
+        event types created by aggregate (after the other event types, an empty array if it has no date).
+        """
+        result = OrderedDict((i, OrderedDict()) for i in self.ids_)
+        for (i, event_type), dates in self.table.groupby(["id", "event_type"], sort=False)["date"]:
+            if event_type not in self.aggregated_:
+                result[i][event_type] = dates.values
+        by_id = self.table[self.table["event_type"].isin(self.aggregated_)].groupby(["id", "event_type"])["date"]
+        dates = {key: d.values for key, d in by_id}
+        for i, types in result.items():
+            for event_type in self.aggregated_:
+                types[event_type] = dates.get((i, event_type), np.array([], dtype="datetime64[ns]"))
+        return result
+
+    def label(self, ids, times, event_type):
+        """
+        Label samples (ROI, time) by the events of event_type up to their time
+
+        Parameters
+        ----------
+        ids : ids of the samples
+        times : times of the samples (datetime-like)
+        event_type : e.g. "harvest"
+
+        Returns
+        -------
+        DataFrame (one row per sample) with the columns
+            count : number of events up to the time (date <= time)
+            last : date of the last event up to the time (NaT if none)
+            days_since : days since the last event (NaN if none)
+            within : first event <= time <= last event (e.g. between before_harvest and after_harvest)
+        """
+        events = self.table[self.table["event_type"] == event_type]
+        event_ids = pd.Index(events["id"].unique())
+        event_codes = event_ids.get_indexer(events["id"])
+        event_ns = events["date"].values.view(np.int64)
+
+        time_ns = pd.DatetimeIndex(np.asarray(times)).asi8
+        codes = event_ids.get_indexer(np.asarray(ids))
+        if len(time_ns) != len(codes):
+            raise ValueError("ids and times must have the same length")
+
+        # key = id code * (n + 1) + rank of the date among the n unique dates: sorted as the table
+        unique_ns = np.unique(event_ns)
+        width = len(unique_ns) + 1
+        event_keys = event_codes * width + np.searchsorted(unique_ns, event_ns, side="left") + 1
+        sample_keys = codes * width + np.searchsorted(unique_ns, time_ns, side="right")
+
+        # the segment of the events of each sample's id and the events up to its time
+        known = codes >= 0
+        start = np.searchsorted(event_keys, codes * width, side="left")
+        end = np.searchsorted(event_keys, codes * width + width, side="left")
+        upto = np.searchsorted(event_keys, sample_keys, side="right")
+        count = np.where(known, upto - start, 0)
+
+        has_last = count > 0
+        last = np.full(len(time_ns), pd.NaT.value, dtype=np.int64)
+        last[has_last] = event_ns[upto[has_last] - 1]
+        within = np.zeros(len(time_ns), dtype=bool)
+        within[known] = (event_ns[start[known]] <= time_ns[known]) & (time_ns[known] <= event_ns[end[known] - 1])
+
+        with np.errstate(invalid="ignore"):
+            days_since = np.where(has_last, (time_ns - last) / float(86400 * 10 ** 9), np.nan)
+        return pd.DataFrame({"count": count, "last": last.view("datetime64[ns]"), "days_since": days_since,
+                             "within": within})
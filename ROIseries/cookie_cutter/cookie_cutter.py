@@ -0,0 +1,183 @@
+#
+#  ROIseries_cookie_cutter: cut the regions of interest of a shapefile out of a raster time series
+#  Copyright (C) 2017 Niklas Keck
+#
+#  This file is part of ROIseries.
+#
+#  ROIseries is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  ROIseries is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with ROIseries.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+from collections import OrderedDict
+import numpy as np
+from ROIseries.sub_routines.sub_routines import lazy_import
+from ROIseries.cookie_cutter.cube_store import CubeStore
+
+fiona = lazy_import("fiona")
+rasterio = lazy_import("rasterio")
+ndimage = lazy_import("scipy.ndimage")
+
+
+def raster_info(raster, upsampling=1):
+    """
+    Grid of a raster (as RASTER_INFO): transform and shape, both refined by upsampling
+
+    raster can be a path or an opened raster (e.g. a rasterio dataset or a CubeStore)
+    """
+    if isinstance(raster, (str, os.PathLike)):
+        with rasterio.open(raster) as src:
+            return raster_info(src, upsampling)
+
+    transform, shape = raster.transform, (raster.height, raster.width)
+    return transform * transform.scale(1 / upsampling), (shape[0] * upsampling, shape[1] * upsampling)
+
+
+class RoiIndex(object):
+    """
+    Label raster of the ROIs of a shapefile on the (upsampled) grid of a raster
+
+    The polygons are rasterized once (pixel centers within the polygon, holes excluded) into a label raster
+    covering the extent of the ROIs only: label i + 1 marks the pixels of ROI i, 0 the background.
+    Where ROIs overlap, the pixel belongs to the ROI which comes later in the shapefile.
+
+    Attributes
+    ----------
+    ids : ids of the ROIs holding at least one pixel
+    labels : label raster (int32) of the extent of the ROIs
+    offset : (row, column) of labels[0, 0] in the grid
+    bbox : array (ROI * 4) row_start, row_stop, col_start, col_stop of the ROIs in the grid
+    upsampling : the grid has upsampling times the resolution of the raster
+    """
+    def __init__(self, ids, labels, offset, bbox, upsampling=1):
+        self.ids = ids
+        self.labels = labels
+        self.offset = offset
+        self.bbox = bbox
+        self.upsampling = upsampling
+
+    @classmethod
+    def from_shapefile(cls, shapefile, id_col_name, raster, upsampling=1):
+        """
+        Rasterize the polygons of shapefile on the grid of raster (any raster of the series)
+        """
+        transform, shape = raster_info(raster, upsampling)
+        with fiona.open(shapefile) as shp:
+            features = list(shp)
+        ids = np.array([f["properties"][id_col_name] for f in features])
+        geometries = [f["geometry"] for f in features]
+
+        # rasterize only the extent of the ROIs
+        bounds = np.array([rasterio.features.bounds(g) for g in geometries])
+        extent = rasterio.windows.from_bounds(bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(),
+                                              bounds[:, 3].max(), transform)
+        extent = extent.round_offsets(op="floor").round_lengths(op="ceil")
+        extent = extent.intersection(rasterio.windows.Window(0, 0, shape[1], shape[0]))
+
+        labels = rasterio.features.rasterize(zip(geometries, np.arange(1, len(ids) + 1)),
+                                             out_shape=(extent.height, extent.width),
+                                             transform=rasterio.windows.transform(extent, transform),
+                                             fill=0, dtype=np.int32)
+
+        # bounding boxes of all labels in one pass
+        slices = ndimage.find_objects(labels, max_label=len(ids))
+        has_pixels = np.array([s is not None for s in slices], dtype=bool)
+        if not has_pixels.any():
+            raise ValueError("None of the objects contains any pixel. Please use finer raster")
+        if not has_pixels.all():
+            print("Objects containing no pixels: " + ", ".join(str(i) for i in ids[~has_pixels]))
+
+        offset = (extent.row_off, extent.col_off)
+        bbox = np.array([[s[0].start + offset[0], s[0].stop + offset[0], s[1].start + offset[1], s[1].stop + offset[1]]
+                         for s in slices if s is not None], dtype=np.int64).reshape(-1, 4)
+
+        # relabel: consecutive labels of the ROIs holding pixels
+        relabel = np.zeros(len(ids) + 1, dtype=np.int32)
+        relabel[1:][has_pixels] = np.arange(1, has_pixels.sum() + 1)
+        return cls(ids[has_pixels], relabel[labels], offset, bbox, upsampling)
+
+    def mask(self, i):
+        """
+        Boolean mask of the pixels of ROI i within its bounding box
+        """
+        r0, r1, c0, c1 = self.bbox[i]
+        return self.labels[r0 - self.offset[0]:r1 - self.offset[0], c0 - self.offset[1]:c1 - self.offset[1]] == i + 1
+
+    def window(self, i):
+        """
+        Window of the raster (not upsampled) holding the bounding box of ROI i
+        """
+        u = self.upsampling
+        r0, r1, c0, c1 = self.bbox[i]
+        return rasterio.windows.Window(c0 // u, r0 // u, -(-c1 // u) - c0 // u, -(-r1 // u) - r0 // u)
+
+    def cut(self, i, data):
+        """
+        Cut ROI i out of data, the values of window(i) in the last two axes (e.g. time * row * column),
+        pixels outside of the ROI are set to NaN
+        """
+        u = self.upsampling
+        r0, r1, c0, c1 = self.bbox[i]
+        if u != 1:
+            # as REBIN(/SAMPLE): repeat the pixels, then crop the bounding box
+            data = data.repeat(u, axis=-2).repeat(u, axis=-1)
+            data = data[..., r0 - (r0 // u) * u:r1 - (r0 // u) * u, c0 - (c0 // u) * u:c1 - (c0 // u) * u]
+        return np.where(self.mask(i), data, np.nan)
+
+
+def cookie_cutter(shapefile, id_col_name, rasterseries, upsampling=1, band=1, dtype=np.float32):
+    """
+    Cut the ROIs of shapefile out of each raster of rasterseries
+
+    In contrast to COOKIE_CUTTER the scenes are not loaded: only the window of each ROI is read from each
+    raster, so the memory needed depends on the area of the ROIs, not on the area of the scenes.
+
+    Parameters
+    ----------
+    shapefile : path to the shapefile holding the ROIs (polygons)
+    id_col_name : attribute of the shapefile holding the ids of the ROIs
+    rasterseries : list of rasters (e.g. GeoTIFFs) with the same grid, one per date, or a CubeStore
+    upsampling : pixels are split into upsampling * upsampling pixels to cut small ROIs more precisely
+    band : band of the rasters to read
+    dtype : dtype of the result (floating point, pixels outside of the ROI are NaN)
+
+    Returns
+    -------
+    OrderedDict id -> array (height * width * time) of the bounding box of the ROI
+
+    Example
+    -------
+    >>> import ROIseries as rs
+    >>> rasters = rs.sub_routines.file_search("data/sentinel_2a/rasters", ".tif")
+    >>> rois = rs.cookie_cutter.cookie_cutter("data/sentinel_2a/vector/studyarea.shp", "ID", rasters)
+    """
+    if isinstance(rasterseries, CubeStore):
+        index = RoiIndex.from_shapefile(shapefile, id_col_name, rasterseries, upsampling)
+        return rasterseries.cut_rois(index, band - 1)
+
+    index = RoiIndex.from_shapefile(shapefile, id_col_name, rasterseries[0], upsampling)
+    windows = [index.window(i) for i in range(len(index.ids))]
+    result = [np.empty((r1 - r0, c1 - c0, len(rasterseries)), dtype=dtype) for r0, r1, c0, c1 in index.bbox]
+
+    # one pass over the time series
+    shape = None
+    for t, raster in enumerate(rasterseries):
+        with rasterio.open(raster) as src:
+            if shape is None:
+                shape = src.shape
+            elif src.shape != shape:
+                raise ValueError("All rasters of the rasterseries must have the same size: {}".format(raster))
+            for i, window in enumerate(windows):
+                result[i][:, :, t] = index.cut(i, src.read(band, window=window))
+
+    return OrderedDict(zip(index.ids, result))
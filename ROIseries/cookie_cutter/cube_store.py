@@ -0,0 +1,211 @@
+#
+#  ROIseries_cube_store: chunked on-disk storage of raster time series
+#  Copyright (C) 2017 Niklas Keck
+#
+#  This file is part of ROIseries.
+#
+#  ROIseries is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  ROIseries is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with ROIseries.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+from affine import Affine
+from ROIseries.sub_routines.sub_routines import lazy_import
+
+rasterio = lazy_import("rasterio")
+
+
+class CubeStore(object):
+    """
+    Chunked, memory-mapped cube (time * band * row * column) of a raster time series
+
+    The cube is split into chunks of chunks = (time, row, column) pixels (all bands in each chunk). Each chunk
+    is contiguous on disk, so reading a tile or the window of a ROI only touches the chunks it intersects and
+    the series never has to be held in RAM. A season of a Sentinel-2 tile (100 dates * 10980 * 10980 pixels,
+    float32) takes 48 GB on disk, a tile of all dates with the default chunks 105 MB per band in RAM.
+
+    Layout
+    ------
+    path/meta.json   shape, chunks, dtype, transform and crs
+    path/times.npy   time of each raster (datetime64[ns]) or its position in the series
+    path/cube.npy    chunk grid (time, row, column) * chunk (time, band, row, column), edge chunks padded
+
+    Example
+    -------
+    >>> import ROIseries as rs
+    >>> rasters = rs.sub_routines.file_search("data/sentinel_2a/rasters", ".tif")
+    >>> cube = rs.cube_store.CubeStore.from_rasters("C:/Users/keck/Desktop/cube_store", rasters)
+    >>> rois = rs.cookie_cutter.cookie_cutter("data/sentinel_2a/vector/studyarea.shp", "ID", cube)
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        self.shape = tuple(meta["shape"])
+        self.chunks = tuple(meta["chunks"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.transform = Affine(*meta["transform"])
+        self.crs = meta["crs"]
+        self.times = np.load(os.path.join(path, "times.npy"))
+        self._cube = np.load(os.path.join(path, "cube.npy"), mmap_mode="r")
+
+    # as rasterio datasets, e.g. for cookie_cutter.raster_info
+    @property
+    def count(self):
+        return self.shape[1]
+
+    @property
+    def height(self):
+        return self.shape[2]
+
+    @property
+    def width(self):
+        return self.shape[3]
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # writing
+    @staticmethod
+    def _create(path, shape, chunks, dtype, transform, crs, times):
+        os.makedirs(path, exist_ok=True)
+        n_times, n_bands, n_rows, n_cols = shape
+        ct, cr, cc = chunks
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"shape": list(shape), "chunks": list(chunks), "dtype": np.dtype(dtype).str,
+                       "transform": list(transform)[:6], "crs": crs}, f)
+        np.save(os.path.join(path, "times.npy"), np.arange(n_times) if times is None else np.asarray(times))
+
+        grid = (-(-n_times // ct), -(-n_rows // cr), -(-n_cols // cc))
+        return np.lib.format.open_memmap(os.path.join(path, "cube.npy"), mode="w+", dtype=dtype,
+                                         shape=grid + (ct, n_bands, cr, cc))
+
+    @classmethod
+    def from_rasters(cls, path, rasterseries, chunks=(8, 512, 512), dtype=np.float32, times=None):
+        """
+        Write a raster time series (e.g. GeoTIFFs with the same grid, one per date) to a cube store at path
+
+        The rasters are streamed in strips of chunks[1] rows, so the memory needed does not depend on the
+        size of the series.
+
+        Parameters
+        ----------
+        rasterseries : list of rasters
+        chunks : size of the chunks (time, row, column)
+        times : time of each raster (datetime64), default: position in rasterseries
+
+        The edge chunks are padded with NaN (float dtypes) or the nodata value of the rasters (integer dtypes).
+        """
+        with rasterio.open(rasterseries[0]) as src:
+            shape = (len(rasterseries), src.count, src.height, src.width)
+            transform, crs = src.transform, src.crs.to_wkt() if src.crs else None
+            nodata = src.nodata
+
+        if np.issubdtype(dtype, np.floating):
+            fill = np.nan
+        elif nodata is None:
+            raise ValueError("Integer dtypes need the nodata value of the rasters to pad the edge chunks, "
+                             "use a float dtype or set nodata: {}".format(rasterseries[0]))
+        else:
+            fill = nodata
+
+        cube = cls._create(path, shape, chunks, dtype, transform, crs, times)
+        ct, cr, cc = chunks
+        for t, raster in enumerate(rasterseries):
+            with rasterio.open(raster) as src:
+                if (src.count, src.height, src.width) != shape[1:]:
+                    raise ValueError("All rasters of the rasterseries must have the same size: {}".format(raster))
+                for r in range(cube.shape[1]):
+                    strip = src.read(window=rasterio.windows.Window(0, r * cr, shape[3], min(cr, shape[2] - r * cr)))
+                    # pad the strip to full chunks, then split the columns into chunks
+                    padded = np.full((shape[1], cr, cube.shape[2] * cc), fill, dtype=dtype)
+                    padded[:, :strip.shape[1], :shape[3]] = strip
+                    cube[t // ct, r, :, t % ct] = \
+                        padded.reshape(shape[1], cr, cube.shape[2], cc).transpose(2, 0, 1, 3)
+
+        cube.flush()
+        del cube
+        return cls(path)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # reading
+    @staticmethod
+    def _range(selection, size):
+        if selection is None:
+            return 0, size
+        start, stop, _ = selection.indices(size)
+        return start, stop
+
+    def read(self, times=None, rows=None, cols=None, bands=None):
+        """
+        Read a block (time * band * row * column) of the cube, only the chunks intersecting it are touched
+
+        Parameters
+        ----------
+        times, rows, cols : slices of positions (all if None)
+        bands : list of band positions (all if None)
+        """
+        ct, cr, cc = self.chunks
+        t0, t1 = self._range(times, self.shape[0])
+        r0, r1 = self._range(rows, self.shape[2])
+        c0, c1 = self._range(cols, self.shape[3])
+        bands = slice(None) if bands is None else bands
+        n_bands = len(np.arange(self.shape[1])[bands])
+
+        out = np.empty((t1 - t0, n_bands, r1 - r0, c1 - c0), dtype=self.dtype)
+        for ti in range(t0 // ct, -(-t1 // ct)):
+            t_sel = slice(max(t0, ti * ct), min(t1, (ti + 1) * ct))
+            for ri in range(r0 // cr, -(-r1 // cr)):
+                r_sel = slice(max(r0, ri * cr), min(r1, (ri + 1) * cr))
+                for ci in range(c0 // cc, -(-c1 // cc)):
+                    c_sel = slice(max(c0, ci * cc), min(c1, (ci + 1) * cc))
+                    chunk = self._cube[ti, ri, ci,
+                                       t_sel.start - ti * ct:t_sel.stop - ti * ct, :,
+                                       r_sel.start - ri * cr:r_sel.stop - ri * cr,
+                                       c_sel.start - ci * cc:c_sel.stop - ci * cc]
+                    out[t_sel.start - t0:t_sel.stop - t0, :,
+                        r_sel.start - r0:r_sel.stop - r0,
+                        c_sel.start - c0:c_sel.stop - c0] = chunk[:, bands]
+        return out
+
+    def iter_tiles(self, bands=None):
+        """
+        Iterate over the spatial tiles (all times) of the cube
+
+        Yields
+        ------
+        rows, cols (slices of the tile in the grid), block (time * band * row * column)
+        """
+        ct, cr, cc = self.chunks
+        for r0 in range(0, self.height, cr):
+            for c0 in range(0, self.width, cc):
+                rows, cols = slice(r0, min(r0 + cr, self.height)), slice(c0, min(c0 + cc, self.width))
+                yield rows, cols, self.read(rows=rows, cols=cols, bands=bands)
+
+    def cut_rois(self, roi_index, band=0):
+        """
+        Cut the ROIs of roi_index (cookie_cutter.RoiIndex on the grid of the cube) out of all times
+
+        Returns
+        -------
+        OrderedDict id -> array (height * width * time) of the bounding box of the ROI
+        """
+        result = OrderedDict()
+        for i, roi_id in enumerate(roi_index.ids):
+            window = roi_index.window(i)
+            block = self.read(rows=slice(window.row_off, window.row_off + window.height),
+                              cols=slice(window.col_off, window.col_off + window.width), bands=[band])
+            result[roi_id] = np.moveaxis(roi_index.cut(i, block[:, 0]), 0, -1)
+        return result
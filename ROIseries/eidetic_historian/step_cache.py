@@ -0,0 +1,288 @@
+#
+#  ROIseries_step_cache: content addressed cache of the outputs of processing steps
+#  Copyright (C) 2017 Niklas Keck
+#
+#  This file is part of ROIseries.
+#
+#  ROIseries is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  ROIseries is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with ROIseries.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import json
+import time
+import gzip
+import pickle
+import shutil
+import types
+import inspect
+import hashlib
+import datetime
+import functools
+import numpy as np
+import pandas as pd
+from ROIseries.cookie_cutter.cookie_cutter import RoiIndex
+from ROIseries.cookie_cutter.cube_store import CubeStore
+from ROIseries.feature_sommelier.feature_store import FeatureStore
+
+# values hashed by their type and repr (which shows their content)
+_scalars = (type(None), bool, int, float, complex, bytes, np.generic, datetime.date, datetime.time,
+            datetime.timedelta)
+_functions = (types.FunctionType, types.BuiltinFunctionType, np.ufunc, type)
+
+
+def _update(h, obj):
+    # feed the content of obj into the hash h
+    if isinstance(obj, np.ndarray):
+        h.update(b"ndarray" + str(obj.dtype).encode() + str(obj.shape).encode())
+        if obj.dtype == object:
+            h.update(pickle.dumps(obj.tolist(), protocol=4))
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        h.update(type(obj).__name__.encode())
+        _update(h, pd.util.hash_pandas_object(obj, index=True).values)
+        _update(h, np.asarray(obj.columns if isinstance(obj, pd.DataFrame) else [obj.name], dtype=object))
+        _update(h, np.asarray(obj.dtypes.astype(str) if isinstance(obj, pd.DataFrame) else [str(obj.dtype)],
+                              dtype=object))
+    elif isinstance(obj, pd.Index):
+        _update(h, obj.to_frame(index=False))
+    elif isinstance(obj, dict):
+        h.update(b"dict")
+        for k in sorted(obj, key=repr):
+            _update(h, k)
+            _update(h, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        h.update(type(obj).__name__.encode() + str(len(obj)).encode())
+        for i in obj:
+            _update(h, i)
+    elif isinstance(obj, (set, frozenset)):
+        h.update(type(obj).__name__.encode() + str(len(obj)).encode())
+        for i in sorted(obj, key=repr):
+            _update(h, i)
+    elif isinstance(obj, str) and os.path.isfile(obj):
+        # files (e.g. rasters, shapefiles, CSVs) by path, size and modification time
+        stat = os.stat(obj)
+        h.update("file:{}:{}:{}".format(os.path.abspath(obj), stat.st_size, stat.st_mtime_ns).encode())
+    elif isinstance(obj, str):
+        h.update(b"str:" + obj.encode())
+    elif isinstance(obj, os.PathLike):
+        _update(h, os.fspath(obj))
+    elif isinstance(obj, _scalars):
+        h.update("{}:{!r}".format(type(obj).__name__, obj).encode())
+    elif isinstance(obj, (CubeStore, FeatureStore)):
+        # stores are written once (meta.json first): by their path, size and modification time of meta.json
+        _update(h, type(obj).__name__)
+        _update(h, os.path.join(os.path.abspath(obj.path), "meta.json"))
+    elif isinstance(obj, RoiIndex):
+        h.update(b"RoiIndex")
+        _update(h, (obj.ids, obj.labels, tuple(obj.offset), obj.bbox, obj.upsampling))
+    elif isinstance(obj, np.random.RandomState):
+        h.update(b"RandomState")
+        _update(h, obj.get_state())
+    elif isinstance(obj, functools.partial):
+        h.update(b"partial")
+        _update(h, (obj.func, obj.args, obj.keywords))
+    elif isinstance(obj, types.MethodType):
+        h.update(b"method")
+        _update(h, (obj.__func__, obj.__self__))
+    elif isinstance(obj, _functions):
+        # functions by their qualified name and source code (the code object if the source is not available)
+        h.update("function:{}.{}".format(getattr(obj, "__module__", None),
+                                         getattr(obj, "__qualname__", obj.__name__)).encode())
+        try:
+            h.update(inspect.getsource(obj).encode())
+        except (OSError, TypeError):
+            code = getattr(obj, "__code__", None)
+            if code is not None:
+                h.update(code.co_code)
+                _update(h, tuple(c for c in code.co_consts if not inspect.iscode(c)))
+    elif hasattr(obj, "get_params"):
+        # fitted estimators (attributes ending with _, as check_is_fitted) by their pickled state: the same
+        # parameters fit to other data are another model. Unfitted ones by their class and parameters.
+        h.update(type(obj).__name__.encode())
+        if any(k.endswith("_") and not k.startswith("__") for k in vars(obj)):
+            h.update(b"fitted" + pickle.dumps(obj, protocol=4))
+        else:
+            _update(h, obj.get_params(deep=False))
+    else:
+        # the repr of other objects may hold their address instead of their content
+        raise TypeError("Cannot hash the content of {} for the step key".format(type(obj).__name__))
+
+
+def step_key(step, *args, **kwargs):
+    """
+    Key of a step: sha256 of its name and the content of its inputs and parameters
+
+    Raises a TypeError for inputs whose content cannot be hashed (their repr may hold their address).
+    """
+    h = hashlib.sha256(step.encode())
+    _update(h, args)
+    _update(h, kwargs)
+    return h.hexdigest()
+
+
+class StepCache(object):
+    """
+    Content addressed cache of the outputs of processing steps (the Python counterpart of savetodb / reset)
+
+    A step is identified by its name and a hash of its inputs and parameters (step_key). If the key is
+    in the cache, the outputs are loaded instead of running the step, so re-running a chain after changing
+    only its last step (e.g. the classifier) skips all the steps before it. Only the outputs of the steps
+    are stored: arrays as .npy (memory-mapped when loaded) or, with compress, as compressed .npz, everything
+    else (e.g. DataFrames) pickled (gzip with compress). When the cache exceeds max_bytes, the least recently
+    used entries are deleted.
+
+    Layout
+    ------
+    path/<key>/meta.json     step name, kinds of the outputs, size and time of the last use
+    path/<key>/<i>.npy|npz|pkl   output i
+
+    Example
+    -------
+    >>> cache = StepCache("C:/Users/keck/Desktop/step_cache", max_bytes=50 * 2 ** 30)
+    >>> rois = cache("cookie_cutter", rs.cookie_cutter.cookie_cutter, shapefile, "ID", rasters)
+    >>> df = cache("spatial_mixer", rs.spatial_mixer.spatial_mixer, rois, ["MEAN", "STDDEV"], times)
+
+    # or as decorator
+    >>> spatial_mixer = cache.cached(rs.spatial_mixer.spatial_mixer)
+    """
+    def __init__(self, path, max_bytes=None, compress=False, mmap=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.mmap = mmap
+        os.makedirs(path, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def __contains__(self, key):
+        return os.path.isfile(os.path.join(self._entry(key), "meta.json"))
+
+    def _read_meta(self, key):
+        with open(os.path.join(self._entry(key), "meta.json")) as f:
+            return json.load(f)
+
+    def _write_meta(self, key, meta):
+        # write and rename: an interrupted write does not leave a broken entry
+        temp = os.path.join(self._entry(key), "meta.json.tmp")
+        with open(temp, "w") as f:
+            json.dump(meta, f)
+        os.replace(temp, os.path.join(self._entry(key), "meta.json"))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # storing and loading outputs
+    def _save(self, key, step, outputs, is_tuple):
+        entry = self._entry(key)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.makedirs(entry)
+        kinds = []
+        for i, output in enumerate(outputs):
+            if isinstance(output, np.ndarray) and output.dtype != object:
+                if self.compress:
+                    np.savez_compressed(os.path.join(entry, "{}.npz".format(i)), output=output)
+                    kinds.append("npz")
+                else:
+                    np.save(os.path.join(entry, "{}.npy".format(i)), output)
+                    kinds.append("npy")
+            else:
+                opener = gzip.open if self.compress else open
+                with opener(os.path.join(entry, "{}.pkl".format(i)), "wb") as f:
+                    pickle.dump(output, f, protocol=4)
+                kinds.append("pkl")
+
+        size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        self._write_meta(key, {"step": step, "kinds": kinds, "tuple": is_tuple, "size": size,
+                               "compress": self.compress, "last_access": time.time()})
+
+    def _load(self, key):
+        entry = self._entry(key)
+        meta = self._read_meta(key)
+        outputs = []
+        for i, kind in enumerate(meta["kinds"]):
+            if kind == "npy":
+                outputs.append(np.load(os.path.join(entry, "{}.npy".format(i)), mmap_mode="r" if self.mmap else None))
+            elif kind == "npz":
+                with np.load(os.path.join(entry, "{}.npz".format(i))) as f:
+                    outputs.append(f["output"])
+            else:
+                opener = gzip.open if meta["compress"] else open
+                with opener(os.path.join(entry, "{}.pkl".format(i)), "rb") as f:
+                    outputs.append(pickle.load(f))
+
+        meta["last_access"] = time.time()
+        self._write_meta(key, meta)
+        return tuple(outputs) if meta["tuple"] else outputs[0]
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # running steps
+    def __call__(self, step, func, *args, **kwargs):
+        """
+        Output of func(*args, **kwargs) from the cache, running (and storing) it only if the key is new
+
+        step names the step (the key also depends on it, e.g. "cookie_cutter"), the key also covers func (its
+        qualified name and source code), so editing the step invalidates its entries
+        """
+        key = step_key(step, func, *args, **kwargs)
+        if key in self:
+            return self._load(key)
+
+        outputs = func(*args, **kwargs)
+        is_tuple = isinstance(outputs, tuple)
+        self._save(key, step, outputs if is_tuple else (outputs,), is_tuple)
+        self.evict()
+        if self.mmap and not self.compress and key in self:
+            # memory-mapped as on later runs
+            return self._load(key)
+        return outputs
+
+    def cached(self, func, step=None):
+        """
+        Decorator: func with its outputs cached under step (default: the name of func)
+        """
+        step = func.__name__ if step is None else step
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self(step, func, *args, **kwargs)
+        return wrapper
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # size budget
+    def entries(self):
+        """
+        DataFrame of the entries (key, step, size, last_access), least recently used first
+        """
+        rows = []
+        for key in os.listdir(self.path):
+            if key in self:
+                meta = self._read_meta(key)
+                rows.append((key, meta["step"], meta["size"], meta["last_access"]))
+        df = pd.DataFrame(rows, columns=["key", "step", "size", "last_access"])
+        return df.sort_values("last_access").reset_index(drop=True)
+
+    def evict(self, max_bytes=None):
+        """
+        Delete the least recently used entries until the cache holds at most max_bytes (default: self.max_bytes)
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if max_bytes is None:
+            return
+        entries = self.entries()
+        excess = entries["size"].sum() - max_bytes
+        for key, size in zip(entries["key"], entries["size"]):
+            if excess <= 0:
+                break
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            excess -= size
@@ -0,0 +1,159 @@
+#
+#  ROIseries_curve_aggregation: aggregate ROC and precision recall curves over many folds
+#  Copyright (C) 2017 Niklas Keck
+#
+#  This file is part of ROIseries.
+#
+#  ROIseries is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  ROIseries is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with ROIseries.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# The curves of all folds are packed into one flat array. Curve i is flat[offsets[i]:offsets[i + 1]].
+import numpy as np
+
+
+def pack(curves):
+    """
+    Pack a list of 1D arrays of varying length into one flat array and the offsets of the arrays
+
+    Example
+    -------
+    >>> pack([np.array([1, 2]), np.array([3, 4, 5])])
+    (array([1, 2, 3, 4, 5]), array([0, 2, 5]))
+    """
+    lengths = [len(c) for c in curves]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    flat = np.concatenate(curves) if curves else np.empty(0)
+    return flat, offsets
+
+
+def unpack(flat, offsets):
+    """
+    Inverse of pack: list of the curves in flat
+    """
+    return np.split(flat, offsets[1:-1])
+
+
+def _curve_id(offsets):
+    # curve number of each element of the flat array
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def reverse(flat, offsets):
+    """
+    Reverse the order of the elements within each curve
+    """
+    curve = _curve_id(offsets)
+    position = np.arange(len(flat)) - offsets[curve]
+    return flat[offsets[curve + 1] - 1 - position]
+
+
+def cummax(flat, offsets):
+    """
+    Cumulative maximum within each curve
+    """
+    if len(flat) == 0:
+        return flat.copy()
+    # work on the (integer) ranks of the values to be exact and lift each curve above all previous ones,
+    # so that one accumulate does not mix the curves
+    values, rank = np.unique(flat, return_inverse=True)
+    lift = len(values) * _curve_id(offsets)
+    return values[np.maximum.accumulate(rank + lift) - lift]
+
+
+def precision_envelope(precision, recall, offsets):
+    """
+    Interpolated precision of precision recall curves (as returned by precision_recall_curve)
+
+    The interpolated precision at recall r is the maximum precision at any recall >= r:
+    http://nlp.stanford.edu/IR-book/html/htmledition/evaluation-of-ranked-retrieval-results-1.html
+
+    Parameters
+    ----------
+    precision, recall : packed curves ordered by decreasing recall
+    offsets : offsets of the curves
+
+    Returns
+    -------
+    The interpolated precision and the recall, both packed and ordered by increasing recall
+    """
+    # in the order of decreasing recall the envelope is the running maximum
+    return reverse(cummax(precision, offsets), offsets), reverse(recall, offsets)
+
+
+def interpolate(x, y, offsets, grid):
+    """
+    Linear interpolation of all curves to grid at once (like np.interp for each curve)
+
+    Parameters
+    ----------
+    x, y : packed curves, x increasing within each curve
+    offsets : offsets of the curves
+    grid : 1D array of x coordinates to interpolate to
+
+    Returns
+    -------
+    2D array curve * grid
+    """
+    n_curves = len(offsets) - 1
+    grid = np.asarray(grid, dtype=np.float64)
+    starts, ends = offsets[:-1], offsets[1:] - 1
+
+    # shift the curves (and the grid) apart, so that one searchsorted finds the positions in all curves
+    span = max(np.max(x) if len(x) else 0, np.max(grid)) - min(np.min(x) if len(x) else 0, np.min(grid)) + 1
+    shift = span * np.arange(n_curves)
+    x_shifted = x + np.repeat(shift, np.diff(offsets))
+    grid_shifted = grid[None, :] + shift[:, None]
+
+    right = np.searchsorted(x_shifted, grid_shifted, side='right')
+    left = np.clip(right - 1, starts[:, None], ends[:, None])
+    right = np.clip(right, starts[:, None], ends[:, None])
+
+    x_left, x_right = x[left], x[right]
+    dx = x_right - x_left
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(dx > 0, (grid[None, :] - x_left) / dx, 0)
+    return y[left] + weight * (y[right] - y[left])
+
+
+def mean_std(values, weights=None):
+    """
+    (Weighted) mean and standard deviation over the curves (axis 0) of interpolated values
+    """
+    if weights is None:
+        weights = np.ones(values.shape[0])
+    weights = np.asarray(weights, dtype=np.float64)[:, None]
+    mean = np.sum(weights * values, axis=0) / np.sum(weights)
+    std = np.sqrt(np.sum(weights * (values - mean) ** 2, axis=0) / np.sum(weights))
+    return mean, std
+
+
+def interpol_for_stats(x, y, offsets, grid=None, weights=None):
+    """
+    Mean and standard deviation of curves of varying length, interpolated to grid
+
+    Parameters
+    ----------
+    x, y : packed curves (see pack), x increasing within each curve
+    offsets : offsets of the curves
+    grid : x coordinates of the result, default: np.linspace(0, 1, 100)
+    weights : weight of each curve (e.g. the number of test samples of the fold), default: equal weights
+
+    Returns
+    -------
+    grid, mean and standard deviation of y at grid
+    """
+    if grid is None:
+        grid = np.linspace(0, 1, 100)
+    mean, std = mean_std(interpolate(x, y, offsets, grid), weights)
+    return grid, mean, std
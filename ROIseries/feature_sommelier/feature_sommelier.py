@@ -19,27 +19,217 @@
 #-
 
 import pandas as pd
-from scipy import interp
 import numpy as np
-import matplotlib.pyplot as plt
 import copy as cp
-import seaborn as sns
-import itertools
-from astropy.time import Time
-import tempfile
-import datetime
-
-from imblearn.over_sampling import (SMOTE,
-                                    RandomOverSampler)
-
-from sklearn.preprocessing import Imputer
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import StratifiedKFold
-from sklearn.metrics import (roc_curve, 
-                             roc_auc_score,
-                             precision_recall_curve,
-                             confusion_matrix,
-                             cohen_kappa_score)
+import functools
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from ROIseries.sub_routines.sub_routines import lazy_import
+from ROIseries.feature_sommelier.feature_store import FeatureStore
+from ROIseries.feature_sommelier import scoring_metrics, curve_aggregation, time_axis
+
+# heavy dependencies: imported by the methods using them, see lazy_import
+plt = lazy_import("matplotlib.pyplot")
+sns = lazy_import("seaborn")
+over_sampling = lazy_import("imblearn.over_sampling")
+impute = lazy_import("sklearn.impute")
+ensemble = lazy_import("sklearn.ensemble")
+model_selection = lazy_import("sklearn.model_selection")
+
+def preprocess_fold(X, y, train_index, test_index, seed, upsampling = True, method = "RANDOM",
+                    impute_missing = True):
+    """
+    Training and test set of one fold of ROIseries_feature_sommelier.CV
+
+    Missing values of both sets are imputed with the column means of the training set, so that nothing of
+    the test set leaks into the fold. Only the training set is over-sampled (SMOTE or RANDOM, random state
+    seed).
+
+    Returns X_train, y_train, X_test, y_test
+    """
+    # Choose training / testing subsets
+    X_train, X_test = X[train_index], X[test_index]
+    y_train, y_test = y[train_index], y[test_index]
+
+    # impute missing values with the statistics of the training set
+    if impute_missing == True:
+        imp = impute.SimpleImputer(missing_values=np.nan, strategy='mean')
+        X_train = imp.fit_transform(X_train)
+        X_test = imp.transform(X_test)
+    elif ~(np.isfinite(X)).all():
+        raise ValueError("All values need to be finite. NaN not allowed.")
+
+    # Do the upsampling ONLY!! for the training data
+    if upsampling == True:
+        if method == "SMOTE":
+            sm = over_sampling.SMOTE(random_state = seed)
+            X_train,y_train = sm.fit_resample(X_train,y_train)
+        elif method == "RANDOM":
+            ros = over_sampling.RandomOverSampler(random_state = seed)
+            X_train,y_train = ros.fit_resample(X_train,y_train)
+    # else: no upsampling was done, please ensure equal number of samples for each class
+    return X_train, y_train, X_test, y_test
+
+
+def fit_fold(X_train, y_train, X_test, y_test, seed, positive, n_trees, n_jobs, return_model = False):
+    """
+    Fit a forest to the (preprocessed, see preprocess_fold) training set and apply it to the test set
+
+    Returns the probability of the positive class, the predicted and the true class of the test
+    samples and the feature importance (and the fitted forest if return_model).
+    """
+    rf = ensemble.RandomForestClassifier(random_state = seed, n_estimators = n_trees, n_jobs = n_jobs)
+    rf.fit(X_train,y_train)
+
+    # apply to test data (probability 0 if the positive class was not part of the training data)
+    probability = rf.predict_proba(X_test)
+    y_probability = (probability[:,rf.classes_ == positive]).sum(axis=1)
+    # same as rf.predict(X_test) without a second pass through the forest
+    y_predicted = rf.classes_.take(np.argmax(probability, axis=1))
+    result = (y_probability, y_predicted, np.array(y_test).ravel(), rf.feature_importances_)
+    if return_model:
+        result += (rf,)
+    return result
+
+
+def cv_fold(X, y, train_index, test_index, seed, positive, n_trees, n_jobs,
+            upsampling = True, method = "RANDOM", impute_missing = True, return_model = False):
+    """
+    Train and test one fold of ROIseries_feature_sommelier.CV (preprocess_fold and fit_fold)
+
+    All random states are set to seed.
+    """
+    fold = preprocess_fold(X, y, train_index, test_index, seed, upsampling, method, impute_missing)
+    return fit_fold(*fold, seed, positive, n_trees, n_jobs, return_model = return_model)
+
+
+class FoldCache(object):
+    """
+    Preprocessed folds (see preprocess_fold) of ROIseries_feature_sommelier, at most max_bytes
+
+    Repeated CV runs over the same folds (e.g. other n_trees or several feature sets tested against each
+    other) skip the imputation and over-sampling. The least recently used folds are dropped first, a fold
+    larger than max_bytes is not kept at all (max_bytes = 0 disables the cache). The cached arrays are read
+    only.
+    """
+    def __init__(self, max_bytes = 2 ** 30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._folds = OrderedDict()
+
+    def __len__(self):
+        return len(self._folds)
+
+    def get(self, key):
+        """ The fold of key, None if it is not cached """
+        if key in self._folds:
+            self._folds.move_to_end(key)
+            self.hits += 1
+            return self._folds[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, fold):
+        """ Keep fold (X_train, y_train, X_test, y_test) if it is not larger than max_bytes """
+        size = sum(a.nbytes for a in fold)
+        if size > self.max_bytes or key in self._folds:
+            return
+        for a in fold:
+            a.setflags(write = False)
+        self._folds[key] = fold
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, dropped = self._folds.popitem(last = False)
+            self.nbytes -= sum(a.nbytes for a in dropped)
+
+    def clear(self):
+        self._folds.clear()
+        self.nbytes = 0
+
+
+def _digest(*arrays):
+    # hash of the content of arrays (part of the key of the cached folds)
+    digest = hashlib.blake2b(digest_size = 16)
+    for a in arrays:
+        a = np.asarray(a)
+        if a.dtype.hasobject:
+            a = pd.util.hash_array(a.ravel())
+        digest.update(str((a.shape, a.dtype.str)).encode())
+        digest.update(np.ascontiguousarray(a).data)
+    return digest.hexdigest()
+
+
+# X and y of the process pool workers of ROIseries_feature_sommelier.CV
+_cv_shared = {}
+
+def _cv_init_worker(shm_name, shape, dtype, y):
+    # attach to the shared memory block once per worker instead of pickling X for every fold
+    if shm_name is not None:
+        shm = shared_memory.SharedMemory(name = shm_name)
+        _cv_shared["shm"] = shm
+        _cv_shared["X"] = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+    _cv_shared["y"] = y
+
+def _cv_fold_shared(task, seed, upsampling, method, impute_missing, keep_bytes, **kwargs):
+    # process pool worker. task is ("preprocess", train_index, test_index): preprocess the fold from the shared X
+    # and return it if it is at most keep_bytes (to be cached by the parent), or ("cached", blocks): the arrays
+    # of a cached fold in shared memory (name, shape, dtype), arrays of objects (e.g. class names) as they are
+    if task[0] == "preprocess":
+        fold = preprocess_fold(_cv_shared["X"], _cv_shared["y"], task[1], task[2], seed, upsampling, method,
+                               impute_missing)
+        result = fit_fold(*fold, seed, **kwargs)
+        return result, (fold if sum(a.nbytes for a in fold) <= keep_bytes else None)
+
+    fold, shms = [], []
+    try:
+        for block in task[1]:
+            if isinstance(block, np.ndarray):
+                fold.append(block)
+                continue
+            name, shape, dtype = block
+            shms.append(shared_memory.SharedMemory(name = name))
+            fold.append(np.ndarray(shape, dtype = dtype, buffer = shms[-1].buf))
+        result = fit_fold(*fold, seed, **kwargs)
+        del fold
+        return result, None
+    finally:
+        for shm in shms:
+            try:
+                shm.close()
+            except BufferError:
+                # still referenced (e.g. by the forest), closed when collected
+                pass
+
+
+class _NameIndex(object):
+    # the feature names joined to one string and the start of each name in it, built once when the names are
+    # set: the names containing a string are found by str.find on the joined names, not by a scan of all names
+    def __init__(self, names):
+        names = [str(n) for n in names]
+        self.joined = "\n".join(names)
+        self.starts = np.cumsum([0] + [len(n) + 1 for n in names[:-1]]) if names else np.zeros(0, dtype = np.int64)
+
+    def contains(self, string):
+        # boolean mask of the names containing string
+        n = len(self.starts)
+        if not string:
+            return np.ones(n, dtype = bool)
+        mask = np.zeros(n, dtype = bool)
+        position = self.joined.find(string) if "\n" not in string else -1
+        while position >= 0:
+            name = np.searchsorted(self.starts, position, side = "right") - 1
+            mask[name] = True
+            if name + 1 == n:
+                break
+            # continue with the next name
+            position = self.joined.find(string, self.starts[name + 1])
+        return mask
+
 
 class ROIseries_feature_sommelier(object):
     # static variables
@@ -48,6 +238,8 @@ class ROIseries_feature_sommelier(object):
     n_trees = 50
     messages = True
     n_jobs = -1
+    n_processes = 1 # processes running the CV folds in parallel (1: serial)
+    fold_cache_bytes = 2 ** 30 # memory of the preprocessed CV folds kept for repeated runs (see FoldCache)
     
     '''
     Interpol_for_stats returns the mean and std for vectors of varying length.
@@ -57,6 +249,10 @@ class ROIseries_feature_sommelier(object):
     
     Parameters
     ----------
+    x, y : lists of arrays, x increasing within each array
+    correct_first_last : set the first / last mean to 0 / 1
+    grid : x coordinates to interpolate to, default: np.linspace(0, 1, 100)
+    weights : weight of each array pair (e.g. the number of test samples of a fold), default: equal
     
     Examples
     --------
@@ -91,49 +287,29 @@ class ROIseries_feature_sommelier(object):
     -------
     
     It returns 3 lists: 
-        mean_x_list: np.linspace(0, 1, 100), as this is the
-                     only option required for recall and precision.
+        mean_x_list: grid (default np.linspace(0, 1, 100), as this is
+                     the only option required for recall and precision).
         
         mean_y_list: the average value interpolated to mean_x_list
         std_y_list: the standard deviation interpolate to std_y_list    
     '''
     @staticmethod
-    def interpol_for_stats(x,y,correct_first_last = False):
- 
-        mean_x = np.linspace(0, 1, 100)
-        
-        # 1. interpolate the x/y values to the regular spacing defined by x coordinates (mean_x)
-        # interpol holds y values at positions mean_x
-        interpol = [interp(mean_x, x_i, y_i) for x_i,y_i in zip(x,y)]
-        interpol = (np.array(interpol))
-        
-        # 2. calculate the sum and normalize by length of x
-        mean_y = np.sum(interpol,axis=0) / len(x)
+    def interpol_for_stats(x,y,correct_first_last = False, grid = None, weights = None):
+        # grid: x coordinates to interpolate to (default np.linspace(0, 1, 100)), weights: weight of each curve
+        # all curves are interpolated at once, see curve_aggregation
+        x_flat, offsets = curve_aggregation.pack(x)
+        y_flat, _ = curve_aggregation.pack(y)
+        mean_x, mean_y, std_y = curve_aggregation.interpol_for_stats(x_flat, y_flat, offsets, grid, weights)
         if correct_first_last == True:
             mean_y[0] = 0.0 # is this correct
             mean_y[-1] = 1.0 # is this correct
-                              
-        # 3. standard deviation (using broadcasting!!! http://www.scipy-lectures.org/intro/numpy/operations.html)
-        var_y = np.sum(((interpol - mean_y)**2),axis=0) / len(x)
-        std_y = np.sqrt(var_y)
         
         # return results
         return mean_x, mean_y, std_y
     
     @staticmethod
     def interpolate_pr(pr,rec):
-        prInv = np.fliplr([pr])[0]
-        recInv = np.fliplr([rec])[0]
-        j = rec.shape[0]-2
-                     
-        while j>=0:
-            if prInv[j+1]>prInv[j]:
-                prInv[j]=prInv[j+1]
-            j=j-1
-                
-        decreasing_max_precision = np.maximum.accumulate(prInv[::-1])[::-1]
-        # plt.plot(rec,pr)
-        # plt.plot(recInv,decreasing_max_precision)
+        decreasing_max_precision, recInv = curve_aggregation.precision_envelope(pr, rec, np.array([0, len(pr)]))
         return decreasing_max_precision, recInv
     
     @staticmethod
@@ -155,79 +331,237 @@ class ROIseries_feature_sommelier(object):
         return result
     
     @staticmethod
-    def read_features_and_groundtruth(features_csv,scene_properties_csv):
-        #----------------------------------------------------------
-        #   Read features output from ROIseries
-        df = [pd.read_csv(i, index_col = 0) for i in features_csv]
-        df = pd.concat(df,axis=1)
-        
-        # transpose the features to:
-        # -> use the time specified in second part of the the column name in a column
-        # -> use the dimensional history in first part of colum name in a colum (e. g. spatial mean, temporal standard deviation)
-        df_trans = pd.DataFrame.transpose(df)
-        id_variables = ['dimensional_history','time']
-        df_trans_infos = (df_trans.index).str.rsplit("_",1)
-        df_trans_infos_df = pd.DataFrame(df_trans_infos.tolist())
-        df_trans_infos_df.columns = id_variables
-        df_trans_infos_df['time']=pd.to_numeric(df_trans_infos_df['time']) 
-        df_trans_infos_df.index = df_trans.index
-        temp=df_trans.join(df_trans_infos_df)
-        long_format = pd.melt(temp,id_vars=id_variables)
-        long_format=long_format.rename(columns ={"variable":"id"})
-        long_format["id_time"]=[str(i)+"_"+"{:.10f}".format(t) for i,t in zip((long_format["id"]).tolist(),(long_format["time"]).tolist())]
-        long_format.drop(["time","id"],axis=1,inplace=True)
-        
-        #  Change format to wide format to have rows X columns = samples X features order
-        wide_format=pd.pivot_table(long_format,columns='dimensional_history',index="id_time",values="value")
-        temp = [(i.split("_")) for i in wide_format.index]
-        wide_format["time"]= [float(i[1]) for i in temp]
-        wide_format["id"] = [i[0] for i in temp] 
-        
-        
-        #----------------------------------------------------------
-        #   Read ground truth
+    def read_groundtruth(scene_properties_csv):
+        """
+        Read the scene properties and index them by the acquisition time of the scene.
+
+        The time is parsed from the file names (YYYYMMDDTHHMMSS, see time_axis.scene_time_to_ns),
+        read_features_and_groundtruth joins the feature dates on it.
+        """
         scene_properties = pd.read_csv(scene_properties_csv)
         scene_properties.drop("contains_data",axis=1,inplace=True)
-        a=((scene_properties['filename'])).str.split("_")
-        a_df = pd.DataFrame(a)
-        b = (a_df['filename']).apply(pd.Series)
-        time_datetime=[datetime.datetime.strptime(i,"%Y%m%dT%H%M%S") for i in b[3]]
-        time_astropy = [Time(i,format="datetime") for i in time_datetime]
-        scene_properties["time_julian"]=[i.jd for i in time_astropy]
+        time = time_axis.scene_time_to_ns(scene_properties["filename"])
         scene_properties.drop("filename",axis=1,inplace=True)
-        
-        # convert to integer and round to make join possible
-        significant_digits = 6
-        scene_properties["time_julian"]=[int(10**significant_digits *i) for i in scene_properties["time_julian"]]
-        wide_format["time"]=[int(10**significant_digits *i) for i in wide_format["time"]]
-        
+        scene_properties.index = pd.DatetimeIndex(time.view("datetime64[ns]"), name = "time")
+        return scene_properties
+
+    @staticmethod
+    def read_features_and_groundtruth(features_csv,scene_properties_csv,chunksize = 10000,significant_digits = 6,
+                                      features = None, times = None):
+        """
+        Read the feature CSVs written by ROIseries_3D::features_to_csv and join the ground truth.
+
+        The CSVs are in the format ID * FEATURE_JULIANDATE. They are streamed in chunks of
+        chunksize rows directly into a preallocated samples * features matrix, so apart
+        from the result only one chunk is held in memory at a time.
+
+        Parameters
+        ----------
+        features_csv : list of paths to the feature CSVs or a feature_store.FeatureStore
+        scene_properties_csv : path to the scene properties CSV (filename, <ground truth columns>, contains_data)
+        chunksize : number of rows (ROIs) read from a CSV at once
+        significant_digits : decimal places of the julian date used for the join: feature dates and scenes
+                             match if they are less than 0.5 * 10**-significant_digits days apart
+        features, times : only for a FeatureStore: the features (e.g. from FeatureStore.select_features)
+                          and dates to read, see FeatureStore.read
+
+        Returns
+        -------
+        DataFrame of rows * columns = samples * features with a (id, time) MultiIndex, the
+        column "id" and the columns of the scene properties. It can be passed directly
+        to ROIseries_feature_sommelier.
+        """
+        if isinstance(features_csv, FeatureStore):
+            # the store reads only the requested features and dates
+            result = features_csv.read_samples(features = features, times = times)
+            result["id"] = result.index.get_level_values("id")
+            times, sample_time_pos = np.unique(result.index.get_level_values("time"), return_inverse = True)
+            return ROIseries_feature_sommelier._join_groundtruth(result, time_axis.julian_to_ns(times), sample_time_pos,
+                                                                 scene_properties_csv, significant_digits)
+
         #----------------------------------------------------------
-        #  Join ground truth to features and write result to disc
-        result = pd.merge(wide_format,scene_properties,how='left',left_on="time",right_on="time_julian",sort=False)
-        result.index=list(zip(result["id"],(result["time"])*(10**-significant_digits)))
-        result.drop(["time","time_julian"],axis=1,inplace=True)
-        
-        outcsv = tempfile.gettempdir()+"\\temporary.csv"
-        result.to_csv(outcsv)
-        return(outcsv)
-        
+        #   1. Read only headers and ids to lay out the result
+        # the FEATURE_JULIANDATE suffixes are split once per file, the dates are matched exactly in ns
+        col_infos = []
+        ids = None
+        for csv in features_csv:
+            header = pd.read_csv(csv, index_col = 0, nrows = 0).columns
+            col_infos.append(time_axis.parse_colsuffix(header))
+            file_ids = pd.Index(pd.read_csv(csv, usecols = [0]).iloc[:, 0])
+            ids = file_ids if ids is None else ids.append(file_ids)
+        ids = ids.drop_duplicates()
+
+        features = pd.Index(np.unique(np.concatenate([f for f, _ in col_infos])), name = "dimensional_history")
+        time_ns = np.unique(np.concatenate([t for _, t in col_infos]))
+        n_times = len(time_ns)
+
+        #----------------------------------------------------------
+        #   2. Stream the values of all files into the samples * features matrix
+        # row of sample (id, time) = id_position * n_times + time_position
+        values = np.full((len(ids) * n_times, len(features)), np.nan)
+        for csv, (feature_names, feature_times) in zip(features_csv, col_infos):
+            feature_pos = features.get_indexer(feature_names)
+            time_pos = np.searchsorted(time_ns, feature_times)
+            for chunk in pd.read_csv(csv, index_col = 0, chunksize = chunksize):
+                id_pos = ids.get_indexer(chunk.index)
+                rows = id_pos[:, None] * n_times + time_pos[None, :]
+                values[rows, feature_pos[None, :]] = chunk.values
+
+        # samples without any value are not part of the result (as in a long to wide pivot)
+        valid = ~np.isnan(values).all(axis = 1)
+        values = values[valid]
+        sample_id = np.repeat(np.asarray(ids), n_times)[valid]
+        sample_time_pos = np.tile(np.arange(n_times), len(ids))[valid]
+
+        times = time_axis.ns_to_julian(time_ns)
+        result = pd.DataFrame(values,
+                              index = pd.MultiIndex.from_arrays([sample_id, times[sample_time_pos]], names = ["id", "time"]),
+                              columns = features)
+        result["id"] = sample_id
+
+        return ROIseries_feature_sommelier._join_groundtruth(result, time_ns, sample_time_pos,
+                                                             scene_properties_csv, significant_digits)
+
+    @staticmethod
+    def _join_groundtruth(result, time_ns, sample_time_pos, scene_properties_csv, significant_digits):
+        # join ground truth on the time in ns (once per date, then broadcast to the samples). time_ns is the time
+        # axis of the features (JULIAN_EPOCH), the scenes are matched on the astronomical julian date.
+        scene_properties = ROIseries_feature_sommelier.read_groundtruth(scene_properties_csv)
+        if not scene_properties.index.is_unique:
+            raise ValueError("The acquisition times of the scenes must be unique")
+        tolerance = 0.5 * 10**-significant_digits * time_axis.NS_PER_DAY
+        to_utc = int(round((time_axis.JULIAN_EPOCH - time_axis.JULIAN_EPOCH_UTC) * time_axis.NS_PER_DAY))
+        scene_pos = time_axis.match_times(time_ns + to_utc, scene_properties.index.asi8, tolerance)
+        # dates without a scene (position -1) get missing values
+        scene_properties = scene_properties.reset_index(drop = True).reindex(scene_pos)
+        for column in scene_properties.columns:
+            result[column] = scene_properties[column].values[sample_time_pos]
+
+        return result
+
     def __init__(self, csv, class_column, strata_column, positive_classname,drop_columns = []):
-        # read in data
-        df = pd.read_csv(csv, index_col = 0)
-        self.y = df[class_column]
-        self.strata = df[strata_column]
+        # read in data: csv is either the path to a csv or a DataFrame (e.g. from read_features_and_groundtruth)
+        if isinstance(csv, pd.DataFrame):
+            df = csv
+        else:
+            df = pd.read_csv(csv, index_col = 0)
+        # positional arrays: the index can be a MultiIndex, which does not support positional indexing
+        self._y = df[class_column].values
+        self._strata = df[strata_column].values
         
-        drop_columns.extend([class_column, strata_column])
-        df.drop(drop_columns,axis=1, inplace=True)
+        df = df.drop(list(drop_columns) + [class_column, strata_column],axis=1)
         
-        self.id = df.index
-        self.feature_names = df.columns
-        self.X = df.values
+        self._id = df.index
+        self._set_feature_names(df.columns)
+        self._X = df.values
         self.positive = positive_classname
-        
+
+        # selections (select_*) are views: they share the data above and only hold the positions of their
+        # rows and columns (None = all), which are applied when the data is accessed
+        self._rows = None
+        self._cols = None
+
+        # preprocessed folds, shared with the selections (the key holds the content of the data, see _fold_key)
+        self.fold_cache = FoldCache(self.fold_cache_bytes)
+        self._freeze()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # data of the (selected) samples and features
+    def _take_rows(self, data):
+        if data is None or self._rows is None:
+            return data
+        return data[self._rows]
+
+    @property
+    def X(self):
+        if self._rows is not None and self._cols is not None:
+            return self._X[np.ix_(self._rows, self._cols)]
+        elif self._rows is not None:
+            return self._X[self._rows]
+        elif self._cols is not None:
+            return self._X[:, self._cols]
+        return self._X
+
+    @X.setter
+    def X(self, X):
+        # the new X replaces the selection: keep only the selected part of the other data
+        self._y, self._strata, self._id = self.y, self.strata, self.id
+        self._set_feature_names(self.feature_names)
+        self._X = X
+        self._rows = self._cols = None
+        self._freeze()
+
+    @property
+    def y(self):
+        return self._take_rows(self._y)
+
+    @y.setter
+    def y(self, y):
+        self._materialize()
+        self._y = y
+        self._freeze()
+
+    @property
+    def strata(self):
+        return self._take_rows(self._strata)
+
+    @strata.setter
+    def strata(self, strata):
+        self._materialize()
+        self._strata = strata
+
+    @property
+    def id(self):
+        return self._take_rows(self._id)
+
+    @id.setter
+    def id(self, id):
+        self._materialize()
+        self._id = id
+
+    @property
+    def feature_names(self):
+        if self._cols is None:
+            return self._feature_names
+        return self._feature_names[self._cols]
+
+    @feature_names.setter
+    def feature_names(self, feature_names):
+        self._materialize()
+        self._set_feature_names(feature_names)
+
+    def _set_feature_names(self, feature_names):
+        # names of all features (shared with the selections) and their lookup for select_features
+        self._feature_names = pd.Index(feature_names)
+        self._name_index = _NameIndex(self._feature_names)
+
+    def _freeze(self):
+        # X and y are read only (assign new arrays instead of changing them in place), so that the digest of
+        # their content (the key of the cached folds) is computed once, when they are set
+        self._X = np.asarray(self._X).view()
+        self._X.setflags(write = False)
+        if self._y is not None:
+            self._y = np.asarray(self._y).view()
+            self._y.setflags(write = False)
+        self._data_digest = _digest(self._X, np.asarray(self._y))
+
+    def _materialize(self):
+        # copy the selected data, afterwards the object does not share data with its parent anymore
+        if self._rows is not None or self._cols is not None:
+            self.X = self.X
+
+    def _select(self, rows = None, cols = None):
+        # rows and cols are positions within the current selection: compose them with its positions
+        new_object = cp.copy(self)
+        if rows is not None:
+            new_object._rows = rows if self._rows is None else self._rows[rows]
+        if cols is not None:
+            new_object._cols = cols if self._cols is None else self._cols[cols]
+        return new_object
+
     def impute_missing(self):       
         # impute missing values with mean (Optimization possible)
-        imp = Imputer(missing_values='NaN', strategy='mean', axis=0)   
+        imp = impute.SimpleImputer(missing_values=np.nan, strategy='mean')   
         self.X = imp.fit_transform(self.X)
         if self.messages == True:
             print("missing NaN imputed with column mean")
@@ -238,135 +572,185 @@ class ROIseries_feature_sommelier(object):
             print("Of full sample %s, %s are True" %(len(y),len((np.where(y))[0])))
         # set strata to None since it is not clear of what strata the newly generated samples are
         self.strata = None
-        sm = SMOTE(random_state = self.ran_stat)
-        self.X,self.y = sm.fit_sample(X,y)
+        sm = over_sampling.SMOTE(random_state = self.ran_stat)
+        self.X,self.y = sm.fit_resample(X,y)
         if self.messages == True:
             print("Of full sample %s, %s are True" %(len(self.y),len((np.where(self.y))[0])))
     
     def select_strata(self,stratum):
         positions = (np.where(self.strata == stratum)[0])
-        newObject = cp.deepcopy(self)
-        newObject.X = self.X[positions]
-        newObject.y = self.y[positions]
-        return newObject
+        return self._select(rows = positions)
     
     def select_features(self,feature_string,exclude = False):
-        feat = self.feature_names
-        full_indices = range(len(feat))        
-        select_indices = [c for c,i in enumerate(feat) if feature_string in i]
+        contains = self._name_index.contains(feature_string)
+        if self._cols is not None:
+            contains = contains[self._cols]
         if exclude:
-            indices = [i for i in full_indices if i not in select_indices]
-        else:
-            indices = select_indices        
-        new_object = cp.deepcopy(self)
-        new_object.X = ((new_object.X)[:,indices])
-        new_object.feature_names = feat[indices]        
-        return(new_object)
+            contains = ~contains
+        return self._select(cols = np.where(contains)[0])
     
     def select_by_feature_range(self,feature,minimum,maximum):
-        # create indices
-        names = self.feature_names
-        column = np.argmax(names == feature)
-        data = self.X[:,column]
+        # create indices: read only the column of feature
+        column = self._feature_names.get_loc(feature)
+        if self._cols is not None and column not in self._cols:
+            raise KeyError("{} is not part of the selected features".format(feature))
+        data = self._take_rows(self._X[:,column])
         indices = (np.where(np.logical_and(data >= minimum,data <= maximum)))[0]
         
         # make subset and return
-        new_object = cp.deepcopy(self)
-        new_object.X = self.X[indices,:]
-        new_object.y = self.y[indices]
-        new_object.strata = self.strata[indices]
-        return new_object
+        return self._select(rows = indices)
         
-    def RF_cv_by_strata(self):
-        """ Train on own data, test on other data """
-        rf = RandomForestClassifier(random_state = self.ran_stat, n_estimators = self.n_trees, n_jobs=self.n_jobs) 
-        strata = set(self.strata) 
-        res_dict = {}
-        for i in itertools.permutations(strata,r=2):
-            o1 = self.select_strata(i[0])
-            o2 = self.select_strata(i[1])
-            rf.fit(o1.X,o1.y)
-            y_probability = rf.predict_proba(o2.X)
-            y_predicted = rf.predict(o2.X)
-            res_dict[i] = zip(y_predicted,y_probability)
-            
+    def RF_cv_by_strata(self,upsampling = False,method = "RANDOM", impute_missing = False):
+        """ Train on own data, test on other data
+
+        One forest per stratum is fit exactly once (kept in self.rf_strata) and applied to the samples
+        of all other strata in one batch. With n_processes > 1 the strata run in a process pool (see CV).
+
+        Returns
+        -------
+        DataFrame of train stratum (rows) * (metric, test stratum) (columns) with the metrics
+        kappa, F and AUC, e.g. result["kappa"] is the strata * strata matrix of kappa.
+        """
+        X, y, strata = np.asarray(self.X), np.asarray(self.y), np.asarray(self.strata)
+        strata_uniq, strata_integer = np.unique(strata, return_inverse = True)
+        n_strata = len(strata_uniq)
+
+        # train on one stratum, test on all others
+        train_indices = [np.where(strata_integer == s)[0] for s in range(n_strata)]
+        test_indices = [np.where(strata_integer != s)[0] for s in range(n_strata)]
+        seeds = [self.ran_stat] * n_strata
+        results = self._run_folds(X, y, train_indices, test_indices, seeds, upsampling = upsampling,
+                                  method = method, impute_missing = impute_missing, return_model = True)
+        self.rf_strata = dict(zip(strata_uniq, [r[4] for r in results]))
+
+        # split the batched predictions of each forest by test stratum and evaluate all test strata at once
+        metrics = ["kappa", "F", "AUC"]
+        result = np.full((n_strata, len(metrics), n_strata), np.nan)
+        for s_train, (test_index, (y_probability, _, y_true, _, _)) in enumerate(zip(test_indices, results)):
+            test_strata = strata_integer[test_index]
+            s_test = [s for s in range(n_strata) if s != s_train]
+            _, measures, _, _ = scoring_metrics.fold_metrics([y_true[test_strata == s] for s in s_test],
+                                                             [y_probability[test_strata == s] for s in s_test],
+                                                             positive = self.positive)
+            for c, m in enumerate(metrics):
+                result[s_train, c, s_test] = measures[m]
+
+        columns = pd.MultiIndex.from_product([metrics, strata_uniq], names = ["metric", "test_stratum"])
+        return pd.DataFrame(result.reshape(n_strata, -1), index = pd.Index(strata_uniq, name = "train_stratum"),
+                            columns = columns)
+
     def RF_predict_other(self,other_object):
         y_probability = (self.rf).predict_proba(other_object.X)
         y_predicted = (self.rf).predict(other_object.X)
         return y_predicted,y_probability
         
+    def _fold_key(self, data, train_index, test_index, seed, upsampling, method, impute_missing):
+        # the fold is determined by the data (the digest of X and y and the selected rows and features), its
+        # indices and the options, the seed only matters for the over-sampling
+        upsampling = upsampling == True
+        return (data, _digest(train_index, test_index), upsampling, method if upsampling else None,
+                int(seed) if upsampling else None, impute_missing == True)
+
+    def _run_folds(self, X, y, train_indices, test_indices, seeds, upsampling = True, method = "RANDOM",
+                   impute_missing = True, return_model = False):
+        # preprocess (or take from fold_cache) and fit each (train_index, test_index, seed), one fold at a time,
+        # in a process pool if n_processes > 1
+        n_folds = len(seeds)
+        selection = [np.array([-1]) if positions is None else positions for positions in (self._rows, self._cols)]
+        data = (self._data_digest, _digest(*selection))
+        keys = [self._fold_key(data, train_index, test_index, seed, upsampling, method, impute_missing)
+                for train_index, test_index, seed in zip(train_indices, test_indices, seeds)]
+
+        if self.n_processes == 1:
+            results = []
+            for c,(key, train_index, test_index, seed) in enumerate(zip(keys, train_indices, test_indices, seeds)):
+                if self.messages == True:
+                    print("Fold %s/%s" %(c,n_folds))
+                fold = self.fold_cache.get(key)
+                if fold is None:
+                    fold = preprocess_fold(X, y, train_index, test_index, seed, upsampling, method, impute_missing)
+                    self.fold_cache.put(key, fold)
+                results.append(fit_fold(*fold, seed, self.positive, self.n_trees, self.n_jobs,
+                                        return_model = return_model))
+                del fold
+            return results
+
+        if self.messages == True:
+            print("%s folds on %s processes" %(n_folds,self.n_processes))
+        # cached folds are passed through shared memory, the others are preprocessed by the workers from the
+        # shared X (and sent back to the cache)
+        shms = []
+        def share(a):
+            a = np.asarray(a)
+            shm = shared_memory.SharedMemory(create = True, size = max(a.nbytes, 1))
+            shms.append(shm)
+            np.ndarray(a.shape, dtype = a.dtype, buffer = shm.buf)[...] = a
+            return shm
+
+        try:
+            tasks = []
+            for key, train_index, test_index in zip(keys, train_indices, test_indices):
+                fold = self.fold_cache.get(key)
+                if fold is None:
+                    tasks.append(("preprocess", train_index, test_index))
+                else:
+                    tasks.append(("cached", [a if a.dtype.hasobject else (share(a).name, a.shape, a.dtype)
+                                             for a in map(np.asarray, fold)]))
+            X_shm = share(X).name if any(t[0] == "preprocess" for t in tasks) else None
+
+            # the folds are the parallel unit: one job per forest to avoid oversubscription
+            run = functools.partial(_cv_fold_shared, upsampling = upsampling, method = method,
+                                    impute_missing = impute_missing, keep_bytes = self.fold_cache.max_bytes,
+                                    positive = self.positive, n_trees = self.n_trees, n_jobs = 1,
+                                    return_model = return_model)
+            results = []
+            with ProcessPoolExecutor(self.n_processes, initializer = _cv_init_worker,
+                                     initargs = (X_shm, X.shape, X.dtype, y)) as executor:
+                for key, (result, preprocessed) in zip(keys, executor.map(run, tasks, seeds)):
+                    if preprocessed is not None:
+                        self.fold_cache.put(key, preprocessed)
+                    results.append(result)
+            return results
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+    def fold_seeds(self):
+        """ Random states of the CV folds: derived from ran_stat, one per fold """
+        return np.random.RandomState(self.ran_stat).randint(np.iinfo(np.int32).max, size = self.folds)
+
     def CV(self,upsampling = True,method = "RANDOM", impute_missing = True):
-        """ Train and test on own data """
-        rf = RandomForestClassifier(random_state = self.ran_stat, n_estimators = self.n_trees, n_jobs=self.n_jobs) 
-        skf = StratifiedKFold(n_splits = self.folds, random_state = self.ran_stat)
-
-        y_probability = []
-        y_predicted = []
-        y_true = []
-        feature_importance = [] 
-        for c,(train_index, test_index) in enumerate(skf.split(self.X, self.y)):
-
-            if self.messages == True:
-                print("Fold %s/%s" %(c,self.folds))
-            # Choose training / testing subsets      
-            X_train, X_test = self.X[train_index], self.X[test_index]
-            y_train, y_test = self.y[train_index], self.y[test_index]
-            
-            # impute missing values for test and training set individually
-            if impute_missing == True:
-                imp = Imputer(missing_values='NaN', strategy='mean', axis=0)
-                X_train = imp.fit_transform(X_train)
-                X_test = imp.fit_transform(X_test)
-            elif ~(np.isfinite(self.X)).all():
-                raise "All values need to be finite. NaN not allowed."
-            
-            # Do the upsampling ONLY!! for the training data
-            if upsampling == True:
-                if method == "SMOTE":                                     
-                    sm = SMOTE(random_state = self.ran_stat)
-                    X_train,y_train = sm.fit_sample(X_train,y_train)
-                elif method == "RANDOM":
-                    ros = RandomOverSampler(random_state = self.ran_stat)
-                    X_train,y_train = ros.fit_sample(X_train,y_train)
-            else:
-                "no upsampling was done, please ensure equal number of samples for each class"
-            
-            # fit to data
-            rf.fit(X_train,y_train)
-            
-            # apply to test data
-            index_positive = np.where(rf.classes_ == self.positive)
-            y_probability.append(((rf.predict_proba(X_test))[:,index_positive]).ravel())
-            y_predicted.append(rf.predict(X_test))
-            y_true.append(y_test.ravel())
-           
-            # add feature importance
-            feature_importance.append(rf.feature_importances_ )
-        
+        """ Train and test on own data
+
+        With n_processes > 1 the folds run in a process pool. X (and the cached folds) are shared with
+        the workers through shared memory and each fold uses the same seed (fold_seeds) as in the serial
+        case, so the results are identical.
+
+        The imputation (with the means of the training set) and the over-sampling of each fold are kept
+        in fold_cache: repeated runs over the same data, features, folds and seeds skip them.
+        """
+        # the folds are not shuffled (random_state only applies to shuffled folds, the seeds are fold_seeds)
+        skf = model_selection.StratifiedKFold(n_splits = self.folds)
+        X, y = np.asarray(self.X), np.asarray(self.y)
+        train_test = list(skf.split(X, y))
+        train_indices, test_indices = zip(*train_test)
+        results = self._run_folds(X, y, train_indices, test_indices, self.fold_seeds(), upsampling = upsampling,
+                                  method = method, impute_missing = impute_missing)
+
+        y_probability, y_predicted, y_true, feature_importance = [list(i) for i in zip(*results)]
+
         # save the resulting list with length = cv folds
         self.y_probability = y_probability
         self.y_predicted = y_predicted
         self.y_true = y_true
         self.feature_importance = feature_importance
         
-        # make further metrics per fold
-        self.conf_matrix = [confusion_matrix(t, p, labels =[True,False]) for t,p in zip(self.y_true,self.y_predicted)]
-        
-        # performance measures
-        kappa = [cohen_kappa_score(p,t, labels =[True,False]) for p,t in zip(self.y_predicted, self.y_true)]
-        conf_measures = [self.measures(m) for m in self.conf_matrix]
-        for m,k in zip(conf_measures,kappa):
-            m["kappa"]=k
-        self.performance_measures = conf_measures
-        
-        # ROC curve
-        temp_roc_curve = [roc_curve(t,p,pos_label = True) for t,p in zip(self.y_true, self.y_probability)]
-        self.roc_curve = [dict(zip(["fpr","tpr","thresholds"],i)) for i in temp_roc_curve]
-        self.roc_auc = [roc_auc_score(t,p) for t,p in zip(self.y_true, self.y_probability)]
-        
-        # precision, recall curve
-        temp_pr_curve = [precision_recall_curve(t,p,pos_label = True) for t,p in zip(self.y_true, self.y_probability)]
-        self.pr_curve = [dict(zip(["precision","recall","thresholds"],i)) for i in temp_pr_curve]
+        # make further metrics per fold, all folds at once:
+        # conf_matrix (fold * 2 * 2), performance_measures (structured array: fold * measure), curves (list: fold)
+        self.conf_matrix, self.performance_measures, self.roc_curve, self.pr_curve = \
+            scoring_metrics.fold_metrics(self.y_true, self.y_probability, positive = self.positive)
+        self.roc_auc = self.performance_measures["AUC"]
         
     def plot_feature_importance(self,path=None,threshold = 0.5, number = 20, method = "count", get_data = False, scale_importance = 1):
         
@@ -440,11 +824,13 @@ class ROIseries_feature_sommelier(object):
         
         # 1. interpolate values according to: 
             # http://nlp.stanford.edu/IR-book/html/htmledition/evaluation-of-ranked-retrieval-results-1.html
-            # implementation: http://stackoverflow.com/questions/39836953/how-to-draw-a-precision-recall-curve-with-interpolation-in-python
-        precision2, recall2 = zip(*[self.interpolate_pr(p,r) for p,r in zip(precision,recall)])
+            # all folds at once, see curve_aggregation.precision_envelope
+        precision_flat, offsets = curve_aggregation.pack(precision)
+        recall_flat, _ = curve_aggregation.pack(recall)
+        precision_flat, recall_flat = curve_aggregation.precision_envelope(precision_flat, recall_flat, offsets)
         
         if mean == True:
-            mean_x, mean_y, std_y = self.interpol_for_stats(recall2,precision2)
+            mean_x, mean_y, std_y = curve_aggregation.interpol_for_stats(recall_flat, precision_flat, offsets)
             if get_data == False:
                 plt.errorbar(mean_x,mean_y,yerr =std_y, label='PR: mean & standard deviation over CV')
                 plt.xlabel('recall')
@@ -458,6 +844,8 @@ class ROIseries_feature_sommelier(object):
             
             #mean_recall, mean_precision, std_precision = self.interpol(recall,precision)
         else:
+            precision2 = curve_aggregation.unpack(precision_flat, offsets)
+            recall2 = curve_aggregation.unpack(recall_flat, offsets)
             # create plots
             if get_data == False:
                 for p,r in zip(precision2,recall2):
@@ -0,0 +1,222 @@
+#
+#  ROIseries_feature_store: columnar on-disk storage of ROIseries features
+#  Copyright (C) 2017 Niklas Keck
+#
+#  This file is part of ROIseries.
+#
+#  ROIseries is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  ROIseries is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with ROIseries.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from ROIseries.feature_sommelier.time_axis import julian_to_datetime, ns_to_julian, parse_colsuffix
+
+
+class FeatureStore(object):
+    """
+    Columnar, memory-mapped store of the features written by ROIseries_3D::features_to_csv
+
+    The store is a directory holding one .npy file per feature with the shape time * id and
+    the shared axes (ids, julian dates, feature names). Features are only read from disk when
+    they are requested and the reader only touches the requested dates and ids.
+
+    Layout
+    ------
+    path/meta.json          feature names, dtype and the name of the id index
+    path/ids.npy            ids (n_ids)
+    path/times.npy          julian dates as float64 (n_times)
+    path/features/<i>.npy   values of feature i (n_times * n_ids)
+
+    Example
+    -------
+    >>> import ROIseries as rs
+    >>> csv = rs.sub_routines.file_search("C:/Users/keck/Desktop/delete_if_unknown/", ".csv")
+    >>> store = rs.feature_store.FeatureStore.from_csv("C:/Users/keck/Desktop/feature_store", csv)
+
+    # time * (id, feature) as returned by timeindex_from_colsuffix, e.g. as input to TAFtoTRF
+    >>> df = store.read(features=store.select_features("NDVI"), times=slice(10, 20))
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        self.dtype = np.dtype(meta["dtype"])
+        self.id_name = meta["id_name"]
+        self.feature_names = pd.Index(meta["features"], name="feature")
+        self.ids = pd.Index(np.load(os.path.join(path, "ids.npy"), allow_pickle=False), name=self.id_name)
+        self.times = np.load(os.path.join(path, "times.npy"))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # writing
+    @staticmethod
+    def _create(path, features, ids, times, id_name, dtype):
+        os.makedirs(os.path.join(path, "features"), exist_ok=True)
+        ids = np.asarray(ids)
+        if ids.dtype == object:
+            # string ids are stored as unicode to make them loadable without pickle
+            ids = ids.astype(str)
+        np.save(os.path.join(path, "ids.npy"), ids)
+        np.save(os.path.join(path, "times.npy"), np.asarray(times, dtype=np.float64))
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"features": list(features), "id_name": id_name, "dtype": np.dtype(dtype).str}, f)
+
+        shape = (len(times), len(ids))
+        return [np.lib.format.open_memmap(os.path.join(path, "features", "{}.npy".format(c)), mode="w+",
+                                          dtype=dtype, shape=shape)
+                for c in range(len(features))]
+
+    @classmethod
+    def write(cls, path, df, dtype=np.float64):
+        """
+        Write a DataFrame in the format ID * FEATURE_JULIANDATE (see timeindex_from_colsuffix) to path
+        """
+        return cls.from_csv(path, [df], dtype=dtype)
+
+    @classmethod
+    def from_csv(cls, path, features_csv, chunksize=10000, dtype=np.float64):
+        """
+        Convert feature CSVs in the format ID * FEATURE_JULIANDATE to a feature store at path
+
+        The CSVs are streamed in chunks of chunksize rows, so the memory needed does not depend on
+        the size of the CSVs. features_csv can also hold DataFrames of the same format.
+        """
+        def header(csv):
+            if isinstance(csv, pd.DataFrame):
+                return csv.columns, csv.index
+            ids = pd.read_csv(csv, usecols=[0]).iloc[:, 0]
+            return pd.read_csv(csv, index_col=0, nrows=0).columns, pd.Index(ids, name=ids.name)
+
+        def chunks(csv):
+            if isinstance(csv, pd.DataFrame):
+                return [csv]
+            return pd.read_csv(csv, index_col=0, chunksize=chunksize)
+
+        # 1. lay out the axes from the headers and ids only
+        col_infos = []
+        ids = None
+        for csv in features_csv:
+            file_columns, file_ids = header(csv)
+            col_infos.append(parse_colsuffix(file_columns))
+            ids = file_ids if ids is None else ids.append(file_ids)
+        id_name = ids.name
+        ids = ids.drop_duplicates()
+
+        features = pd.Index(np.unique(np.concatenate([f for f, _ in col_infos])))
+        # dates are matched exactly in ns (see parse_colsuffix), stored as julian dates
+        time_ns = np.unique(np.concatenate([t for _, t in col_infos]))
+        columns = cls._create(path, features, ids, ns_to_julian(time_ns), id_name, dtype)
+        for c in columns:
+            c[:] = np.nan
+
+        # 2. stream the values into the columns
+        for csv, (feature_names, feature_times) in zip(features_csv, col_infos):
+            feature_pos = features.get_indexer(feature_names)
+            time_pos = np.searchsorted(time_ns, feature_times)
+            for chunk in chunks(csv):
+                id_pos = ids.get_indexer(chunk.index)
+                values = chunk.values
+                for f in np.unique(feature_pos):
+                    is_f = feature_pos == f
+                    columns[f][time_pos[is_f][:, None], id_pos[None, :]] = values[:, is_f].transpose()
+
+        for c in columns:
+            c.flush()
+        del columns
+        return cls(path)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # reading
+    def select_features(self, feature_string, exclude=False):
+        """
+        Names of the features containing feature_string (or not containing it if exclude)
+        """
+        contains = self.feature_names.str.contains(feature_string, regex=False)
+        if exclude:
+            contains = ~contains
+        return list(self.feature_names[contains])
+
+    def _positions(self, index, selection):
+        # selection: None (all), a slice of positions or labels of index
+        if selection is None:
+            return slice(None)
+        elif isinstance(selection, slice):
+            return selection
+        positions = index.get_indexer(selection)
+        if (positions < 0).any():
+            raise KeyError("{} not in the feature store".format(list(np.asarray(selection)[positions < 0])))
+        return positions
+
+    def column(self, feature):
+        """
+        Memory-mapped values (time * id) of one feature
+        """
+        c = self.feature_names.get_loc(feature)
+        return np.load(os.path.join(self.path, "features", "{}.npy".format(c)), mmap_mode="r")
+
+    def _read(self, features, times, ids):
+        if features is None:
+            features = self.feature_names
+        time_pos = self._positions(pd.Index(self.times), times)
+        id_pos = self._positions(self.ids, ids)
+
+        # row pushdown: contiguous date ranges (slices) are read as such, ids are gathered from these rows only
+        values = []
+        for f in features:
+            column = self.column(f)[time_pos]
+            values.append(np.asarray(column[:, id_pos]))
+        return list(features), self.times[time_pos], self.ids[id_pos], values
+
+    def read(self, features=None, times=None, ids=None):
+        """
+        Read features to a DataFrame of time (DatetimeIndex) * (id, feature), the format of timeindex_from_colsuffix
+
+        Parameters
+        ----------
+        features : feature names to read (all if None), e.g. from select_features
+        times : slice of date positions or julian dates to read (all if None). If the result is
+                used in TAFtoTRF, include the dates of the shift window.
+        ids : ids to read (all if None)
+        """
+        features, times, ids, values = self._read(features, times, ids)
+        n_times, n_ids = len(times), len(ids)
+
+        # (feature, time, id) -> time * (id, feature)
+        values = np.stack(values, axis=2).reshape(n_times, n_ids * len(features)) if values else \
+            np.empty((n_times, 0), dtype=self.dtype)
+        columns = pd.MultiIndex.from_product([ids, features], names=[self.id_name, "feature"])
+        index = julian_to_datetime(times).rename("time")
+
+        df = pd.DataFrame(values, index=index, columns=columns)
+        df.sort_index(axis=1, inplace=True)
+        return df
+
+    def read_samples(self, features=None, times=None, ids=None):
+        """
+        Read features to a DataFrame of samples (id, julian date) * features
+
+        Samples without any value are dropped, as in ROIseries_feature_sommelier.read_features_and_groundtruth
+        """
+        features, times, ids, values = self._read(features, times, ids)
+        n_times, n_ids = len(times), len(ids)
+
+        # (feature, time, id) -> (id, time) * feature, no features: no values, all samples are dropped
+        values = np.stack(values, axis=2).transpose(1, 0, 2).reshape(n_ids * n_times, len(features)) if values \
+            else np.empty((n_ids * n_times, 0), dtype=self.dtype)
+        valid = ~np.isnan(values).all(axis=1)
+        index = pd.MultiIndex.from_arrays([np.repeat(np.asarray(ids), n_times)[valid],
+                                           np.tile(times, n_ids)[valid]], names=["id", "time"])
+        return pd.DataFrame(values[valid], index=index, columns=pd.Index(features, name="dimensional_history"))
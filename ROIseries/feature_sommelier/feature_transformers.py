@@ -22,14 +22,19 @@
 import pandas as pd
 import numpy as np
 from sklearn.base import BaseEstimator, TransformerMixin
-import calendar
+from concurrent.futures import ThreadPoolExecutor
 import ROIseries as rs
+from ROIseries.feature_sommelier import time_axis
+from ROIseries.temporal_blender.temporal_blender import interpolate_to
 
 
-def timeindex_from_colsuffix(df):
+def timeindex_from_colsuffix(df, previous=None):
     """
     Transform DataFrame from ID * feature_time format to time * (feature,id)
 
+    The parsed column names are cached (see time_axis.parse_colsuffix), the values are scattered
+    into the time * id * feature cube with one assignment and reshaped to time * (id, feature).
+
     Parameters
     ----------
     df : a DataFrame in the form ID * feature_time e.g.
@@ -39,29 +44,39 @@ def timeindex_from_colsuffix(df):
     3              1687.019608            1088.754902
     2              2388.691489            1005.478723
     4              1756.762162            698.162162
+    previous : the result of an earlier call on a subset of the dates of df (optional). Only the
+               columns of dates not in previous are transformed and appended to it.
     """
-    df = df.copy()
+    features, times = time_axis.parse_colsuffix(df.columns)
 
-    cols = np.array([i.rsplit("_", 1) for i in df.columns])
-    # since julian date origin is at noon, subtract 12 hours = half a day
-    feature_time = list(zip(cols[:, 0],
-                            pd.to_datetime(np.float32(cols[:, 1])-0.5,
-                                           unit='D',
-                                           origin='julian')))
+    if previous is not None:
+        # only the values of the new dates are read
+        new = np.where(~np.isin(times, previous.index.asi8))[0]
+        features, times, values = features[new], times[new], df.iloc[:, new].values
+    else:
+        values = df.values
 
-    df.columns = pd.MultiIndex.from_tuples(
-            feature_time, names=["feature", "time"])
+    id_name = 'original_id' if df.index.name is None else df.index.name
+    ids, id_order = df.index.sort_values(return_indexer=True)
+    feature_names, feature_pos = np.unique(features, return_inverse=True)
+    time_ns, time_pos = np.unique(times, return_inverse=True)
+    n_ids, n_features, n_times = len(ids), len(feature_names), len(time_ns)
 
-    if df.index.name is None:
-        df.index.name = 'original_id'
+    if len(np.unique(feature_pos * n_times + time_pos)) != len(features):
+        raise ValueError("The time is not unique for each feature and id")
 
-    rs.sub_routines.sort_index_columns_inplace(df)
-    df = df.stack("feature").transpose()
+    # without missing (feature, time) combinations every cell is set => the dtype can be kept
+    dtype = values.dtype if len(features) == n_features * n_times else np.result_type(values.dtype, np.float64)
+    cube = np.full((n_times, n_ids, n_features), np.nan, dtype=dtype)
+    cube[time_pos[None, :], np.arange(n_ids)[:, None], feature_pos[None, :]] = values[id_order]
 
-    if df.index.is_unique:
-        return df
-    else:
-        raise ValueError("The time is not unique for each feature and id")
+    result = pd.DataFrame(cube.reshape(n_times, n_ids * n_features),
+                          index=pd.DatetimeIndex(time_ns.view('datetime64[ns]'), name="time"),
+                          columns=pd.MultiIndex.from_product([ids, feature_names], names=[id_name, "feature"]))
+
+    if previous is not None:
+        result = pd.concat([previous, result]).sort_index()
+    return result
 
 
 def reltime_from_absdate(DatetimeIndex):
@@ -81,29 +96,13 @@ def reltime_from_absdate(DatetimeIndex):
     The transformed 1D numeric array e.g.
         array([0, 1, 2, 3])
     """
+    delta_mode, reltime = time_axis.regular_frequency(DatetimeIndex)
 
-    if not DatetimeIndex.is_unique:
-        raise ValueError("DatetimeIndex must be unique")
-
-    t_delta = (DatetimeIndex[1:] - DatetimeIndex[0:-1])
-    delta_mode = t_delta.to_series().mode()[0]
-
-    if delta_mode == min(t_delta):
-        print("detected time base: {}".format(delta_mode))
-    else:
-        raise ValueError("Mode and Min of differences of adjacent time events "
-                         "must be equal")
-
-    if any([i%delta_mode for i in t_delta]):
-        raise ValueError("The difference of adjacent time events must be "
-                         "a multiple of the delta_mode "
-                         "(considering sign_digits)")
-    else:
-        reltime = (DatetimeIndex - min(DatetimeIndex)) / delta_mode
-        # Found no option for direct delta_mode (pd.Timedelta) -> frequency conversion: detour via dummy time series:
-        freq = pd.infer_freq([DatetimeIndex[0], DatetimeIndex[0] + delta_mode, DatetimeIndex[0] + delta_mode * 2])
-        reltime.name = 'reltime'
-        return reltime, freq
+    # Found no option for direct delta_mode (pd.Timedelta) -> frequency conversion: detour via dummy time series
+    # (anchored frequencies as infer_freq, e.g. W-SUN for weekly dates)
+    freq = pd.infer_freq([DatetimeIndex[0], DatetimeIndex[0] + delta_mode, DatetimeIndex[0] + delta_mode * 2])
+    print("detected time base: {}".format(delta_mode))
+    return pd.Index(reltime.astype(np.float64), name='reltime'), freq
 
 
 class TAFtoTRF(BaseEstimator, TransformerMixin):
@@ -129,10 +128,15 @@ class TAFtoTRF(BaseEstimator, TransformerMixin):
     >>> t1=TAFtoTRF(shift_dict)
     >>> p1 = make_pipeline(t1)
     >>> dfx = p1.fit_transform(df)
+
+    # or read only the needed features and dates (including the shift window) from a feature store
+    >>> store = rs.feature_store.FeatureStore.from_csv("C:/Users/keck/Desktop/feature_store", csv)
+    >>> df = store.read(features=store.select_features("NDVI"), times=slice(10, 20)).stack(store.id_name)
     """
-    def __init__(self, shift_dict, id_colname):
+    def __init__(self, shift_dict, id_colname, dtype=np.float64):
         self.shift_dict = shift_dict
         self.id_colname = id_colname
+        self.dtype = dtype
 
     def fit(self, x, y=None):
         return self
@@ -159,39 +163,70 @@ class TAFtoTRF(BaseEstimator, TransformerMixin):
                 TRFs with a shift of -1 (1 step back in time from t0) are renamed to
                 featureName_m1.
                 {'m1': 0, 'm2': -1, 'm3': -2, 'p1': 1, 'p2': 2, 'p3': 3}
-            """
-        df = x.copy()
-
-        rs.sub_routines.sort_index_columns_inplace(df)
-        df = df.unstack(self.id_colname)
-
-        trf_label = 'trf_label'
 
-        shift_dict = {k: v * -1 for k, v in self.shift_dict.items()}
-        shifted_dfs = []
-        for k, v in shift_dict.items():
+            dtype (constructor): dtype of the result, e.g. np.float32 to halve the memory
+            """
+        # 1. positions of the rows of x in a (time, id, feature) cube
+        time_index = x.index.droplevel(self.id_colname)
+        times = time_index.unique().sort_values()
+        time_pos = times.get_indexer(time_index)
+        ids = x.index.get_level_values(self.id_colname)
+        id_pos, id_uniq = pd.factorize(ids)
+
+        feature_order = np.argsort(np.asarray(x.columns), kind="mergesort")
+        features = x.columns[feature_order]
+        labels = sorted(self.shift_dict)
+        shifts = np.array([self.shift_dict[k] for k in labels])
+
+        # 2. the cube, padded with nan along time to cover the largest shifts
+        pad_before, pad_after = max(0, -shifts.min()), max(0, shifts.max())
+        cube = np.full((pad_before + len(times) + pad_after, len(id_uniq), len(features)), np.nan, dtype=self.dtype)
+        cube[time_pos + pad_before, id_pos, :] = x.values[:, feature_order]
+
+        # 3. all shifts at once: a strided (time, id, feature, window) view of the cube, gathered into one block
+        # window position of shift v: v + pad_before
+        windows = np.lib.stride_tricks.sliding_window_view(cube, pad_before + 1 + pad_after, axis=0)
+        values = windows[time_pos[:, None, None], id_pos[:, None, None],
+                         np.arange(len(features))[None, :, None], (shifts + pad_before)[None, None, :]]
+
+        columns = pd.MultiIndex.from_product([features, labels], names=[x.columns.name, 'trf_label'])
+        return pd.DataFrame(values.reshape(len(x), -1), index=x.index, columns=columns)
+
+
+class InterpolateTo(BaseEstimator, TransformerMixin):
+    """
+    Resample time series onto a target time axis by linear interpolation (see temporal_blender.interpolate_to)
 
-            # v == 0 makes shift return the same dataframe and not the desired copy
-            if v == 0:
-                df_shifted = df.copy()
-            else:
-                df_shifted = df.shift(v)
+    E.g. to bring series of different sensors or orbits onto a common grid before TAFtoTRF. Target times
+    outside of the time range of x are NaN.
 
-            df_shifted[trf_label] = k
-            df_shifted.set_index(trf_label, append=True, inplace=True)
-            shifted_dfs.append(df_shifted)
+    Example
+    -------
+    >>> grid = pd.date_range("2015-11-23", "2016-01-10", freq="12D", name="time")
+    >>> p1 = make_pipeline(InterpolateTo(grid, "ID"), TAFtoTRF(shift_dict, "ID"))
+    """
+    def __init__(self, target_time, id_colname=None):
+        self.target_time = target_time
+        self.id_colname = id_colname
 
-        shifted_dfs = pd.concat(shifted_dfs)
+    def fit(self, x, y=None):
+        return self
 
-        rs.sub_routines.sort_index_columns_inplace(shifted_dfs)
-        shifted_dfs = shifted_dfs.stack(self.id_colname)
-        df = shifted_dfs.unstack(trf_label)
+    def transform(self, x, y=None):
+        """
+            Parameters
+            ----------
+            x : DataFrame time (index) * series (columns), e.g. the result of timeindex_from_colsuffix, or
+                if id_colname is set (time, id) (index) * features (columns) as the input of TAFtoTRF
+            """
+        wide = x.unstack(self.id_colname) if self.id_colname is not None else x
+        target = pd.Index(self.target_time, name=wide.index.name)
+        values = interpolate_to(wide.index, target, wide.values)
+        result = pd.DataFrame(values, index=target, columns=wide.columns)
+        if self.id_colname is not None:
+            result = result.stack(self.id_colname, dropna=False)
+        return result
 
-        # indexing a smaller DataFrame (x) with a larger DataFrame's index (df.index) (both have unique indices),
-        # results in the smaller DataFrame being ?broadcasted? to the size of the larger. Where df.index is not in
-        # x.index nan rows added created. These should_not_exist! Therefore return only valid subset
-        # should_not_exist = (x.loc[df.index, :]).loc[df.drop(x.index).index, :]
-        return df.loc[x.index, :]
 
 def doy_circular(DatetimeIndex):
     """
@@ -224,9 +259,6 @@ def doy_circular(DatetimeIndex):
     >>> np.unique(np.round(distance,5))
     >>> # there the distances in a leap year are a little bit smaller due to more days / year
     """
-    doy = np.array(DatetimeIndex.dayofyear,dtype=np.float32)
-    leap_bol = np.array([calendar.isleap(y) for y in DatetimeIndex.year])
-
     # Aim: Transform DOY (1, 365) to a circular coordinate system
     # => 2 pi = 1 circle
     # => Number of days/year: 366 (leap year), 365 (normal year)
@@ -237,10 +269,114 @@ def doy_circular(DatetimeIndex):
     # => Use this set of values between 0 and (just below) 2 pi to calculate sine and cosine.
     #    Distances within this Coordinate System (cp. https://en.wikipedia.org/wiki/Unit_circle) should be a valid
     #    metric for the temporal distances between days seamlessly across years (no 365 to 1 jump as in ordinary DOY)
-    doy[leap_bol] = 2 * np.pi * ((doy[leap_bol]-1) / 366)
-    doy[~leap_bol] = 2 * np.pi * ((doy[~leap_bol]-1) / 365)
+    # The encodings are calculated once per unique timestamp (see calendar_encodings)
+    codes, unique = pd.factorize(pd.DatetimeIndex(DatetimeIndex).asi8)
+    encoded = calendar_encodings(unique, ["doy"])
+    return dict(zip(["doy_sin", "doy_cos"], [encoded[codes, 0], encoded[codes, 1]]))
+
+
+# valid encodings of calendar_encodings
+calendar_periods = ["doy", "month", "week"]
+
+
+def calendar_encodings(ns, encodings=("doy",), dtype=np.float32, out=None):
+    """
+    Cyclical encodings (sine, cosine) of times, with datetime64 arithmetic only
+
+    doy : day of the year, (doy - 1) / (365 or 366 days of the year)
+    month : (month - 1) / 12
+    week : (ISO week - 1) / (52 or 53 ISO weeks of the ISO year)
+
+    Parameters
+    ----------
+    ns : int64 array of times (ns since 1970-01-01), NaT gives NaN
+    encodings : list of calendar_periods
+    out : preallocated array (time * 2 encodings) to write to
 
-    return dict(zip(["doy_sin", "doy_cos"], [np.sin(doy), np.cos(doy)]))
+    Returns
+    -------
+    array (time * [encoding_1_sin, encoding_1_cos, encoding_2_sin, ...])
+    """
+    ns = np.asarray(ns, dtype=np.int64)
+    if out is None:
+        out = np.empty((len(ns), 2 * len(encodings)), dtype=dtype)
+    nat = ns == pd.NaT.value
+    days = np.where(nat, 0, ns).view("datetime64[ns]").astype("datetime64[D]")
+    years = days.astype("datetime64[Y]")
+    year = years.astype(np.int64) + 1970
+
+    def is_leap(y):
+        return (y % 4 == 0) & ((y % 100 != 0) | (y % 400 == 0))
+
+    for i, encoding in enumerate(encodings):
+        if encoding == "doy":
+            position = (days - years).astype(np.int64)
+            n = 365 + is_leap(year)
+        elif encoding == "month":
+            position = days.astype("datetime64[M]").astype(np.int64) % 12
+            n = 12
+        elif encoding == "week":
+            # ISO week: weeks start on monday (1970-01-01 was a thursday), week 1 holds the first thursday
+            weekday = (days.astype(np.int64) + 3) % 7
+            thursday = days + (3 - weekday).astype("timedelta64[D]")
+            iso_years = thursday.astype("datetime64[Y]")
+            position = (thursday - iso_years).astype(np.int64) // 7
+            # an ISO year has 53 weeks if it starts on a thursday or is a leap year starting on a wednesday
+            iso_year = iso_years.astype(np.int64) + 1970
+            first_weekday = (iso_years.astype("datetime64[D]").astype(np.int64) + 3) % 7
+            n = 52 + ((first_weekday == 3) | ((first_weekday == 2) & is_leap(iso_year)))
+        else:
+            raise ValueError("{} is not a valid encoding: {}".format(encoding, calendar_periods))
+
+        angle = (2 * np.pi * (position / n)).astype(out.dtype)
+        angle[nat] = np.nan
+        np.sin(angle, out=out[:, 2 * i])
+        np.cos(angle, out=out[:, 2 * i + 1])
+    return out
+
+
+class CalendarFeatures(BaseEstimator, TransformerMixin):
+    """
+    Append cyclical calendar encodings of the time of each sample (see calendar_encodings) as features
+
+    The times are repeated for every ROI: they are factorized, the encodings are calculated once per unique
+    timestamp into one preallocated array and broadcast back to the samples by their codes.
+
+    Example
+    -------
+    >>> p1 = make_pipeline(TAFtoTRF(shift_dict, "ID"), CalendarFeatures("time", ["doy", "month"]))
+    """
+    def __init__(self, time_level="time", encodings=("doy",), dtype=np.float32):
+        self.time_level = time_level
+        self.encodings = encodings
+        self.dtype = dtype
+
+    def fit(self, x, y=None):
+        return self
+
+    def transform(self, x, y=None):
+        """
+            Parameters
+            ----------
+            x : DataFrame with the times in the index (level time_level of a MultiIndex, or the index itself if
+                time_level is None)
+
+            Returns
+            -------
+            x with the columns <encoding>_sin, <encoding>_cos appended
+            """
+        times = x.index if self.time_level is None else x.index.get_level_values(self.time_level)
+        codes, unique = pd.factorize(pd.DatetimeIndex(times).asi8)
+        encoded = calendar_encodings(unique, self.encodings, dtype=self.dtype)
+        names = ["{}_{}".format(e, f) for e in self.encodings for f in ["sin", "cos"]]
+
+        result = x.copy()
+        values = encoded[codes]
+        for i, name in enumerate(names):
+            if isinstance(x.columns, pd.MultiIndex):
+                name = (name,) + ("",) * (x.columns.nlevels - 1)
+            result[name] = values[:, i]
+        return result
 
 
 class DropCorrelated(BaseEstimator, TransformerMixin):
@@ -254,21 +390,113 @@ class DropCorrelated(BaseEstimator, TransformerMixin):
 
     def transform(self, x, y=None):
 
+        # work on a copy: x_corr must not change
+        x_corr = np.array(self.x_corr, dtype=np.float64)
         if self.absolute_correlation:
-            self.x_corr = (self.x_corr).abs()
-        n_vars = self.x_corr.shape[1]
+            x_corr = np.abs(x_corr)
+        n_vars = x_corr.shape[1]
 
         # set the upper right half and diagonal of the correlation matrix to 0
-        (self.x_corr).iloc[rs.sub_routines.idx_corners(n_vars, 'up_right')] = 0
+        x_corr[rs.sub_routines.idx_corners(n_vars, 'up_right')] = 0
 
         # get indices for sub-setting: rows must stay the same number!
         var_idx = np.broadcast_to(np.arange(n_vars), (n_vars, n_vars)).transpose()
 
         # get index of correlated variables
-        remove_arr = np.array(var_idx[(self.x_corr).get_values() > self.correlation_threshold])
+        remove_arr = np.array(var_idx[x_corr > self.correlation_threshold])
         remove_set = set(remove_arr[~np.isnan(remove_arr)])
         keep = set(range(n_vars)) - remove_set
         print("{} % where dropped with correlation_threshold of {}".format(round((len(remove_set)/n_vars)*100),
                                                                            self.correlation_threshold))
 
         return x.iloc[:, list(keep)].copy()
+
+
+class DropCorrelatedBlockwise(BaseEstimator, TransformerMixin):
+    """
+    Drop features correlated to an earlier feature (same rule as DropCorrelated)
+
+    In contrast to DropCorrelated, the correlations are calculated during fit, in tiles of
+    block_size * block_size features. Each block of features is extracted and centred once (a copy of x in
+    dtype), the full correlation matrix is never held in memory, only one tile per thread. Missing values are
+    excluded pairwise (as in DataFrame.corr).
+
+    Parameters
+    ----------
+    correlation_threshold : a feature is dropped if its correlation to any earlier feature is above the threshold
+    absolute_correlation : use the absolute value of the correlation
+    block_size : number of features per tile
+    n_jobs : number of threads working on the tiles (None: number of processors)
+    dtype : dtype of the tile computations
+
+    Attributes
+    ----------
+    keep_ : positions of the kept features
+    """
+    def __init__(self, correlation_threshold, absolute_correlation=False, block_size=1024, n_jobs=None,
+                 dtype=np.float32):
+        self.correlation_threshold = correlation_threshold
+        self.absolute_correlation = absolute_correlation
+        self.block_size = block_size
+        self.n_jobs = n_jobs
+        self.dtype = dtype
+
+    def _block(self, x, mean, start):
+        # centered values (for numerical stability), their mask of valid values and the values with nan set to 0
+        block = np.asarray(x[:, start:start + self.block_size], dtype=self.dtype) - mean[start:start + self.block_size]
+        valid = ~np.isnan(block)
+        return valid, np.where(valid, block, 0)
+
+    @staticmethod
+    def _corr(valid_i, block_i, valid_j, block_j):
+        # pairwise complete correlation of the columns of two blocks
+        if valid_i.all() and valid_j.all():
+            n = block_i.shape[0]
+            sum_i, sum_j = block_i.sum(axis=0)[:, None], block_j.sum(axis=0)[None, :]
+            sum_ii, sum_jj = (block_i ** 2).sum(axis=0)[:, None], (block_j ** 2).sum(axis=0)[None, :]
+        else:
+            valid_i, valid_j = valid_i.astype(block_i.dtype), valid_j.astype(block_j.dtype)
+            n = valid_i.T @ valid_j
+            sum_i, sum_j = block_i.T @ valid_j, valid_i.T @ block_j
+            sum_ii, sum_jj = (block_i ** 2).T @ valid_j, valid_i.T @ (block_j ** 2)
+        sum_ij = block_i.T @ block_j
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (n * sum_ij - sum_i * sum_j) / np.sqrt((n * sum_ii - sum_i ** 2) * (n * sum_jj - sum_j ** 2))
+
+    def fit(self, x, y=None):
+        x = x.values if isinstance(x, pd.DataFrame) else np.asarray(x)
+        n_vars = x.shape[1]
+        mean = np.nanmean(x, axis=0).astype(self.dtype)
+        starts = range(0, n_vars, self.block_size)
+        drop = np.zeros(n_vars, dtype=bool)
+
+        def drop_block_row(i):
+            # compare the features of block i to all earlier features (tiles j <= i)
+            valid_i, block_i = blocks[i]
+            drop_i = np.zeros(block_i.shape[1], dtype=bool)
+            for j in range(i + 1):
+                corr = self._corr(valid_i, block_i, *blocks[j])
+                if self.absolute_correlation:
+                    corr = np.abs(corr)
+                correlated = corr > self.correlation_threshold
+                if j == i:
+                    # within the diagonal tile only earlier features count
+                    correlated = np.tril(correlated, k=-1)
+                drop_i |= correlated.any(axis=1)
+            drop[starts[i]:starts[i] + self.block_size] = drop_i
+
+        with ThreadPoolExecutor(self.n_jobs) as executor:
+            # each block is extracted and centred once, then shared by all its tiles
+            blocks = list(executor.map(lambda start: self._block(x, mean, start), starts))
+            list(executor.map(drop_block_row, range(len(starts))))
+
+        self.keep_ = np.where(~drop)[0]
+        print("{} % where dropped with correlation_threshold of {}".format(round((drop.sum()/n_vars)*100),
+                                                                           self.correlation_threshold))
+        return self
+
+    def transform(self, x, y=None):
+        if isinstance(x, pd.DataFrame):
+            return x.iloc[:, self.keep_].copy()
+        return np.asarray(x)[:, self.keep_]
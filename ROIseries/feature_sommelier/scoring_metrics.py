@@ -1,15 +1,221 @@
 import numpy as np
+import pandas as pd
 
 
 def errors_per_stratum_count(y_true, y_pred, strata_level_name, summary_stat=np.mean, normalize_denominator=None):
-    strata = y_true.index.get_level_values(strata_level_name)
-    errors = (y_true != y_pred)
-    strata_uniq, strata_integer = np.unique(strata, return_inverse=True)
-    n_errors = np.bincount(strata_integer, weights=errors)
+    return StratumScorer(y_true, strata_level_name, summary_stat, normalize_denominator).score(y_pred)
 
-    if normalize_denominator is not None:
-        count_per_stratum = np.bincount(strata_integer, weights=np.ones(len(strata_integer)))
-        count_factor = count_per_stratum / normalize_denominator
-        n_errors = n_errors / count_factor
 
-    return summary_stat(n_errors)
+class StratumScorer(object):
+    """
+    Precompiled errors_per_stratum_count for many predictions of the same y_true
+
+    The strata are factorized once, the integer codes and the counts per stratum are cached. The errors of
+    many candidate models (one column of y_pred each) are counted in one bincount.
+
+    The scorer can be passed to GridSearchCV (scoring=StratumScorer(y, "strata")), y has to be a
+    Series with the strata in its index. As in make_scorer(..., greater_is_better=False) the negated
+    score is returned then. The codes of the subsets of y are taken from the codes of a MultiIndex or a
+    CategoricalIndex without touching the strata labels again.
+
+    Example
+    -------
+    >>> scorer = StratumScorer(y_true, "strata")
+    >>> scorer.errors(np.column_stack([y_pred_model_1, y_pred_model_2]))  # candidate * stratum
+    >>> scorer.score(np.column_stack([y_pred_model_1, y_pred_model_2]))  # candidate
+    """
+    def __init__(self, y_true, strata_level_name, summary_stat=np.mean, normalize_denominator=None):
+        self.strata_level_name = strata_level_name
+        self.summary_stat = summary_stat
+        self.normalize_denominator = normalize_denominator
+
+        self.y_true_ = np.asarray(y_true)
+        self.index_ = y_true.index
+        self.codes_, self.strata_ = pd.factorize(self.index_.get_level_values(strata_level_name), sort=True)
+        self.counts_ = np.bincount(self.codes_, minlength=len(self.strata_))
+
+    def _codes(self, index):
+        # integer stratum codes of the samples of index (usually a subset of the index of y_true)
+        if index is self.index_:
+            return self.codes_
+
+        if isinstance(index, pd.MultiIndex):
+            level = index.names.index(self.strata_level_name)
+            level_codes = self.strata_.get_indexer(index.levels[level])[index.codes[level]]
+        elif isinstance(index, pd.CategoricalIndex):
+            level_codes = self.strata_.get_indexer(index.categories)[index.codes]
+        else:
+            level_codes = self.strata_.get_indexer(index.get_level_values(self.strata_level_name))
+
+        if (level_codes < 0).any():
+            raise ValueError("y holds strata which were not in y_true of the StratumScorer")
+        return level_codes
+
+    def errors(self, y_pred, y_true=None, codes=None):
+        """
+        Number of errors per stratum (normalized if normalize_denominator is set)
+
+        Parameters
+        ----------
+        y_pred : 1D array (sample) or 2D array (sample * candidate) of predictions
+        y_true, codes : true classes and stratum codes of the samples, default: the ones of the y_true
+                        the scorer was built with
+
+        Returns
+        -------
+        1D array (stratum) or 2D array (candidate * stratum), only the strata with samples (e.g. a test fold
+        of GridSearchCV can miss some strata of y_true)
+        """
+        if y_true is None:
+            y_true, codes, counts = self.y_true_, self.codes_, self.counts_
+        else:
+            counts = np.bincount(codes, minlength=len(self.strata_))
+
+        y_pred = np.asarray(y_pred)
+        one_candidate = y_pred.ndim == 1
+        y_pred = y_pred.reshape(len(y_true), -1)
+        n_strata, n_candidates = len(self.strata_), y_pred.shape[1]
+
+        # one bincount for all candidates: candidate c counts into the bins c * n_strata + stratum
+        bins = codes[:, None] + n_strata * np.arange(n_candidates)[None, :]
+        n_errors = np.bincount(bins.ravel(), weights=(y_pred != y_true[:, None]).ravel(),
+                               minlength=n_strata * n_candidates).reshape(n_candidates, n_strata)
+        present = counts > 0
+        n_errors, counts = n_errors[:, present], counts[present]
+
+        if self.normalize_denominator is not None:
+            n_errors = n_errors / (counts / self.normalize_denominator)
+
+        return n_errors[0] if one_candidate else n_errors
+
+    def _summarize(self, n_errors):
+        if n_errors.ndim == 1:
+            return self.summary_stat(n_errors)
+        return np.array([self.summary_stat(i) for i in n_errors])
+
+    def score(self, y_pred):
+        """
+        summary_stat of the errors per stratum (for each candidate if y_pred is 2D)
+        """
+        return self._summarize(self.errors(y_pred))
+
+    def __call__(self, estimator, X, y):
+        # scikit-learn scorer interface: greater is better
+        codes = self._codes(y.index)
+        return -self._summarize(self.errors(estimator.predict(X), np.asarray(y), codes))
+
+
+# fields of the per fold measures returned by fold_metrics
+measure_names = ["true_negative_rate", "recall", "precision", "overall_acc", "deviation", "F", "G", "kappa", "AUC"]
+
+
+def fold_metrics(y_true, y_probability, positive=True, threshold=0.5):
+    """
+    Confusion matrix, measures, ROC and precision recall curve for many folds at once
+
+    The samples of all folds are sorted once (by fold, then descending probability) and all results
+    are derived from the cumulative true / false positive counts.
+
+    Parameters
+    ----------
+    y_true : list (one entry per fold) of arrays holding the true classes
+    y_probability : list (one entry per fold) of arrays holding the probability of the positive class
+    positive : the positive class
+    threshold : samples with y_probability > threshold are predicted positive
+
+    Returns
+    -------
+    conf_matrix : array (fold * 2 * 2) [[TP, FN], [FP, TN]] (like confusion_matrix(..., labels=[True, False]))
+    measures : structured array (fold) with the fields in measure_names
+    roc_curve : list (fold) of dicts with "fpr", "tpr", "thresholds"
+    pr_curve : list (fold) of dicts with "precision", "recall", "thresholds"
+
+    Empty folds have a confusion matrix of zeros, NaN measures and empty curves.
+    """
+    n_folds = len(y_true)
+    lengths = np.array([len(t) for t in y_true], dtype=np.int64)
+    if (lengths == 0).any():
+        # empty folds get no counts, NaN measures and empty curves, the others are evaluated as usual
+        keep = np.where(lengths > 0)[0]
+        conf_matrix = np.zeros((n_folds, 2, 2))
+        measures = np.full(n_folds, np.nan, dtype=[(i, np.float64) for i in measure_names])
+        roc_curve = [{k: np.empty(0) for k in ["fpr", "tpr", "thresholds"]} for _ in range(n_folds)]
+        pr_curve = [{k: np.empty(0) for k in ["precision", "recall", "thresholds"]} for _ in range(n_folds)]
+        if len(keep):
+            results = fold_metrics([y_true[i] for i in keep], [y_probability[i] for i in keep], positive, threshold)
+            conf_matrix[keep], measures[keep] = results[0], results[1]
+            for c, i in enumerate(keep):
+                roc_curve[i], pr_curve[i] = results[2][c], results[3][c]
+        return conf_matrix, measures, roc_curve, pr_curve
+
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    fold = np.repeat(np.arange(n_folds), lengths)
+    true = np.concatenate(y_true) == positive
+    probability = np.concatenate(y_probability).astype(np.float64)
+
+    # 1. confusion matrix at threshold
+    predicted = probability > threshold
+    tp = np.bincount(fold, weights=true & predicted, minlength=n_folds)
+    fp = np.bincount(fold, weights=~true & predicted, minlength=n_folds)
+    n_p = np.bincount(fold, weights=true, minlength=n_folds)
+    n_n = lengths - n_p
+    fn, tn = n_p - tp, n_n - fp
+    conf_matrix = np.stack([np.stack([tp, fn], axis=1), np.stack([fp, tn], axis=1)], axis=1)
+
+    # 2. measures
+    measures = np.zeros(n_folds, dtype=[(i, np.float64) for i in measure_names])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        measures["true_negative_rate"] = tn / n_n
+        measures["recall"] = tp / n_p
+        measures["precision"] = tp / (tp + fp)
+        measures["overall_acc"] = (tp + tn) / lengths
+        # custom measure: fractional deviation from number of positive: This needs to be minimized!!!
+        measures["deviation"] = (tp + fp - n_p) / n_p
+        measures["F"] = (2 * measures["precision"] * measures["recall"]) / (measures["precision"] + measures["recall"])
+        measures["G"] = (measures["true_negative_rate"] * measures["recall"]) ** 0.5
+        p_observed = (tp + tn) / lengths
+        p_expected = ((tp + fp) * n_p + (fn + tn) * n_n) / lengths.astype(np.float64) ** 2
+        measures["kappa"] = (p_observed - p_expected) / (1 - p_expected)
+
+    # 3. cumulative counts at each distinct probability (descending) of each fold
+    order = np.lexsort((-probability, fold))
+    probability, true = probability[order], true[order]
+    is_last = np.concatenate([(fold[1:] != fold[:-1]) | (probability[1:] != probability[:-1]), [True]])
+    cum_tp = np.cumsum(true)
+    cum_tp = cum_tp - np.repeat(cum_tp[starts] - true[starts], lengths)
+    cum_fp = np.arange(len(true)) - np.repeat(starts, lengths) + 1 - cum_tp
+
+    idx = np.where(is_last)[0]
+    tps, fps, thresholds, fold = cum_tp[idx], cum_fp[idx], probability[idx], fold[idx]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fpr = fps / n_n[fold]
+        tpr = tps / n_p[fold]
+
+    # AUC (trapezoidal rule) from the segments between subsequent points, every fold starts at (0, 0)
+    first = np.concatenate([[True], fold[1:] != fold[:-1]])
+    fpr_previous = np.where(first, 0, np.roll(fpr, 1))
+    tpr_previous = np.where(first, 0, np.roll(tpr, 1))
+    area = (fpr - fpr_previous) * (tpr + tpr_previous) / 2
+    measures["AUC"] = np.bincount(fold, weights=area, minlength=n_folds)
+
+    # 4. curves per fold
+    roc_curve, pr_curve = [], []
+    bounds = np.searchsorted(fold, np.arange(n_folds + 1))
+    for f in range(n_folds):
+        s = slice(bounds[f], bounds[f + 1])
+        roc_curve.append({"fpr": np.concatenate([[0], fpr[s]]),
+                          "tpr": np.concatenate([[0], tpr[s]]),
+                          "thresholds": np.concatenate([thresholds[s][:1] + 1, thresholds[s]])})
+
+        # precision recall: increasing thresholds up to full recall, ending with (recall 0, precision 1)
+        tps_f, fps_f = tps[s], fps[s]
+        last = tps_f.searchsorted(tps_f[-1])
+        reverse = slice(last, None, -1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = tps_f / (tps_f + fps_f)
+            recall = tps_f / n_p[f]
+        pr_curve.append({"precision": np.concatenate([precision[reverse], [1]]),
+                         "recall": np.concatenate([recall[reverse], [0]]),
+                         "thresholds": thresholds[s][reverse]})
+
+    return conf_matrix, measures, roc_curve, pr_curve
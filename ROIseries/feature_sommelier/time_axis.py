@@ -0,0 +1,202 @@
+#
+#  ROIseries_time_axis: time axis of the features from ROIseries
+#  Copyright (C) 2017 Niklas Keck
+#
+#  This file is part of ROIseries.
+#
+#  ROIseries is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  ROIseries is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with ROIseries.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+NS_PER_DAY = 86400 * 10 ** 9
+
+# ROIseries stores the time as julian date. Since julian date origin is at noon, 12 hours = half a day are
+# subtracted when converting to datetime (as in pd.to_datetime(julian - 0.5, unit='D', origin='julian')).
+# => julian date JULIAN_EPOCH is 1970-01-01 00:00:00
+JULIAN_EPOCH = 2440588
+# the astronomical julian date of 1970-01-01 00:00:00 (as JULDAY and astropy), to match julian dates with times
+# of other sources, e.g. the acquisition times of the scenes (scene_time_to_ns)
+JULIAN_EPOCH_UTC = 2440587.5
+
+# column name -> (feature, time in ns since 1970-01-01) of the column names parsed so far, at most
+# COLSUFFIX_CACHE_SIZE (the least recently used are dropped first)
+COLSUFFIX_CACHE_SIZE = 2 ** 20
+_colsuffix_cache = OrderedDict()
+
+
+def julian_to_datetime(julian):
+    """
+    Convert julian dates (float64) to a DatetimeIndex
+
+    The conversion is done in float64 relative to JULIAN_EPOCH, which keeps sub-second precision
+    (in contrast to float32, which has a resolution of a quarter day at 2.45e6).
+    """
+    return pd.DatetimeIndex(julian_to_ns(julian).view('datetime64[ns]'))
+
+
+def julian_to_ns(julian, epoch=JULIAN_EPOCH):
+    """
+    Convert julian dates (float64) to ns since 1970-01-01 (int64)
+
+    epoch is the julian date of 1970-01-01 00:00:00: JULIAN_EPOCH (as the time axis of the features)
+    or JULIAN_EPOCH_UTC (astronomical julian date)
+    """
+    days = np.asarray(julian, dtype=np.float64) - epoch
+    return np.round(days * NS_PER_DAY).astype(np.int64)
+
+
+def ns_to_julian(ns, epoch=JULIAN_EPOCH):
+    """
+    Convert ns since 1970-01-01 (int64) to julian dates (float64), the inverse of julian_to_ns
+    """
+    return epoch + np.asarray(ns, dtype=np.int64) / NS_PER_DAY
+
+
+def scene_time_to_ns(filenames, token=3, separator="_", time_format="%Y%m%dT%H%M%S"):
+    """
+    Parse the acquisition time of scenes from their file names to ns since 1970-01-01 (int64)
+
+    Parameters
+    ----------
+    filenames : iterable of file names, e.g. ['S2A_L2A_UMV32N_20151123T120000_10m_studyarea.tif']
+    token : position of the time in the file name split by separator
+    time_format : format of the time token (Sentinel-2: YYYYMMDDTHHMMSS)
+
+    Returns
+    -------
+    int64 array, e.g. array([1448280000000000000]) (= astronomical julian date 2457350.0)
+    """
+    tokens = pd.Series(np.asarray(filenames, dtype=object)).str.split(separator, expand=True)[token]
+    return pd.to_datetime(tokens, format=time_format).values.view(np.int64)
+
+
+def match_times(times, keys, tolerance=0):
+    """
+    Sorted merge of two time axes (int64 ns): position of the nearest key of each time
+
+    The keys are sorted once and located with one searchsorted, as pd.merge_asof(direction="nearest").
+
+    Parameters
+    ----------
+    times : int64 array of the times to look up
+    keys : int64 array of the times to match with
+    tolerance : maximum distance (ns) of a match
+
+    Returns
+    -------
+    int64 array of positions in keys, -1 where no key is within tolerance
+    """
+    times = np.asarray(times, dtype=np.int64)
+    keys = np.asarray(keys, dtype=np.int64)
+    if len(keys) == 0:
+        return np.full(len(times), -1, dtype=np.int64)
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    right = np.clip(np.searchsorted(sorted_keys, times), 0, len(keys) - 1)
+    left = np.clip(right - 1, 0, len(keys) - 1)
+    # the nearer neighbour, the earlier one on ties
+    nearest = np.where(np.abs(sorted_keys[right] - times) < np.abs(times - sorted_keys[left]), right, left)
+    return np.where(np.abs(sorted_keys[nearest] - times) <= tolerance, order[nearest], -1)
+
+
+def julian_string_to_ns(julian):
+    """
+    Convert julian dates given as strings (e.g. '2457633.9394560') to ns since 1970-01-01 (int64)
+
+    The integer and fractional days are converted separately in integer arithmetic, so that
+    no precision is lost.
+    """
+    parts = pd.Series(np.asarray(julian, dtype=str)).str.split(".", n=1, expand=True)
+    days = parts[0].astype(np.int64).values - JULIAN_EPOCH
+    ns = days * NS_PER_DAY
+    if parts.shape[1] == 2:
+        # nanoseconds need at most 14 decimal places of a day
+        fraction = parts[1].fillna("").str.slice(0, 14).str.ljust(14, "0").astype(np.int64).values
+        ns += np.round(fraction * (NS_PER_DAY / 10 ** 14)).astype(np.int64)
+    return ns
+
+
+def parse_colsuffix(columns):
+    """
+    Split FEATURE_JULIANDATE column names into features and times (ns since 1970-01-01)
+
+    The result of each column name is cached (the last COLSUFFIX_CACHE_SIZE column names), so columns seen
+    by an earlier call are not parsed again.
+
+    Parameters
+    ----------
+    columns : iterable of column names e.g.
+        ['B_MEAN_RAW_2457633.9', 'B_MEAN_RAW_2457663.9']
+
+    Returns
+    -------
+    (feature names, times as int64 ns)
+    """
+    columns = list(columns)
+    parsed = {}
+    new = []
+    for c in set(columns):
+        if c in _colsuffix_cache:
+            _colsuffix_cache.move_to_end(c)
+            parsed[c] = _colsuffix_cache[c]
+        else:
+            new.append(c)
+    if new:
+        split = [c.rsplit("_", 1) for c in new]
+        ns = julian_string_to_ns([s[1] for s in split])
+        parsed.update(zip(new, zip([s[0] for s in split], ns)))
+        _colsuffix_cache.update((c, parsed[c]) for c in new)
+    while len(_colsuffix_cache) > COLSUFFIX_CACHE_SIZE:
+        _colsuffix_cache.popitem(last=False)
+
+    parsed = [parsed[c] for c in columns]
+    features = np.array([p[0] for p in parsed], dtype=object)
+    times = np.array([p[1] for p in parsed], dtype=np.int64)
+    return features, times
+
+
+def regular_frequency(DatetimeIndex):
+    """
+    Detect the base frequency of a time axis with unique time events
+
+    The base frequency is the mode of the differences between adjacent time events, which has to be
+    equal to their minimum. All differences have to be a multiple of it.
+
+    Returns
+    -------
+    The base frequency (pd.Timedelta) and the relative time ((time - min(time)) / base frequency) as int64
+    """
+    if not DatetimeIndex.is_unique:
+        raise ValueError("DatetimeIndex must be unique")
+
+    ns = DatetimeIndex.asi8
+    t_delta = np.diff(ns)
+    deltas, counts = np.unique(t_delta, return_counts=True)
+    # np.unique sorts: the first of the most frequent differences, as pd.Series.mode()[0]
+    delta_mode = deltas[np.argmax(counts)]
+
+    if delta_mode != t_delta.min():
+        raise ValueError("Mode and Min of differences of adjacent time events "
+                         "must be equal")
+
+    if np.any(t_delta % delta_mode):
+        raise ValueError("The difference of adjacent time events must be "
+                         "a multiple of the delta_mode "
+                         "(considering sign_digits)")
+
+    return pd.Timedelta(int(delta_mode)), (ns - ns.min()) // delta_mode
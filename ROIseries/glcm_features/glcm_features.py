@@ -0,0 +1,228 @@
+#
+#  ROIseries_glcm_features: grey level co-occurrence matrix features of the regions of interest
+#  Copyright (C) 2017 Niklas Keck
+#
+#  This file is part of ROIseries.
+#
+#  ROIseries is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  ROIseries is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with ROIseries.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+valid_types = ["CON", "DIS", "HOM", "ASM", "ENE", "MAX", "ENT", "MEAN", "VAR", "STD", "COR"]
+valid_dirs = ["0", "45", "90", "135"]
+
+# neighbour (row, column offset) of a pixel for each direction (as GLCM_MATRIX, rows = y, columns = x)
+_offsets = {"0": (0, 1), "45": (1, -1), "90": (1, 0), "135": (1, 1)}
+
+
+def generate_feature_names(types=None, dirs=None):
+    """
+    Names of the GLCM features (as GLCM_GENERATE_FEATURE_NAMES), e.g. GLCM_CON_0
+    """
+    types = valid_types if types is None else types
+    dirs = valid_dirs if dirs is None else dirs
+    for d in dirs:
+        if d not in valid_dirs:
+            raise ValueError("The following dir is not valid: {}".format(d))
+    for t in types:
+        if t not in valid_types:
+            raise ValueError("The following type is not valid: {}".format(t))
+    return ["GLCM_{}_{}".format(t, d) for t in types for d in dirs]
+
+
+def quantize(a, levels=64):
+    """
+    Scale an array to the grey levels 0 ... levels - 1 (as BYTSCL(a, /NAN, TOP=levels - 1)), NaN -> -1
+
+    levels=None bins the raw values with unit width from the minimum of each image (the first two axes),
+    as HIST_2D_NAN in GLCM_MATRIX.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    finite = ~np.isnan(a)
+    q = np.full(a.shape, -1, dtype=np.int64)
+    if levels is None:
+        a_min = np.where(finite, a, np.inf).min(axis=(0, 1) if a.ndim > 2 else None, keepdims=True)
+        q[finite] = np.floor((a - a_min)[finite]).astype(np.int64)
+    elif finite.any():
+        a_min, a_max = np.min(a[finite]), np.max(a[finite])
+        scale = (levels - 1 + 0.9999) / (a_max - a_min) if a_max > a_min else 0
+        q[finite] = np.minimum((a[finite] - a_min) * scale, levels - 1).astype(np.int64)
+    return q
+
+
+def _pairs(q, direction):
+    # grey levels of all pixels (in the last two axes) and their neighbours in direction
+    dr, dc = _offsets[direction]
+    h, w = q.shape[-2:]
+    c0, c1 = max(0, -dc), w - max(0, dc)
+    a = q[..., 0:h - dr, c0:c1]
+    b = q[..., dr:h, c0 + dc:c1 + dc]
+    return a, b
+
+
+def cooccurrence(quantized, levels, dirs=None):
+    """
+    Symmetric co-occurrence counts of a batch of quantized images in one bincount
+
+    Parameters
+    ----------
+    quantized : list of arrays (... * height * width) of grey levels, -1 for NaN
+    levels : number of grey levels
+    dirs : directions (valid_dirs)
+
+    Returns
+    -------
+    array (image * ... * direction * level * level)
+    """
+    dirs = valid_dirs if dirs is None else dirs
+    lead = quantized[0].shape[:-2]
+    n_lead = int(np.prod(lead))
+    n_bins = len(dirs) * levels * levels
+    keys = []
+    for i, q in enumerate(quantized):
+        q = q.reshape((n_lead,) + q.shape[-2:])
+        for d, direction in enumerate(dirs):
+            a, b = _pairs(q, direction)
+            valid = (a >= 0) & (b >= 0)
+            image = (i * n_lead + np.arange(n_lead)).reshape(-1, 1, 1) * n_bins + d * levels * levels
+            image = np.broadcast_to(image, a.shape)
+            keys.append((image + a * levels + b)[valid])
+
+    counts = np.bincount(np.concatenate(keys) if keys else np.empty(0, dtype=np.int64),
+                         minlength=len(quantized) * n_lead * n_bins)
+    counts = counts.reshape((len(quantized),) + lead + (len(dirs), levels, levels)).astype(np.float64)
+    # pairs in both orders (h2d + TRANSPOSE(h2d))
+    return counts + np.swapaxes(counts, -1, -2)
+
+
+def haralick(counts, types=None):
+    """
+    Haralick features (as GLCM_FEATURES) of a batch of co-occurrence matrices (... * level * level)
+
+    All features are derived from the normalized matrices P and their shared marginals: the distribution
+    of the grey levels p(i), of the differences of the grey levels p(|i - j|) and the sum of P * i * j.
+
+    Returns
+    -------
+    array (... * type), NaN where the matrix is empty
+    """
+    types = valid_types if types is None else types
+    levels = counts.shape[-1]
+    batch = counts.shape[:-2]
+    flat = counts.reshape(-1, levels * levels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        P = flat / flat.sum(axis=1, keepdims=True)
+
+    i, j = np.divmod(np.arange(levels * levels), levels)
+    k = np.abs(i - j)
+    grey = np.arange(levels)
+
+    p_i = P.reshape(-1, levels, levels).sum(axis=2)
+    # p(|i - j|): cells ordered by |i - j|, summed per difference
+    order = np.argsort(k, kind="stable")
+    p_k = np.add.reduceat(P[:, order], np.searchsorted(k[order], grey), axis=1)
+
+    result = np.full((len(P), len(types)), np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = p_i.dot(grey)
+        var = p_i.dot(grey ** 2) - mean ** 2
+        asm = (P ** 2).sum(axis=1)
+        for c, t in enumerate(types):
+            if t == "CON":
+                result[:, c] = p_k.dot(grey ** 2)
+            elif t == "DIS":
+                result[:, c] = p_k.dot(grey)
+            elif t == "HOM":
+                result[:, c] = p_k.dot(1.0 / (1 + grey ** 2))
+            elif t == "ASM":
+                result[:, c] = asm
+            elif t == "ENE":
+                result[:, c] = np.sqrt(asm)
+            elif t == "MAX":
+                result[:, c] = P.max(axis=1)
+            elif t == "ENT":
+                result[:, c] = -np.where(P > 0, P * np.log(np.where(P > 0, P, 1)), 0).sum(axis=1)
+            elif t == "MEAN":
+                result[:, c] = mean
+            elif t == "VAR":
+                result[:, c] = var
+            elif t == "STD":
+                result[:, c] = np.sqrt(var)
+            elif t == "COR":
+                result[:, c] = (P.dot(i * j) - mean ** 2) / var
+            else:
+                raise ValueError("The following type is not valid: {}".format(t))
+
+    # empty matrices (no valid pair of pixels)
+    result[np.isnan(P).all(axis=1)] = np.nan
+    return result.reshape(batch + (len(types),))
+
+
+def glcm_features(rois, types=None, dirs=None, levels=64, n_jobs=None, max_bins=2 ** 24):
+    """
+    GLCM features of each ROI, date and direction
+
+    Each ROI is quantized once over all dates. The co-occurrence matrices of all directions of a batch of
+    ROIs are counted in one bincount and their features computed at once. The dates are processed on a
+    thread pool.
+
+    With levels=None the grey levels are the raw values binned with unit width from the minimum of each image
+    (as HIST_2D_NAN in GLCM_MATRIX, which takes the minimum over the pixels of the pairs of one direction),
+    so the features have the scale of the IDL outputs. Scale the values beforehand (as
+    NORMALIZE_RS_NEW_MIN_MAX) to keep the number of levels small, a ValueError is raised if the matrices of one
+    image exceed max_bins. With a number of levels the grey levels are fixed per ROI (levels bins between its
+    minimum and maximum over all dates), the features then differ in scale from the IDL outputs.
+
+    Parameters
+    ----------
+    rois : dict id -> array (height * width * time), e.g. the result of cookie_cutter
+    types : Haralick features (valid_types)
+    dirs : directions (valid_dirs)
+    levels : number of grey levels, None: unit wide bins of the raw values (as GLCM_MATRIX)
+    n_jobs : number of threads
+    max_bins : maximum number of matrix cells counted at once (ROIs are batched accordingly)
+
+    Returns
+    -------
+    array (ROI * time * type * direction)
+    """
+    types = valid_types if types is None else types
+    dirs = valid_dirs if dirs is None else dirs
+    generate_feature_names(types, dirs)
+
+    # time * height * width
+    quantized = [np.moveaxis(quantize(a, levels), -1, 0) for a in rois.values()]
+    if levels is None:
+        levels = max([int(q.max()) for q in quantized if q.size] + [0]) + 1
+        if levels * levels * len(dirs) > max_bins:
+            raise ValueError("The raw values span {} grey levels, the co-occurrence matrices of one image exceed "
+                             "max_bins = {}: scale the values or set levels".format(levels, max_bins))
+    n_rois, n_times = len(quantized), quantized[0].shape[0] if quantized else 0
+    batch = max(1, max_bins // (len(dirs) * levels * levels))
+    result = np.full((n_rois, n_times, len(types), len(dirs)), np.nan)
+
+    def run(t):
+        for start in range(0, n_rois, batch):
+            images = [q[t] for q in quantized[start:start + batch]]
+            result[start:start + batch, t] = np.moveaxis(haralick(cooccurrence(images, levels, dirs), types), -1, -2)
+
+    if n_jobs == 1 or n_times < 2:
+        for t in range(n_times):
+            run(t)
+    else:
+        with ThreadPoolExecutor(n_jobs) as executor:
+            list(executor.map(run, range(n_times)))
+    return result
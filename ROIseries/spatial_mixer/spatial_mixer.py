@@ -0,0 +1,176 @@
+#
+#  ROIseries_spatial_mixer: spatial statistics of the regions of interest
+#  Copyright (C) 2017 Niklas Keck
+#
+#  This file is part of ROIseries.
+#
+#  ROIseries is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  ROIseries is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with ROIseries.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy as np
+import pandas as pd
+from ROIseries.glcm_features import glcm_features
+
+native = ["MEAN", "STDDEV", "COUNT", "MIN", "MAX", "SUM", "MEDIAN"]
+
+
+def labelled_pixels(rois):
+    """
+    Concatenate the pixels of all ROIs into one array, labelled with the number of their ROI
+
+    Parameters
+    ----------
+    rois : dict id -> array (height * width * time), e.g. the result of cookie_cutter. Pixels without
+           any value (outside of the ROI) are dropped.
+
+    Returns
+    -------
+    ids, codes (ROI number of each pixel, sorted), values (pixel * time)
+    """
+    ids = list(rois.keys())
+    flat = [np.asarray(a).reshape(-1, np.shape(a)[-1]) for a in rois.values()]
+    values = np.concatenate(flat).astype(np.float64)
+    codes = np.repeat(np.arange(len(ids)), [len(f) for f in flat])
+
+    keep = ~np.isnan(values).all(axis=1)
+    return ids, codes[keep], values[keep]
+
+
+def _format_time(t):
+    return t if isinstance(t, str) else "{:.10f}".format(t)
+
+
+def statistics(codes, values, n_rois, types):
+    """
+    Statistics of the pixels of each ROI and time in one pass over the labelled pixels
+
+    Parameters
+    ----------
+    codes : ROI number of each pixel (sorted)
+    values : values (pixel * time), NaN is ignored
+    n_rois : number of ROIs
+    types : list of MEAN, STDDEV, COUNT, MIN, MAX, SUM, MEDIAN, PERCENTILE_<p>
+
+    Returns
+    -------
+    dict type -> array (ROI * time)
+    """
+    n_pixels, n_times = values.shape
+    finite = ~np.isnan(values)
+    values_0 = np.where(finite, values, 0)
+
+    # sums of all ROIs and times in one bincount: ROI r, time t counts into bin r * n_times + t
+    bins = (codes[:, None] * n_times + np.arange(n_times)[None, :]).ravel()
+
+    def per_roi(weights):
+        return np.bincount(bins, weights=weights.ravel(), minlength=n_rois * n_times).reshape(n_rois, n_times)
+
+    count = per_roi(finite)
+    total = per_roi(values_0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total / count
+
+    result = {}
+    for t in types:
+        if t == "MEAN":
+            result[t] = mean
+        elif t == "SUM":
+            result[t] = total
+        elif t == "COUNT":
+            result[t] = count
+        elif t == "STDDEV":
+            # second moment around the mean (as STDDEV: sample standard deviation)
+            squares = per_roi(np.where(finite, values - mean[codes], 0) ** 2)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                result[t] = np.where(count > 1, np.sqrt(squares / (count - 1)), np.nan)
+
+    if "MIN" in types or "MAX" in types:
+        starts = np.searchsorted(codes, np.arange(n_rois))
+        non_empty = np.bincount(codes, minlength=n_rois) > 0
+        for t, ufunc in [("MIN", np.fmin), ("MAX", np.fmax)]:
+            if t in types:
+                result[t] = np.full((n_rois, n_times), np.nan)
+                if n_pixels:
+                    result[t][non_empty] = ufunc.reduceat(values, starts[non_empty], axis=0)
+
+    ranked = [t for t in types if t == "MEDIAN" or t.startswith("PERCENTILE")]
+    if ranked:
+        # one sort for all order statistics: by ROI, within each ROI by value (NaN last)
+        order = np.lexsort((values, np.broadcast_to(codes[:, None], values.shape)), axis=0)
+        sorted_values = np.take_along_axis(values, order, axis=0)
+        # the order statistics are read at the offsets of the ROIs in the sorted pixels
+        starts = np.searchsorted(codes, np.arange(n_rois))[:, None]
+        for t in ranked:
+            if t == "MEDIAN":
+                # as MEDIAN without /EVEN: the upper of the middle values
+                k = count.astype(np.int64) // 2
+            else:
+                # as PERCENTILE_RS: nearest rank
+                percentage = float(t.split("_")[1])
+                if not 0 <= percentage <= 100:
+                    raise ValueError("Percentage has to be between 0 to 100")
+                k = np.maximum(np.ceil(percentage / 100.0 * count).astype(np.int64) - 1, 0)
+            position = np.minimum(starts + k, max(n_pixels - 1, 0))
+            result[t] = np.where(count > 0, sorted_values[position, np.arange(n_times)[None, :]]
+                                 if n_pixels else np.nan, np.nan)
+
+    unknown = [t for t in types if t not in result]
+    if unknown:
+        raise ValueError("{} will not be calculated since it is not a valid option".format(unknown))
+    return result
+
+
+def spatial_mixer(rois, types, times, prefix="", id_name="ID", glcm_levels=64, n_jobs=None):
+    """
+    Spatial statistics of each ROI and time (as RS_SPATIAL_MIXER), all statistics in one pass
+
+    Parameters
+    ----------
+    rois : dict id -> array (height * width * time), e.g. the result of cookie_cutter
+    types : list of MEAN, STDDEV, COUNT, MIN, MAX, SUM, MEDIAN, PERCENTILE_<p>, GLCM (all GLCM features)
+            and GLCM_<type>_<dir> (see glcm_features)
+    times : julian date of each time (floats or strings), used as column suffix
+    prefix : prefix of the feature names, e.g. "NDVI_"
+    glcm_levels, n_jobs : grey levels and number of threads of glcm_features.glcm_features
+
+    Returns
+    -------
+    DataFrame ID * FEATURE_JULIANDATE (e.g. NDVI_MEAN_2457350.0000000000), the format of the feature CSVs
+    and the input of timeindex_from_colsuffix
+
+    Unlike RS_SPATIAL_MIXER, which writes COUNT once (a single column 'COUNT' of the first time), COUNT is
+    a column per time like all other statistics: the number of valid pixels changes with the NaN of each time
+    (e.g. clouds), and every column keeps the FEATURE_JULIANDATE format.
+    """
+    ids, codes, values = labelled_pixels(rois)
+    if values.shape[1] != len(times):
+        raise ValueError("length of time attribute and temporal array dimension differ")
+
+    # expand GLCM to all GLCM features
+    types = [n for t in types for n in (glcm_features.generate_feature_names() if t == "GLCM" else [t])]
+    glcm = [t for t in types if t.startswith("GLCM_")]
+    result = statistics(codes, values, len(ids), [t for t in types if t not in glcm])
+
+    if glcm:
+        glcm_types = sorted(set(t.split("_")[1] for t in glcm))
+        glcm_dirs = sorted(set(t.split("_")[2] for t in glcm))
+        features = glcm_features.glcm_features(rois, glcm_types, glcm_dirs, levels=glcm_levels, n_jobs=n_jobs)
+        for t in glcm:
+            _, glcm_type, direction = t.split("_")
+            result[t] = features[:, :, glcm_types.index(glcm_type), glcm_dirs.index(direction)]
+
+    times = [_format_time(t) for t in times]
+    columns = ["{}{}_{}".format(prefix, t, time) for t in types for time in times]
+    return pd.DataFrame(np.concatenate([result[t] for t in types], axis=1), columns=columns,
+                        index=pd.Index(ids, name=id_name))
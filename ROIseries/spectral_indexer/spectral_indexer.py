@@ -0,0 +1,259 @@
+#
+#  ROIseries_spectral_indexer: combine image bands into spectral indices
+#  Copyright (C) 2017 Niklas Keck
+#
+#  This file is part of ROIseries.
+#
+#  ROIseries is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  ROIseries is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with ROIseries.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import ast
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from ROIseries.sub_routines.sub_routines import lazy_import
+
+rasterio = lazy_import("rasterio")
+
+_binary = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide,
+           ast.Pow: np.power, ast.Gt: np.greater, ast.Lt: np.less, ast.GtE: np.greater_equal,
+           ast.LtE: np.less_equal, ast.Eq: np.equal, ast.NotEq: np.not_equal}
+_unary = {ast.USub: np.negative, ast.UAdd: np.positive}
+_comparisons = {np.greater, np.less, np.greater_equal, np.less_equal, np.equal, np.not_equal}
+_functions = {"sqrt": np.sqrt, "abs": np.abs, "exp": np.exp, "alog": np.log, "alog10": np.log10}
+
+# IDL operators -> python operators
+_idl_operators = [(r"\^", "**"), (r"\bGT\b", ">"), (r"\bLT\b", "<"), (r"\bGE\b", ">="), (r"\bLE\b", "<="),
+                  (r"\bEQ\b", "=="), (r"\bNE\b", "!=")]
+
+
+class SpectralIndex(object):
+    """
+    A formula of SPECTRAL_INDEXER (e.g. "(R[3]-R[2])/(R[3]+R[2])") compiled to a sequence of ufunc calls
+
+    The formula is parsed once into an expression tree, which is compiled to instructions on a few
+    registers (temporary buffers). The evaluation runs the instructions tile by tile, so the temporaries
+    stay small and the bands are cast to float within the ufuncs instead of as full copies.
+
+    Supported: R[i] (band i), numbers, + - * / ^ (or **), GT LT GE LE EQ NE (or > < >= <= == !=),
+    unary -, SQRT(), ABS(), EXP(), ALOG(), ALOG10(). As in IDL the formula is case insensitive.
+    """
+    def __init__(self, formula):
+        self.formula = formula
+        expression = formula.lower()
+        for idl, python in _idl_operators:
+            expression = re.sub(idl, python, expression, flags=re.IGNORECASE)
+        tree = ast.parse(expression, mode="eval").body
+
+        self.instructions = []
+        self.bands = set()
+        self._free = []
+        self.n_registers = 0
+        result = self._compile(tree)
+        if result[0] == "register":
+            # the last instruction writes to the output directly
+            ufunc, _, operands = self.instructions[-1]
+            self.instructions[-1] = (ufunc, ("out", None), operands)
+        else:
+            self.instructions.append((np.copyto, ("out", None), (result,)))
+        self.bands = sorted(self.bands)
+
+    def _register(self):
+        if self._free:
+            return self._free.pop()
+        self.n_registers += 1
+        return self.n_registers - 1
+
+    def _release(self, operands):
+        self._free.extend(o[1] for o in operands if o[0] == "register")
+
+    def _emit(self, ufunc, operands):
+        self._release(operands)
+        destination = ("register", self._register())
+        self.instructions.append((ufunc, destination, operands))
+        return destination
+
+    def _compile(self, node):
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == "r":
+            band = ast.literal_eval(node.slice)
+            if not isinstance(band, int):
+                raise ValueError("Bands must be referenced by their number, e.g. R[3]: {}".format(self.formula))
+            self.bands.add(band)
+            return "band", band
+        elif isinstance(node, ast.Constant) and not isinstance(node.value, (str, bytes)):
+            return "constant", node.value
+        elif isinstance(node, ast.BinOp) and type(node.op) in _binary:
+            return self._emit(_binary[type(node.op)], (self._compile(node.left), self._compile(node.right)))
+        elif isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in _binary:
+            return self._emit(_binary[type(node.ops[0])], (self._compile(node.left),
+                                                           self._compile(node.comparators[0])))
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in _unary:
+            return self._emit(_unary[type(node.op)], (self._compile(node.operand),))
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _functions \
+                and len(node.args) == 1:
+            return self._emit(_functions[node.func.id], (self._compile(node.args[0]),))
+        raise ValueError("Unsupported expression in formula: {}".format(self.formula))
+
+    def evaluate(self, R, out, registers):
+        """
+        Run the instructions on one tile
+
+        Parameters
+        ----------
+        R : list of the bands (arrays of the tile)
+        out : output array of the tile
+        registers : list of n_registers arrays of the shape of out
+        """
+        def value(operand):
+            kind, v = operand
+            if kind == "band":
+                return R[v]
+            elif kind == "register":
+                return registers[v][:len(out)]
+            return v
+
+        for ufunc, (kind, d), operands in self.instructions:
+            destination = out if kind == "out" else registers[d][:len(out)]
+            if ufunc is np.copyto:
+                np.copyto(destination, value(operands[0]), casting="unsafe")
+            elif ufunc in _comparisons:
+                # compared in the dtype of the operands, the result is 1 or 0
+                ufunc(*[value(o) for o in operands], out=destination, casting="unsafe")
+            else:
+                ufunc(*[value(o) for o in operands], out=destination, dtype=out.dtype, casting="unsafe")
+
+
+class SpectralIndexer(object):
+    """
+    Compute one or many spectral indices from the bands of an image (or a block of a CubeStore)
+
+    The bands are read once for all indices. The image is split into tiles of about tile_size pixels
+    (along the first axis of the bands), the tiles are evaluated on a thread pool (numpy releases the GIL)
+    with one set of registers per thread, the results are written into one preallocated array.
+
+    Parameters
+    ----------
+    formulas : a formula (see SpectralIndex) or a dict name -> formula
+    dtype : dtype of the result
+    tile_size : number of pixels per tile
+    n_jobs : number of threads (default: number of processors)
+
+    Example
+    -------
+    # Sentinel-2 10 m bands: R[0] = B2 (blue), R[1] = B3 (green), R[2] = B4 (red), R[3] = B8 (nir)
+    >>> indexer = SpectralIndexer({"NDVI": "(R[3]-R[2])/(R[3]+R[2])",
+    ...                            "NDWI": "(R[1]-R[3])/(R[1]+R[3])",
+    ...                            "EVI": "2.5*(R[3]-R[2])/(R[3]+6*R[2]-7.5*R[0]+1)"})
+    >>> ndvi, ndwi, evi = indexer.transform(image)  # image: band * row * column
+
+    # the indices of all dates of a tile of a CubeStore
+    >>> for rows, cols, block in cube.iter_tiles():
+    ...     indices = indexer.transform(block, band_axis=1)  # time * index * row * column
+    """
+    def __init__(self, formulas, dtype=np.float32, tile_size=2 ** 16, n_jobs=None):
+        if isinstance(formulas, str):
+            formulas = OrderedDict([(formulas, formulas)])
+        self.names = list(formulas.keys())
+        self.indices = [SpectralIndex(f) for f in formulas.values()]
+        self.dtype = dtype
+        self.tile_size = tile_size
+        self.n_jobs = n_jobs
+
+    def transform(self, image, band_axis=0):
+        """
+        Compute the indices of image
+
+        Parameters
+        ----------
+        image : array with the bands along band_axis, or a list of 2D arrays (one per band)
+        band_axis : axis of the bands
+
+        Returns
+        -------
+        array with the indices along band_axis
+        """
+        if isinstance(image, np.ndarray):
+            R = [np.take(image, i, axis=band_axis) for i in range(image.shape[band_axis])]
+        else:
+            R = [np.asarray(i) for i in image]
+        needed = sorted(set(b for index in self.indices for b in index.bands))
+        if needed and needed[-1] >= len(R):
+            raise ValueError("The formulas reference band {}, the image has {} bands".format(needed[-1], len(R)))
+
+        shape = R[0].shape
+        out = np.empty((len(self.indices),) + shape, dtype=self.dtype)
+        if out.size == 0:
+            return np.moveaxis(out, 0, band_axis)
+
+        # tiles along the first axis of the bands
+        pixels_per_row = int(np.prod(shape[1:])) if len(shape) > 1 else 1
+        rows_per_tile = max(1, self.tile_size // max(pixels_per_row, 1))
+        tiles = [slice(i, min(i + rows_per_tile, shape[0])) for i in range(0, shape[0], rows_per_tile)]
+
+        local = threading.local()
+
+        def run(tile):
+            if not hasattr(local, "registers"):
+                n_registers = max(index.n_registers for index in self.indices)
+                local.registers = [np.empty((rows_per_tile,) + shape[1:], dtype=self.dtype)
+                                   for _ in range(n_registers)]
+            R_tile = [band[tile] for band in R]
+            with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+                for i, index in enumerate(self.indices):
+                    index.evaluate(R_tile, out[i, tile], local.registers)
+
+        if len(tiles) == 1 or self.n_jobs == 1:
+            for tile in tiles:
+                run(tile)
+        else:
+            with ThreadPoolExecutor(self.n_jobs) as executor:
+                list(executor.map(run, tiles))
+
+        return np.moveaxis(out, 0, band_axis)
+
+
+def spectral_indexer(images, formula, dtype=np.float32, n_jobs=None):
+    """
+    Combine the bands of images into one 2D array per image (as SPECTRAL_INDEXER)
+
+    Parameters
+    ----------
+    images : a raster (path), an array (band * row * column), a list of 2D arrays (one per band)
+             or a list of rasters (each evaluated separately)
+    formula : formula (see SpectralIndex) or dict name -> formula to compute multiple indices at once
+
+    Returns
+    -------
+    a 2D array (a list of 2D arrays for a list of rasters). For a dict of formulas, an OrderedDict
+    name -> result.
+    """
+    indexer = SpectralIndexer(formula, dtype=dtype, n_jobs=n_jobs)
+
+    def index(image):
+        if isinstance(image, str):
+            with rasterio.open(image) as src:
+                image = src.read()
+        return indexer.transform(image)
+
+    if isinstance(images, (list, tuple)) and len(images) and isinstance(images[0], str):
+        results = [index(i) for i in images]
+        per_index = [[r[i] for r in results] for i in range(len(indexer.names))]
+    else:
+        per_index = list(index(images))
+
+    if isinstance(formula, str):
+        return per_index[0]
+    return OrderedDict(zip(indexer.names, per_index))
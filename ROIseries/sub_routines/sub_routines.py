@@ -1,7 +1,51 @@
 import os
+import importlib
 import pandas as pd
 import numpy as np
 
+
+class lazy_import(object):
+    """
+    Stand-in for a module, which is imported at the first access of one of its attributes
+
+    Heavy dependencies (plotting, astropy, imblearn, rasterio, ...) are bound with lazy_import at module
+    level, so that import ROIseries stays cheap and they are loaded only by the functions using them.
+    Submodules are imported on access as well (e.g. rasterio.features).
+
+    Example
+    -------
+    >>> plt = lazy_import("matplotlib.pyplot")
+    >>> plt.plot([1, 2, 3])  # matplotlib is imported here
+    """
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        module = self._load()
+        try:
+            return getattr(module, attr)
+        except AttributeError:
+            try:
+                return importlib.import_module("{}.{}".format(self._name, attr))
+            except ImportError:
+                raise AttributeError("module '{}' has no attribute '{}'".format(self._name, attr))
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return "<lazy module '{}' ({})>".format(self._name, state)
+
 def file_search(top_dir, extension):
 
     result = []
@@ -38,4 +82,98 @@ def idx_corners(n_vars, direction):
         raise ValueError("direction not in "
                          "['up_right','down_left','up_left','up_right']")
 
-    return [x, y]
+    return x, y
+
+
+def _sliding_extreme(x, interval, ufunc):
+    # van Herk / Gil-Werman: running extreme (NaN-aware with fmin / fmax) of all windows in O(T)
+    n_rows, n_times = x.shape
+    n_blocks = -(-n_times // interval)
+    padded = np.full((n_rows, n_blocks * interval), np.nan)
+    padded[:, :n_times] = x
+    blocks = padded.reshape(n_rows, n_blocks, interval)
+    prefix = ufunc.accumulate(blocks, axis=2).reshape(n_rows, -1)
+    suffix = ufunc.accumulate(blocks[:, :, ::-1], axis=2)[:, :, ::-1].reshape(n_rows, -1)
+    n_windows = n_times - interval + 1
+    return ufunc(suffix[:, :n_windows], prefix[:, interval - 1:interval - 1 + n_windows])
+
+
+def moving_stats(array, interval, stats=None):
+    """
+    Statistics of all windows of interval time steps along the last axis (as MOVING_STATS_RS), NaN ignored
+
+    All windows come from NaN-aware cumulative power sums (mean, variance, skewness, kurtosis, std, total)
+    and a running minimum / maximum, so the cost does not depend on interval. Only mdev (mean absolute
+    deviation) needs the values of each window (vectorized on a sliding window view).
+
+    Parameters
+    ----------
+    array : array (... * time), e.g. pixels * time or x * y * time
+    interval : number of time steps of the windows
+    stats : list of "mean", "variance", "skewness", "kurtosis", "std", "mdev", "min", "max", "total"
+            (all if None)
+
+    Returns
+    -------
+    dict stat -> array (... * (time - interval + 1))
+    """
+    all_stats = ["mean", "variance", "skewness", "kurtosis", "std", "mdev", "min", "max", "total"]
+    stats = all_stats if stats is None else stats
+    unknown = set(stats) - set(all_stats)
+    if unknown:
+        raise ValueError("Unknown statistics: {}".format(sorted(unknown)))
+
+    array = np.asarray(array, dtype=np.float64)
+    lead, n_times = array.shape[:-1], array.shape[-1]
+    if not 1 <= interval <= n_times:
+        raise ValueError("interval must be between 1 and the length of the time axis")
+    x = array.reshape(-1, n_times)
+    n_windows = n_times - interval + 1
+    out = np.empty((len(stats), x.shape[0], n_windows))
+    result = dict(zip(stats, out))
+
+    finite = ~np.isnan(x)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # center each row to keep the power sums accurate
+        center = np.where(finite.any(axis=1), np.nanmean(np.where(finite, x, np.nan), axis=1), 0)[:, None]
+    xc = np.where(finite, x - center, 0)
+
+    def window_sums(values):
+        cumulative = np.zeros((x.shape[0], n_times + 1))
+        np.cumsum(values, axis=1, out=cumulative[:, 1:])
+        return cumulative[:, interval:] - cumulative[:, :n_windows]
+
+    n = window_sums(finite)
+    s1, s2, s3, s4 = [window_sums(xc ** k) for k in (1, 2, 3, 4)]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        m = s1 / n
+        # central moments from the power sums
+        m2 = s2 - n * m ** 2
+        m3 = s3 - 3 * m * s2 + 2 * n * m ** 3
+        m4 = s4 - 4 * m * s3 + 6 * m ** 2 * s2 - 3 * n * m ** 4
+        variance = np.maximum(m2, 0) / (n - 1)
+        sdev = np.sqrt(variance)
+
+        for stat in stats:
+            if stat == "mean":
+                np.add(m, center, out=result[stat])
+            elif stat == "variance":
+                result[stat][:] = variance
+            elif stat == "std":
+                result[stat][:] = sdev
+            elif stat == "skewness":
+                np.divide(m3, n * sdev ** 3, out=result[stat])
+            elif stat == "kurtosis":
+                np.subtract(m4 / (n * variance ** 2), 3, out=result[stat])
+            elif stat == "total":
+                np.add(s1, n * center, out=result[stat])
+            elif stat == "mdev":
+                windows = np.lib.stride_tricks.sliding_window_view(x, interval, axis=1)
+                np.divide(np.nansum(np.abs(windows - (m + center)[:, :, None]), axis=2), n, out=result[stat])
+            elif stat == "min":
+                result[stat][:] = _sliding_extreme(x, interval, np.fmin)
+            elif stat == "max":
+                result[stat][:] = _sliding_extreme(x, interval, np.fmax)
+
+    return {k: v.reshape(lead + (n_windows,)) for k, v in result.items()}
@@ -0,0 +1,84 @@
+#
+#  ROIseries_temporal_blender: align time series of the regions of interest on a common time axis
+#  Copyright (C) 2017 Niklas Keck
+#
+#  This file is part of ROIseries.
+#
+#  ROIseries is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  ROIseries is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with ROIseries.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy as np
+import pandas as pd
+
+
+def _as_numbers(time):
+    # datetimes as ns (int64, made relative to the first source time before the conversion to float64),
+    # numbers as float64
+    time = pd.Index(time)
+    if isinstance(time, pd.DatetimeIndex):
+        return time.asi8
+    return np.asarray(time, dtype=np.float64)
+
+
+def interpolate_to(s_time, o_time, s_values):
+    """
+    Linear interpolation of the series (columns of s_values) from s_time to o_time (as RS_interpolate_to)
+
+    One searchsorted locates all target times, all columns are interpolated at once. Values at matching
+    times are copied, targets outside of [min(s_time), max(s_time)] are NaN. As INTERPOL, NaN in the
+    neighbouring source values propagate.
+
+    Parameters
+    ----------
+    s_time : source times (numbers or datetimes)
+    o_time : target times (of the same type)
+    s_values : array (source time * series)
+
+    Returns
+    -------
+    array (target time * series)
+    """
+    s = _as_numbers(s_time)
+    o = _as_numbers(o_time)
+    values = np.asarray(s_values, dtype=np.float64)
+    if values.ndim == 1:
+        return interpolate_to(s_time, o_time, values[:, None])[:, 0]
+    if len(s) != len(values):
+        raise ValueError("s_time and s_values must have the same length")
+
+    order = np.argsort(s, kind="stable")
+    s, values = s[order], values[order]
+    if len(s) and len(o):
+        # relative to the first source time (in int64 for datetimes) to keep the precision of float64
+        o, s = o - s[0], s - s[0]
+    o, s = o.astype(np.float64), s.astype(np.float64)
+
+    right = np.searchsorted(s, o, side="left")
+    left = np.clip(right - 1, 0, max(len(s) - 1, 0))
+    right = np.clip(right, 0, max(len(s) - 1, 0))
+    # exact matches: take the value itself
+    match = (right < len(s)) & (s[right] == o) if len(s) else np.zeros(len(o), dtype=bool)
+    left[match] = right[match]
+
+    result = np.full((len(o), values.shape[1]), np.nan)
+    inside = (o >= s[0]) & (o <= s[-1]) if len(s) else np.zeros(len(o), dtype=bool)
+    if not inside.any():
+        return result
+
+    l, r = left[inside], right[inside]
+    dt = s[r] - s[l]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight = np.where(dt > 0, (o[inside] - s[l]) / dt, 0)[:, None]
+    result[inside] = np.where(weight > 0, values[l] + weight * (values[r] - values[l]), values[l])
+    return result
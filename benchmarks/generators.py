@@ -0,0 +1,111 @@
+#
+#  ROIseries_benchmark_generators: synthetic data for the benchmarks of the feature pipeline
+#  Copyright (C) 2017 Niklas Keck
+#
+#  This file is part of ROIseries.
+#
+#  ROIseries is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  ROIseries is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with ROIseries.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy as np
+import pandas as pd
+
+# first date and revisit time (days) of the synthetic time series: Sentinel-2A, as the test data
+FIRST_JULIAN = 2457350.0
+REVISIT = 10.0
+
+
+def ids(n_rois):
+    return pd.Index(["ID_{}".format(i) for i in range(n_rois)], name="ID")
+
+
+def julian_dates(n_dates):
+    return FIRST_JULIAN + REVISIT * np.arange(n_dates)
+
+
+def feature_names(n_features):
+    return ["F{:03d}_MEAN".format(i) for i in range(n_features)]
+
+
+def feature_frame(n_rois, n_dates, n_features, seed=0, dtype=np.float64, missing=0.01):
+    """
+    Features in the format of the feature CSVs: ID * FEATURE_JULIANDATE
+
+    Each feature is a smooth curve per ROI (seasonal cycle with a random phase and amplitude) plus noise, a
+    fraction missing of the values is NaN (e.g. clouds).
+
+    Returns
+    -------
+    DataFrame n_rois * (n_features * n_dates), the columns ordered by feature, then date
+    """
+    rng = np.random.RandomState(seed)
+    phase = rng.uniform(0, 2 * np.pi, (n_rois, n_features, 1)).astype(dtype)
+    amplitude = rng.uniform(0.5, 2, (n_rois, n_features, 1)).astype(dtype)
+    season = (2 * np.pi * np.arange(n_dates, dtype=dtype) * REVISIT / 365.25)[None, None, :]
+
+    values = amplitude * np.sin(season + phase)
+    values += rng.normal(scale=0.1, size=values.shape).astype(dtype)
+    values = values.reshape(n_rois, n_features * n_dates)
+    if missing:
+        values[rng.rand(*values.shape) < missing] = np.nan
+
+    columns = ["{}_{:.10f}".format(f, t) for f in feature_names(n_features) for t in julian_dates(n_dates)]
+    return pd.DataFrame(values, index=ids(n_rois), columns=columns)
+
+
+def strata(n_rois, n_strata, seed=0):
+    """
+    Stratum of each ROI (s_0 ... s_<n_strata - 1>), Series indexed by ID
+    """
+    rng = np.random.RandomState(seed + 1)
+    return pd.Series(np.array(["s_{}".format(i) for i in range(n_strata)])[rng.randint(n_strata, size=n_rois)],
+                     index=ids(n_rois), name="stratum")
+
+
+def classes(X, seed=0):
+    """
+    Binary class of each sample, depending on the first features (so that the classifier has something to learn)
+    """
+    rng = np.random.RandomState(seed + 2)
+    X = np.nan_to_num(np.asarray(X, dtype=np.float64))
+    signal = X[:, :min(3, X.shape[1])].sum(axis=1)
+    return signal + rng.normal(scale=signal.std() + 1e-12, size=len(X)) > 0
+
+
+def samples(df, strata_by_id, seed=0):
+    """
+    Sommelier input: samples (time, ID) * features plus the columns "class" and "stratum"
+
+    Parameters
+    ----------
+    df : (time, ID) * features, e.g. timeindex_from_colsuffix(...).stack("ID") or the result of TAFtoTRF
+    strata_by_id : the result of strata
+    """
+    result = df.copy()
+    if isinstance(result.columns, pd.MultiIndex):
+        result.columns = ["_".join(str(i) for i in c) for c in result.columns]
+    result["class"] = classes(result.values, seed)
+    result["stratum"] = strata_by_id.reindex(result.index.get_level_values("ID")).values
+    return result
+
+
+def predictions(n_samples, n_strata, error_rate=0.2, seed=0):
+    """
+    y_true (Series with the level "strata" in its index) and y_pred with a fraction error_rate of errors
+    """
+    rng = np.random.RandomState(seed)
+    stratum = np.array(["s_{}".format(i) for i in range(n_strata)])[rng.randint(n_strata, size=n_samples)]
+    y_true = pd.Series(rng.rand(n_samples) < 0.5, index=pd.Index(stratum, name="strata"))
+    y_pred = np.where(rng.rand(n_samples) < error_rate, ~y_true.values, y_true.values)
+    return y_true, y_pred
@@ -0,0 +1,129 @@
+#
+#  ROIseries_import_time: cold start time and memory of importing ROIseries
+#  Copyright (C) 2017 Niklas Keck
+#
+#  This file is part of ROIseries.
+#
+#  ROIseries is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  ROIseries is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with ROIseries.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Cold start time and memory of typical imports of a worker process
+
+Each import statement runs repeat times in a fresh interpreter. The wall time of the import, the growth of
+the RSS and the heavy dependencies loaded by it are recorded (the minimum time of the runs), appended to
+the output file as JSON lines (as run_benchmarks.py) and checked against the limits: the exit code is 1 if
+an import exceeds --max-seconds or --max-rss-mib or loads one of the dependencies which must stay lazy.
+
+Example
+-------
+python benchmarks/import_time.py
+python benchmarks/import_time.py --max-seconds 1.5 --max-rss-mib 150 --output import_time.jsonl
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from run_benchmarks import environment
+
+# ROIseries of this checkout (also without an installed package)
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# what the workers import
+statements = ["import ROIseries",
+              "import ROIseries; ROIseries.scoring_metrics",
+              "import ROIseries; ROIseries.feature_transformers",
+              "import ROIseries; ROIseries.feature_sommelier",
+              "import ROIseries; ROIseries.cookie_cutter"]
+
+# dependencies loaded only by the functions using them (see sub_routines.lazy_import)
+lazy = ["matplotlib", "seaborn", "astropy", "imblearn", "rasterio", "fiona"]
+
+_probe = """
+import json, os, resource, sys, time
+sys.path.insert(0, {root!r})
+
+def rss():
+    # current RSS (ru_maxrss is inherited from the parent over fork / exec on Linux)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+before = rss()
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "rss_bytes": rss() - before,
+                  "modules": sorted(m for m in {lazy!r} if m in sys.modules)}}))
+"""
+
+
+def measure(statement, repeat=5):
+    """
+    Import time, RSS growth and the lazy dependencies loaded by statement in fresh interpreters
+    """
+    probe = _probe.format(statement=statement, lazy=lazy, root=root)
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", probe])
+        runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+    return {"statement": statement, "seconds": [r["seconds"] for r in runs],
+            "seconds_min": min(r["seconds"] for r in runs),
+            "seconds_median": float(np.median([r["seconds"] for r in runs])),
+            "rss_bytes": int(np.median([r["rss_bytes"] for r in runs])),
+            "loaded_lazy_modules": runs[-1]["modules"]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=None, help="limit of the import time of each statement")
+    parser.add_argument("--max-rss-mib", type=float, default=None, help="limit of the RSS growth of each statement")
+    parser.add_argument("--output", default=None, help="JSON lines file the results are appended to")
+    options = parser.parse_args(argv)
+
+    env = environment()
+    failed = False
+    records = []
+    for statement in statements:
+        record = measure(statement, options.repeat)
+        problems = []
+        if record["loaded_lazy_modules"]:
+            problems.append("loads {}".format(", ".join(record["loaded_lazy_modules"])))
+        if options.max_seconds is not None and record["seconds_min"] > options.max_seconds:
+            problems.append("slower than {} s".format(options.max_seconds))
+        if options.max_rss_mib is not None and record["rss_bytes"] > options.max_rss_mib * 2 ** 20:
+            problems.append("more than {} MiB".format(options.max_rss_mib))
+        record["problems"] = problems
+        record.update(env)
+        records.append(record)
+        failed |= bool(problems)
+        print("{:50} {:7.3f} s {:8.1f} MiB  {}".format(statement, record["seconds_min"],
+                                                       record["rss_bytes"] / 2 ** 20, "; ".join(problems) or "ok"))
+
+    if options.output is not None:
+        with open(options.output, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+    return int(failed)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
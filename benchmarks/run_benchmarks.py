@@ -0,0 +1,319 @@
+#
+#  ROIseries_benchmarks: wall time, peak memory and allocations of the stages of the feature pipeline
+#  Copyright (C) 2017 Niklas Keck
+#
+#  This file is part of ROIseries.
+#
+#  ROIseries is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  ROIseries is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with ROIseries.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Benchmarks of the stages of the feature pipeline on synthetic data (see generators.py)
+
+Each (scenario, stage) runs in a fresh process: its inputs are generated, the stage is timed repeat times,
+then run once more under tracemalloc. The results are appended as one JSON object per line to the output
+file, together with the versions of the packages and the git commit, so that the files of two versions
+can be compared.
+
+Stages
+------
+timeindex_from_colsuffix : ID * FEATURE_JULIANDATE -> time * (ID, feature)
+TAFtoTRF : (time, ID) * feature -> (time, ID) * (feature, shift), three shifts
+DropCorrelated : drop by a precomputed correlation matrix (features * features)
+DropCorrelatedBlockwise : correlations computed in tiles during fit
+errors_per_stratum_count : errors per stratum of the predictions of all samples
+CV : ROIseries_feature_sommelier.CV on the (time, ID) samples
+chain : all of the above from the feature CSV format to the errors per stratum of the CV predictions
+
+Example
+-------
+python benchmarks/run_benchmarks.py --scenario small medium --output bench_v1.jsonl
+python benchmarks/run_benchmarks.py --scenario large --stage TAFtoTRF CV --repeat 1
+python benchmarks/run_benchmarks.py --n-rois 2000 --n-dates 30 --n-features 40 --n-strata 4
+python benchmarks/run_benchmarks.py compare bench_v1.jsonl bench_v2.jsonl --threshold 1.1
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+# generators and ROIseries of this checkout (also without an installed package)
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [benchmark_dir, os.path.dirname(benchmark_dir)]
+import generators
+
+# n_rois, n_dates, n_features, n_strata
+scenarios = {"small": (1000, 20, 10, 3),
+             "medium": (10000, 50, 50, 5),
+             "large": (100000, 100, 100, 10),
+             "xlarge": (100000, 100, 500, 10)}
+
+stages = ["timeindex_from_colsuffix", "TAFtoTRF", "DropCorrelated", "DropCorrelatedBlockwise",
+          "errors_per_stratum_count", "CV", "chain"]
+
+shift_dict = {"m1": -1, "t0": 0, "p1": 1}
+correlation_threshold = 0.95
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# stages: setup(size) returns the inputs, run(*inputs) is measured
+def _stacked(n_rois, n_dates, n_features, n_strata, dtype="float64"):
+    import ROIseries as rs
+    wide = generators.feature_frame(n_rois, n_dates, n_features, dtype=dtype)
+    return rs.feature_transformers.timeindex_from_colsuffix(wide).stack("ID")
+
+
+def _sommelier(df, options):
+    import ROIseries as rs
+    sommelier = rs.feature_sommelier.ROIseries_feature_sommelier(df, "class", "stratum", True)
+    sommelier.messages = False
+    sommelier.folds = options.folds
+    sommelier.n_trees = options.n_trees
+    sommelier.n_jobs = options.n_jobs
+    return sommelier
+
+
+def _cv_errors(sommelier):
+    import ROIseries as rs
+    from sklearn.model_selection import StratifiedKFold
+    # the CV predictions of all folds, per stratum (the folds of CV: StratifiedKFold without shuffling)
+    folds = StratifiedKFold(n_splits=sommelier.folds).split(sommelier.X, sommelier.y)
+    test_strata = np.concatenate([sommelier.strata[test] for _, test in folds])
+    y_true = pd.Series(np.concatenate(sommelier.y_true), index=pd.Index(test_strata, name="strata"))
+    return rs.scoring_metrics.errors_per_stratum_count(y_true, np.concatenate(sommelier.y_predicted), "strata")
+
+
+def setup(stage, size, options):
+    n_rois, n_dates, n_features, n_strata = size
+    if stage in ("timeindex_from_colsuffix", "chain"):
+        inputs = (generators.feature_frame(n_rois, n_dates, n_features, dtype=options.dtype),)
+        if stage == "chain":
+            inputs += (generators.strata(n_rois, n_strata),)
+        return inputs
+    elif stage == "TAFtoTRF":
+        return (_stacked(*size, dtype=options.dtype),)
+    elif stage in ("DropCorrelated", "DropCorrelatedBlockwise"):
+        x = _stacked(*size, dtype=options.dtype)
+        if stage == "DropCorrelated":
+            return x, np.corrcoef(np.nan_to_num(x.values), rowvar=False)
+        return (x,)
+    elif stage == "errors_per_stratum_count":
+        return generators.predictions(n_rois * n_dates, n_strata)
+    elif stage == "CV":
+        df = generators.samples(_stacked(*size, dtype=options.dtype), generators.strata(n_rois, n_strata))
+        return (_sommelier(df, options),)
+    raise ValueError("Unknown stage: {}".format(stage))
+
+
+def run(stage, inputs, options):
+    import ROIseries as rs
+    if stage == "timeindex_from_colsuffix":
+        return rs.feature_transformers.timeindex_from_colsuffix(inputs[0])
+    elif stage == "TAFtoTRF":
+        return rs.feature_transformers.TAFtoTRF(shift_dict, "ID", dtype=options.dtype).fit_transform(inputs[0])
+    elif stage == "DropCorrelated":
+        x, x_corr = inputs
+        return rs.feature_transformers.DropCorrelated(x_corr, correlation_threshold).fit_transform(x)
+    elif stage == "DropCorrelatedBlockwise":
+        return rs.feature_transformers.DropCorrelatedBlockwise(correlation_threshold).fit_transform(inputs[0])
+    elif stage == "errors_per_stratum_count":
+        y_true, y_pred = inputs
+        return rs.scoring_metrics.errors_per_stratum_count(y_true, y_pred, "strata")
+    elif stage == "CV":
+        return inputs[0].CV()
+    elif stage == "chain":
+        wide, strata = inputs
+        x = rs.feature_transformers.timeindex_from_colsuffix(wide).stack("ID")
+        x = rs.feature_transformers.TAFtoTRF(shift_dict, "ID", dtype=options.dtype).fit_transform(x)
+        x = rs.feature_transformers.DropCorrelatedBlockwise(correlation_threshold).fit_transform(x)
+        sommelier = _sommelier(generators.samples(x, strata), options)
+        sommelier.CV()
+        return _cv_errors(sommelier)
+    raise ValueError("Unknown stage: {}".format(stage))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# measurements
+def _max_rss():
+    # peak resident set size of this process in bytes (ru_maxrss: KiB on Linux, bytes on macOS)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _measure(stage, size, options, queue):
+    try:
+        import ROIseries  # imported before the timed runs
+        inputs = setup(stage, size, options)
+        setup_rss = _max_rss()
+        times = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(options.repeat):
+                start = time.perf_counter()
+                run(stage, inputs, options)
+                times.append(time.perf_counter() - start)
+            peak_rss = _max_rss()
+
+            # allocations (numpy reports its buffers to tracemalloc), separate run: tracing slows python code
+            alloc_peak = alloc_retained = None
+            if options.allocations:
+                tracemalloc.start()
+                before = tracemalloc.get_traced_memory()[0]
+                result = run(stage, inputs, options)
+                retained, alloc_peak = tracemalloc.get_traced_memory()
+                alloc_peak -= before
+                alloc_retained = retained - before
+                del result
+                tracemalloc.stop()
+
+        queue.put({"time_s": times, "time_min_s": min(times), "time_median_s": float(np.median(times)),
+                   "setup_rss_bytes": setup_rss, "peak_rss_bytes": peak_rss,
+                   "stage_rss_bytes": max(peak_rss - setup_rss, 0),
+                   "alloc_peak_bytes": alloc_peak, "alloc_retained_bytes": alloc_retained})
+    except Exception as e:
+        queue.put({"error": "{}: {}".format(type(e).__name__, e)})
+
+
+def measure(stage, size, options):
+    """
+    Measure one stage in a fresh process (so that the peak RSS belongs to this stage and size only)
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_measure, args=(stage, size, options, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if process.exitcode not in (0, None) and "error" not in result:
+        result["error"] = "exit code {}".format(process.exitcode)
+    return result
+
+
+def environment():
+    """
+    Versions and machine of a benchmark run
+    """
+    import sklearn
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "numpy": np.__version__,
+            "pandas": pd.__version__, "sklearn": sklearn.__version__, "machine": platform.node(),
+            "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds")}
+
+
+def benchmark(options):
+    if options.n_rois is not None:
+        sizes = {"custom": (options.n_rois, options.n_dates, options.n_features, options.n_strata)}
+    else:
+        sizes = {s: scenarios[s] for s in options.scenario}
+
+    env = environment()
+    with open(options.output, "a") as f:
+        for scenario, size in sizes.items():
+            for stage in options.stage:
+                record = dict(zip(["n_rois", "n_dates", "n_features", "n_strata"], size))
+                record.update(scenario=scenario, stage=stage, repeat=options.repeat, dtype=options.dtype)
+                record.update(measure(stage, size, options))
+                record.update(env)
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+
+                if "error" in record:
+                    print("{:8} {:26} failed: {}".format(scenario, stage, record["error"]))
+                else:
+                    print("{:8} {:26} {:10.3f} s  peak RSS {:8.1f} MiB  allocated {:>8} MiB".format(
+                        scenario, stage, record["time_min_s"], record["peak_rss_bytes"] / 2 ** 20,
+                        "-" if record["alloc_peak_bytes"] is None else
+                        "{:.1f}".format(record["alloc_peak_bytes"] / 2 ** 20)))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# comparison of two result files
+def read_results(path):
+    """
+    DataFrame of a result file (the last record of each scenario, size and stage)
+    """
+    with open(path) as f:
+        df = pd.DataFrame([json.loads(line) for line in f if line.strip()])
+    keys = ["scenario", "n_rois", "n_dates", "n_features", "n_strata", "stage"]
+    return df.drop_duplicates(keys, keep="last").set_index(keys)
+
+
+def compare(baseline, candidate, threshold=1.1, measures=("time_min_s", "peak_rss_bytes", "alloc_peak_bytes")):
+    """
+    Ratios candidate / baseline of the measures of the stages in both files
+
+    Returns
+    -------
+    DataFrame of the ratios and a boolean column regression (any ratio above threshold)
+    """
+    a, b = read_results(baseline), read_results(candidate)
+    common = a.index.intersection(b.index)
+    ratios = pd.DataFrame({m: b.loc[common, m].astype(float) / a.loc[common, m].astype(float) for m in measures
+                           if m in a and m in b}, index=common)
+    ratios["regression"] = (ratios > threshold).any(axis=1)
+    return ratios
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "compare":
+        parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+        parser.add_argument("baseline")
+        parser.add_argument("candidate")
+        parser.add_argument("--threshold", type=float, default=1.1,
+                            help="ratio candidate / baseline above which a measure counts as regression")
+        options = parser.parse_args(argv[1:])
+        ratios = compare(options.baseline, options.candidate, options.threshold)
+        with pd.option_context("display.width", 200, "display.max_rows", None):
+            print(ratios.round(3))
+        return int(ratios["regression"].any())
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", nargs="+", default=["small"], choices=sorted(scenarios))
+    parser.add_argument("--stage", nargs="+", default=stages, choices=stages)
+    parser.add_argument("--n-rois", type=int, help="custom size instead of the scenarios")
+    parser.add_argument("--n-dates", type=int, default=20)
+    parser.add_argument("--n-features", type=int, default=10)
+    parser.add_argument("--n-strata", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage (the minimum is reported)")
+    parser.add_argument("--no-allocations", dest="allocations", action="store_false",
+                        help="skip the tracemalloc run")
+    parser.add_argument("--dtype", default="float64", choices=["float32", "float64"])
+    parser.add_argument("--folds", type=int, default=3)
+    parser.add_argument("--n-trees", type=int, default=10)
+    parser.add_argument("--n-jobs", type=int, default=-1)
+    parser.add_argument("--output", default="benchmark_results.jsonl",
+                        help="JSON lines file the results are appended to")
+    benchmark(parser.parse_args(argv))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -34,8 +34,8 @@ features_csv = [
 # Replace the following path with the path stored in the ground_truth variable in the first part of the tutorial.
 scene_properties_csv = r"D:\Programming\code\ROIseries\data\sentinel_2a\table\scene_properties.csv"
 
-# Reformat the features and the ground truth into one CSV of ROWS X COLUMS = SAMPLES X FEATURES.
-# The csv variable stores the path to the resulting table.
+# Reformat the features and the ground truth into one table of ROWS X COLUMS = SAMPLES X FEATURES.
+# The csv variable stores the resulting DataFrame, which can be passed on instead of a path to a CSV.
 csv = RS_test.ROIseries_feature_sommelier.read_features_and_groundtruth(features_csv,scene_properties_csv)
 
 # Instantiate the feature_sommelier and do a 10 fold cross validation
@@ -11,5 +11,12 @@ setup(
     author="Niklas Keck",
     packages=["ROIseries",
               "ROIseries.feature_sommelier",
-              "ROIseries.sub_routines", ]
+              "ROIseries.sub_routines",
+              "ROIseries.cookie_cutter",
+              "ROIseries.spectral_indexer",
+              "ROIseries.spatial_mixer",
+              "ROIseries.glcm_features",
+              "ROIseries.temporal_blender",
+              "ROIseries.eidetic_historian",
+              "ROIseries.book_keeper", ]
 )
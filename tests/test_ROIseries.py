@@ -4,7 +4,7 @@ import pandas as pd
 import pytest
 from pandas.util.testing import assert_frame_equal
 from sklearn.pipeline import make_pipeline
-from sklearn.metrics import confusion_matrix
+from sklearn.metrics import confusion_matrix, cohen_kappa_score, roc_auc_score
 import numpy as np
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -81,6 +81,22 @@ def metrics():
 
     return metrics
 
+@pytest.fixture()
+def sommelier():
+    rng = np.random.RandomState(0)
+    n_samples, n_features = 120, 8
+    x = rng.normal(size=(n_samples, n_features))
+    x[rng.rand(n_samples, n_features) < 0.05] = np.nan
+    df = pd.DataFrame(x, columns=["Feature_{}".format(i) for i in range(n_features)])
+    df['class'] = (np.nansum(x[:, :3], axis=1) + rng.normal(size=n_samples)) > 1
+    df['stratum'] = rng.choice(['s_1', 's_2', 's_3'], n_samples)
+
+    sommelier = rs.feature_sommelier.ROIseries_feature_sommelier(df, 'class', 'stratum', True)
+    sommelier.messages = False
+    sommelier.folds = 3
+    sommelier.n_trees = 5
+    return sommelier
+
 # ----------------------------------------------------------------------------------------------------------------------
 # Tests
 def test_timeindex_from_colsuffix_SideEffects(df):
@@ -98,6 +114,12 @@ def test_reltime_from_absdate_freq(time):
     reltime, freq = rs.feature_transformers.reltime_from_absdate(time)
     assert freq == '12D'
 
+    # the frequency string of infer_freq, e.g. anchored weeks
+    weekly = pd.DatetimeIndex(['2015-11-22', '2015-11-29', '2015-12-13'])
+    reltime, freq = rs.feature_transformers.reltime_from_absdate(weekly)
+    assert freq == 'W-SUN'
+    assert list(reltime) == [0, 1, 3]
+
 
 def test_reltime_from_absdate_reltime(time):
     reltime, freq = rs.feature_transformers.reltime_from_absdate(time)
@@ -215,3 +237,710 @@ def test_drop_correlated():
     transformer = rs.feature_transformers.DropCorrelated(df.corr(), 0.9, absolute_correlation=True)
     result = transformer.fit_transform(df)
     pd.testing.assert_frame_equal(result, pd.DataFrame(np.array([ten]).transpose()))
+
+
+def test_read_features_and_groundtruth(df, tmpdir):
+    # scenes at the julian dates of the first two columns of df; the third date has no ground truth
+    # julian date 2457350.0 = 2015-11-23 12:00:00
+    scene_properties = pd.DataFrame({'filename': ['S2A_L2A_UMV32N_20151123T120000_10m_studyarea.tif',
+                                                  'S2A_L2A_UMV32N_20151205T120000_10m_studyarea.tif'],
+                                     'cloudy': [True, False],
+                                     'contains_data': [True, True]})
+    scene_properties_csv = str(tmpdir.join('scene_properties.csv'))
+    scene_properties.to_csv(scene_properties_csv, index=False)
+
+    features_csv = []
+    for feature in ['Feature_1', 'Feature_2']:
+        csv = str(tmpdir.join(feature + '.csv'))
+        df.filter(like=feature).to_csv(csv)
+        features_csv.append(csv)
+
+    sommelier = rs.feature_sommelier.ROIseries_feature_sommelier
+    result = sommelier.read_features_and_groundtruth(features_csv, scene_properties_csv, chunksize=2)
+
+    assert result.shape == (15, 4)
+    assert result.loc[('ID_7', 2457362.0), 'Feature_2'] == 76
+    assert result.loc[('ID_5', 2457398.0), 'Feature_1'] == 54
+    assert (result.xs(2457350.0, level='time')['cloudy'] == True).all()
+    assert (result.xs(2457362.0, level='time')['cloudy'] == False).all()
+    assert result.xs(2457374.0, level='time')['cloudy'].isnull().all()
+
+
+def test_feature_store_read(df, tmpdir):
+    store = rs.feature_store.FeatureStore.write(str(tmpdir.join('store')), df)
+    expected = rs.feature_transformers.timeindex_from_colsuffix(df)
+    assert_frame_equal(store.read(), expected, check_dtype=False)
+
+
+def test_feature_store_pushdown(df, tmpdir):
+    store = rs.feature_store.FeatureStore.write(str(tmpdir.join('store')), df)
+    result = store.read(features=store.select_features('_2'), times=slice(1, 3), ids=['ID_7', 'ID_5'])
+
+    expected = rs.feature_transformers.timeindex_from_colsuffix(df)
+    expected = expected.loc[expected.index[1:3], (['ID_5', 'ID_7'], ['Feature_2'])]
+    assert_frame_equal(result, expected, check_dtype=False)
+
+    # selections matching nothing give empty frames
+    for features in [[], store.select_features('no such feature')]:
+        assert store.read(features=features).shape == (5, 0)
+        assert store.read_samples(features=features).shape == (0, 0)
+
+
+def test_cv_parallel(sommelier):
+    sommelier.CV()
+    serial = [sommelier.y_probability, sommelier.feature_importance, sommelier.conf_matrix, sommelier.roc_auc]
+
+    # the workers preprocess the folds (empty cache) or get the cached folds
+    sommelier.n_processes = 2
+    for cache in [rs.feature_sommelier.FoldCache(), sommelier.fold_cache]:
+        sommelier.fold_cache = cache
+        sommelier.CV()
+        parallel = [sommelier.y_probability, sommelier.feature_importance, sommelier.conf_matrix, sommelier.roc_auc]
+
+        for s, p in zip(serial, parallel):
+            for s_fold, p_fold in zip(s, p):
+                np.testing.assert_array_equal(s_fold, p_fold)
+    assert len(sommelier.fold_cache) == 3 and sommelier.fold_cache.hits == 3
+
+
+def test_rf_cv_by_strata(sommelier):
+    result = sommelier.RF_cv_by_strata(impute_missing=True)
+
+    # one forest per stratum, evaluated on all other strata
+    assert sorted(sommelier.rf_strata) == ['s_1', 's_2', 's_3']
+    for metric in ['kappa', 'F', 'AUC']:
+        matrix = result[metric]
+        assert matrix.shape == (3, 3)
+        assert np.isnan(np.diag(matrix.values)).all()
+        assert matrix.notnull().values.sum() == 6
+
+
+def test_cv_fold_cache(sommelier):
+    sommelier.CV()
+    first = [sommelier.y_probability, sommelier.feature_importance]
+    assert (sommelier.fold_cache.misses, sommelier.fold_cache.hits) == (3, 0)
+
+    # same folds: the preprocessing is skipped, the results are the same
+    sommelier.CV()
+    assert (sommelier.fold_cache.misses, sommelier.fold_cache.hits) == (3, 3)
+    for f, s in zip(first, [sommelier.y_probability, sommelier.feature_importance]):
+        for f_fold, s_fold in zip(f, s):
+            np.testing.assert_array_equal(f_fold, s_fold)
+
+    # other features or seeds are other folds
+    sommelier.select_features('_1', exclude=True).CV()
+    sommelier.ran_stat = 1
+    sommelier.CV()
+    assert sommelier.fold_cache.misses == 9
+
+    # X is read only, new data are other folds
+    with pytest.raises(ValueError):
+        sommelier.X[:, :3] = 0
+    X = sommelier.X.copy()
+    X[:, :3] = 0
+    sommelier.X = X
+    sommelier.CV()
+    assert sommelier.fold_cache.misses == 12
+
+    # the test set is imputed with the means of the training set
+    X, y = sommelier.X, sommelier.y
+    train_index, test_index = np.arange(0, 60), np.arange(60, 120)
+    X_train, y_train, X_test, y_test = rs.feature_sommelier.preprocess_fold(X, y, train_index, test_index, 0,
+                                                                             upsampling=False)
+    missing = np.isnan(X[test_index])
+    train_means = np.broadcast_to(np.nanmean(X[train_index], axis=0), X_test.shape)
+    np.testing.assert_allclose(X_test[missing], train_means[missing])
+
+    # bounded: nothing is kept if it does not fit
+    cache = rs.feature_sommelier.FoldCache(max_bytes=0)
+    cache.put("key", (X_train, y_train, X_test, y_test))
+    assert len(cache) == 0 and cache.nbytes == 0 and cache.get("key") is None
+
+
+def test_select_views(sommelier):
+    x, strata, names = sommelier.X, sommelier.strata, sommelier.feature_names
+
+    view = sommelier.select_strata('s_2').select_features('_1', exclude=True).select_by_feature_range('Feature_0', -1, 1)
+
+    rows = np.where(strata == 's_2')[0]
+    cols = np.where(~names.str.contains('_1'))[0]
+    rows = rows[(x[rows, 0] >= -1) & (x[rows, 0] <= 1)]
+
+    # the selection shares the data of its parent and applies the composed positions on access
+    assert view._X is sommelier._X
+    np.testing.assert_array_equal(view.X, x[np.ix_(rows, cols)])
+    np.testing.assert_array_equal(view.y, sommelier.y[rows])
+    np.testing.assert_array_equal(view.strata, strata[rows])
+    assert list(view.feature_names) == list(names[cols])
+
+    # the precomputed name lookup matches str.contains, also on selections
+    for sommelier_or_view in [sommelier, sommelier.select_features('_1', exclude=True)]:
+        names = sommelier_or_view.feature_names
+        for string in ['Feature_', '_1', 'e_7', 'Feature_0', '', 'nothing']:
+            assert list(sommelier_or_view.select_features(string).feature_names) == \
+                list(names[names.str.contains(string, regex=False)])
+
+
+def test_fold_metrics():
+    rng = np.random.RandomState(1)
+    y_true = [rng.rand(n) > 0.6 for n in (30, 50, 41)]
+    # rounded probabilities to have ties
+    y_probability = [np.round(rng.rand(len(t)) * 0.5 + 0.4 * t, 1) for t in y_true]
+
+    conf_matrix, measures, roc_curve, pr_curve = rs.scoring_metrics.fold_metrics(y_true, y_probability)
+
+    for f, (t, p) in enumerate(zip(y_true, y_probability)):
+        predicted = p > 0.5
+        np.testing.assert_array_equal(conf_matrix[f], confusion_matrix(t, predicted, labels=[True, False]))
+        np.testing.assert_almost_equal(measures['kappa'][f], cohen_kappa_score(predicted, t, labels=[True, False]))
+        np.testing.assert_almost_equal(measures['AUC'][f], roc_auc_score(t, p))
+        expected = rs.feature_sommelier.ROIseries_feature_sommelier.measures(conf_matrix[f])
+        for name, value in expected.items():
+            np.testing.assert_almost_equal(measures[name][f], value)
+        assert pr_curve[f]['recall'][0] == 1 and pr_curve[f]['precision'][-1] == 1
+
+    # empty folds (also the last one) get NaN measures, the others are not affected
+    empty = np.array([], dtype=bool)
+    result = rs.scoring_metrics.fold_metrics([empty, y_true[0], empty], [empty, y_probability[0], empty])
+    np.testing.assert_array_equal(result[0][1], conf_matrix[0])
+    assert (result[0][[0, 2]] == 0).all()
+    for name in rs.scoring_metrics.measure_names:
+        assert np.isnan(result[1][name][[0, 2]]).all()
+        np.testing.assert_equal(result[1][name][1], measures[name][0])
+    assert len(result[2][2]['fpr']) == 0
+    np.testing.assert_array_equal(result[3][1]['precision'], pr_curve[0]['precision'])
+
+
+def test_interpol_for_stats():
+    n = [15, 18, 14, 20]
+    x = [np.linspace(0, 1, i) for i in n]
+    y = [np.linspace(0, 1, i) ** (c + 1) for c, i in enumerate(n)]
+    mean_x, mean_y, std_y = rs.feature_sommelier.ROIseries_feature_sommelier.interpol_for_stats(x, y)
+
+    interpol = np.array([np.interp(mean_x, x_i, y_i) for x_i, y_i in zip(x, y)])
+    np.testing.assert_array_almost_equal(mean_y, interpol.mean(axis=0))
+    np.testing.assert_array_almost_equal(std_y, interpol.std(axis=0))
+
+
+def test_precision_envelope():
+    precision = [np.array([0.5, 0.4, 0.6, 0.3, 1.0]), np.array([0.2, 0.7, 0.1])]
+    recall = [np.array([1.0, 0.8, 0.5, 0.2, 0.0]), np.array([1.0, 0.5, 0.0])]
+    p, offsets = rs.curve_aggregation.pack(precision)
+    r, _ = rs.curve_aggregation.pack(recall)
+
+    envelope, recall_increasing = rs.curve_aggregation.precision_envelope(p, r, offsets)
+    np.testing.assert_array_equal(envelope, [1.0, 0.6, 0.6, 0.5, 0.5, 0.7, 0.7, 0.2])
+    np.testing.assert_array_equal(recall_increasing, [0.0, 0.2, 0.5, 0.8, 1.0, 0.0, 0.5, 1.0])
+
+
+@pytest.mark.parametrize("absolute_correlation", [False, True])
+def test_drop_correlated_blockwise(absolute_correlation):
+    rng = np.random.RandomState(0)
+    base = rng.normal(size=(50, 4))
+    # correlated (and anti-correlated) copies of the base features with noise and missing values
+    x = np.concatenate([base, base[:, :2] + 0.1 * rng.normal(size=(50, 2)), -base[:, 2:], rng.normal(size=(50, 3))],
+                       axis=1)
+    x[rng.rand(*x.shape) < 0.05] = np.nan
+    df = pd.DataFrame(x)
+
+    expected = rs.feature_transformers.DropCorrelated(df.corr(), 0.9, absolute_correlation).fit_transform(df)
+    transformer = rs.feature_transformers.DropCorrelatedBlockwise(0.9, absolute_correlation, block_size=3, n_jobs=2)
+    result = transformer.fit_transform(df)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_trf_float32_unsorted(df, df_trf):
+    df_time = rs.feature_transformers.timeindex_from_colsuffix(df).stack('ID')
+    # rows in arbitrary order: the result follows the order of the input
+    df_time = df_time.sample(frac=1, random_state=0)
+
+    shift_dict = dict(zip(["m2", "m1", "p1"], [-1, 0, 1]))
+    result = rs.feature_transformers.TAFtoTRF(shift_dict, 'ID', dtype=np.float32).fit_transform(df_time)
+    assert (result.dtypes == np.float32).all()
+    assert result.index.equals(df_time.index)
+    assert_frame_equal(result.loc[df_trf.index], df_trf, check_dtype=False)
+
+
+def test_timeindex_from_colsuffix_incremental(df):
+    full = rs.feature_transformers.timeindex_from_colsuffix(df)
+    old_dates = [c for c in df.columns if not c.endswith("2457398.0000000000")]
+    previous = rs.feature_transformers.timeindex_from_colsuffix(df[old_dates])
+    result = rs.feature_transformers.timeindex_from_colsuffix(df, previous=previous)
+    assert_frame_equal(result, full, check_dtype=False)
+    assert list(full.columns.names) == ['ID', 'feature']
+
+    # the cache of the parsed column names is bounded
+    size = rs.time_axis.COLSUFFIX_CACHE_SIZE
+    try:
+        rs.time_axis.COLSUFFIX_CACHE_SIZE = 4
+        features, _ = rs.time_axis.parse_colsuffix(df.columns)
+        assert list(features) == [c.rsplit("_", 1)[0] for c in df.columns]
+        assert len(rs.time_axis._colsuffix_cache) == 4
+    finally:
+        rs.time_axis.COLSUFFIX_CACHE_SIZE = size
+
+
+def test_julian_subday_precision():
+    # float32 can not resolve 2457633.9394560 (resolution: a quarter day)
+    features, times = rs.time_axis.parse_colsuffix(["B_2457633.9394560", "B_2457633.9394560"])
+    expected = pd.to_datetime(2457633.9394560 - 0.5, unit='D', origin='julian')
+    assert abs(pd.DatetimeIndex(times.view('datetime64[ns]'))[0] - expected) < pd.Timedelta("1ms")
+    assert abs(rs.time_axis.julian_to_datetime([2457633.9394560])[0] - expected) < pd.Timedelta("1ms")
+    assert list(features) == ["B", "B"]
+
+
+def test_stratum_scorer(metrics):
+    m = metrics
+    scorer = rs.scoring_metrics.StratumScorer(m["y_true"], "strata", normalize_denominator=7)
+    candidates = np.column_stack([m["y_pred"], ~m["y_pred"], m["y_true"].values])
+    expected = [rs.scoring_metrics.errors_per_stratum_count(m["y_true"], c, "strata", normalize_denominator=7)
+                for c in candidates.T]
+    np.testing.assert_allclose(scorer.score(candidates), expected)
+    assert scorer.errors(candidates).shape == (3, 2)
+
+
+def test_stratum_scorer_grid_search(sommelier):
+    from sklearn.model_selection import GridSearchCV
+    from sklearn.tree import DecisionTreeClassifier
+
+    X = np.nan_to_num(sommelier.X)
+    y = pd.Series(sommelier.y, index=pd.MultiIndex.from_arrays([np.arange(len(X)), sommelier.strata],
+                                                               names=["sample", "strata"]))
+    scorer = rs.scoring_metrics.StratumScorer(y, "strata")
+    search = GridSearchCV(DecisionTreeClassifier(random_state=0), {"max_depth": [1, 3]}, scoring=scorer, cv=3)
+    search.fit(X, y)
+
+    # the scorer on a subset of y equals errors_per_stratum_count on the subset
+    estimator = search.best_estimator_
+    subset = y.iloc[::2]
+    expected = rs.scoring_metrics.errors_per_stratum_count(subset, estimator.predict(X[::2]), "strata")
+    assert scorer(estimator, X[::2], subset) == -expected
+
+    # strata missing in the subset are left out, as in errors_per_stratum_count
+    subset = y[y.index.get_level_values("strata") != "s_2"]
+    X_subset = X[(sommelier.strata != "s_2")]
+    for normalize_denominator in [None, 7]:
+        scorer = rs.scoring_metrics.StratumScorer(y, "strata", normalize_denominator=normalize_denominator)
+        expected = rs.scoring_metrics.errors_per_stratum_count(subset, estimator.predict(X_subset), "strata",
+                                                               normalize_denominator=normalize_denominator)
+        assert scorer(estimator, X_subset, subset) == pytest.approx(-expected)
+
+
+@pytest.fixture()
+def rasterseries(tmpdir):
+    """ 3 single band GeoTIFFs (10 m pixels) and a shapefile with a square, a donut and an empty ROI """
+    import rasterio
+    import fiona
+    from rasterio.transform import from_origin
+
+    transform = from_origin(441750, 5469010, 10, 10)
+    rng = np.random.RandomState(0)
+    values = rng.rand(3, 40, 60).astype(np.float32)
+    rasters = []
+    for t in range(3):
+        raster = str(tmpdir.join("S2A_{}.tif".format(t)))
+        with rasterio.open(raster, "w", driver="GTiff", height=40, width=60, count=1, dtype="float32",
+                           transform=transform, crs="EPSG:32632") as dst:
+            dst.write(values[t], 1)
+        rasters.append(raster)
+
+    def box(col0, row0, col1, row1):
+        x0, y0 = transform * (col0, row0)
+        x1, y1 = transform * (col1, row1)
+        return [(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)]
+
+    shapes = [("A", {"type": "Polygon", "coordinates": [box(2, 3, 6, 8)]}),
+              ("B", {"type": "Polygon", "coordinates": [box(20, 10, 30, 20), box(23, 13, 27, 17)[::-1]]}),
+              ("C", {"type": "Polygon", "coordinates": [box(40.1, 30.1, 40.3, 30.3)]})]
+    shapefile = str(tmpdir.join("rois.shp"))
+    schema = {"geometry": "Polygon", "properties": {"ID": "str"}}
+    with fiona.open(shapefile, "w", driver="ESRI Shapefile", schema=schema, crs="EPSG:32632") as dst:
+        for i, geometry in shapes:
+            dst.write({"geometry": geometry, "properties": {"ID": i}})
+
+    return shapefile, rasters, values
+
+
+def test_cookie_cutter(rasterseries):
+    shapefile, rasters, values = rasterseries
+    rois = rs.cookie_cutter.cookie_cutter(shapefile, "ID", rasters)
+
+    # C holds no pixel center and is dropped
+    assert list(rois.keys()) == ["A", "B"]
+    np.testing.assert_array_equal(rois["A"], values[:, 3:8, 2:6].transpose(1, 2, 0))
+
+    # the hole of the donut is NaN
+    assert rois["B"].shape == (10, 10, 3)
+    assert np.isnan(rois["B"][3:7, 3:7]).all()
+    assert np.isnan(rois["B"]).sum() == 4 * 4 * 3
+    np.testing.assert_array_equal(rois["B"][:3], values[:, 10:13, 20:30].transpose(1, 2, 0))
+
+    # rasters can be given as paths too
+    import pathlib
+    assert rs.cookie_cutter.raster_info(pathlib.Path(rasters[0])) == rs.cookie_cutter.raster_info(rasters[0])
+
+
+def test_cookie_cutter_upsampling(rasterseries):
+    shapefile, rasters, values = rasterseries
+    rois = rs.cookie_cutter.cookie_cutter(shapefile, "ID", rasters, upsampling=2)
+    expected = values[:, 3:8, 2:6].repeat(2, axis=1).repeat(2, axis=2).transpose(1, 2, 0)
+    np.testing.assert_array_equal(rois["A"], expected)
+    # on the finer grid the small ROI holds a pixel center
+    np.testing.assert_array_equal(rois["C"], values[:, 30, 40].reshape(1, 1, 3))
+
+
+def test_cube_store(rasterseries, tmpdir):
+    shapefile, rasters, values = rasterseries
+    cube = rs.cube_store.CubeStore.from_rasters(str(tmpdir.join("cube")), rasters, chunks=(2, 16, 16))
+
+    # blocks across chunk borders
+    np.testing.assert_array_equal(cube.read(), values[:, None])
+    np.testing.assert_array_equal(cube.read(times=slice(1, 3), rows=slice(10, 35), cols=slice(5, 50), bands=[0]),
+                                  values[1:3, None, 10:35, 5:50])
+    tiles = list(cube.iter_tiles())
+    assert len(tiles) == 3 * 4
+    rows, cols, block = tiles[-1]
+    np.testing.assert_array_equal(block[:, 0], values[:, rows, cols])
+
+    # ROI extraction from the cube equals the one from the rasters
+    for upsampling in [1, 2]:
+        expected = rs.cookie_cutter.cookie_cutter(shapefile, "ID", rasters, upsampling=upsampling)
+        result = rs.cookie_cutter.cookie_cutter(shapefile, "ID", cube, upsampling=upsampling)
+        assert list(result.keys()) == list(expected.keys())
+        for i in expected:
+            np.testing.assert_array_equal(result[i], expected[i])
+
+
+def test_cube_store_integer(rasterseries, tmpdir):
+    import rasterio
+    _, rasters, values = rasterseries
+    counts = (values * 10000).astype(np.uint16)
+    for nodata in [None, 65535]:
+        integer_rasters = []
+        for t, raster in enumerate(rasters):
+            with rasterio.open(raster) as src:
+                profile = src.profile
+            profile.update(dtype="uint16", nodata=nodata)
+            integer_raster = str(tmpdir.join("uint16_{}_{}.tif".format(nodata, t)))
+            with rasterio.open(integer_raster, "w", **profile) as dst:
+                dst.write(counts[t], 1)
+            integer_rasters.append(integer_raster)
+
+        path = str(tmpdir.join("cube_{}".format(nodata)))
+        if nodata is None:
+            # no value to pad the edge chunks with
+            with pytest.raises(ValueError):
+                rs.cube_store.CubeStore.from_rasters(path, integer_rasters, chunks=(2, 16, 16), dtype=np.uint16)
+        else:
+            cube = rs.cube_store.CubeStore.from_rasters(path, integer_rasters, chunks=(2, 16, 16), dtype=np.uint16)
+            assert cube.dtype == np.uint16
+            np.testing.assert_array_equal(cube.read(), counts[:, None])
+            # rows 40..47 of the last row of chunks are padding
+            assert np.all(cube._cube[0, -1, :, :, :, 40 - 2 * 16:] == nodata)
+
+
+def test_spectral_indexer():
+    rng = np.random.RandomState(0)
+    image = rng.randint(0, 10000, size=(4, 50, 30)).astype(np.uint16)
+    R = image.astype(np.float64)
+    formulas = {"NDVI": "(R[3]-R[2])/(R[3]+R[2])",
+                "EVI": "2.5*(R[3]-R[2])/(R[3]+6*R[2]-7.5*R[0]+1)",
+                "MASK": "(r[1] GT 5000) * SQRT(R[0]^2)",
+                "GREEN": "R[1]"}
+    expected = {"NDVI": (R[3] - R[2]) / (R[3] + R[2]),
+                "EVI": 2.5 * (R[3] - R[2]) / (R[3] + 6 * R[2] - 7.5 * R[0] + 1),
+                "MASK": (R[1] > 5000) * R[0],
+                "GREEN": R[1]}
+
+    indexer = rs.spectral_indexer.SpectralIndexer(formulas, dtype=np.float64, tile_size=128, n_jobs=4)
+    result = indexer.transform(image)
+    for i, name in enumerate(indexer.names):
+        np.testing.assert_allclose(result[i], expected[name], rtol=1e-12)
+
+    # list of bands and band axis of a CubeStore block (time * band * row * column)
+    ndvi = rs.spectral_indexer.spectral_indexer(list(image), formulas["NDVI"])
+    np.testing.assert_allclose(ndvi, expected["NDVI"], rtol=1e-6)
+    block = rs.spectral_indexer.SpectralIndexer(formulas["NDVI"]).transform(np.stack([image, image]), band_axis=1)
+    assert block.shape == (2, 1, 50, 30)
+    np.testing.assert_allclose(block[1, 0], expected["NDVI"], rtol=1e-6)
+
+    with pytest.raises(ValueError):
+        rs.spectral_indexer.SpectralIndex("__import__('os')")
+
+
+def test_spatial_mixer():
+    rng = np.random.RandomState(0)
+    rois = {"ID_1": rng.rand(3, 4, 2), "ID_7": rng.rand(5, 2, 2), "ID_5": rng.rand(1, 1, 2)}
+    rois["ID_1"][0, :2] = np.nan
+    rois["ID_7"][1, 1, 1] = np.nan
+    times = [2457350.0, 2457362.0]
+    types = ["MEAN", "STDDEV", "COUNT", "MIN", "MAX", "SUM", "MEDIAN", "PERCENTILE_25"]
+
+    df = rs.spatial_mixer.spatial_mixer(rois, types, times, prefix="NDVI_")
+    assert df.index.tolist() == ["ID_1", "ID_7", "ID_5"]
+    assert df.columns[0] == "NDVI_MEAN_2457350.0000000000"
+
+    for i, a in rois.items():
+        for t, time in enumerate(times):
+            x = a[:, :, t].ravel()
+            x = np.sort(x[~np.isnan(x)])
+            expected = {"MEAN": x.mean(), "STDDEV": x.std(ddof=1) if len(x) > 1 else np.nan, "COUNT": len(x),
+                        "MIN": x.min(), "MAX": x.max(), "SUM": x.sum(), "MEDIAN": x[len(x) // 2],
+                        "PERCENTILE_25": x[max(int(np.ceil(0.25 * len(x))) - 1, 0)]}
+            for s in types:
+                np.testing.assert_allclose(df.loc[i, "NDVI_{}_{:.10f}".format(s, time)], expected[s])
+
+    # the columns are in the FEATURE_JULIANDATE format
+    df_time = rs.feature_transformers.timeindex_from_colsuffix(df)
+    assert df_time.shape == (2, 3 * len(types))
+
+
+def test_glcm_features():
+    rng = np.random.RandomState(0)
+    rois = {"ID_1": rng.rand(6, 5, 3), "ID_7": rng.rand(4, 7, 3), "ID_5": np.full((2, 2, 3), np.nan)}
+    rois["ID_1"][0, 0, :] = np.nan
+    levels = 8
+    result = rs.glcm_features.glcm_features(rois, levels=levels, n_jobs=2)
+    assert result.shape == (3, 3, 11, 4)
+    assert np.isnan(result[2]).all()
+
+    # loop reference (as GLCM_MATRIX / GLCM_FEATURES) for ROI ID_1
+    q = rs.glcm_features.quantize(rois["ID_1"], levels)
+    offsets = {"0": (0, 1), "45": (1, -1), "90": (1, 0), "135": (1, 1)}
+    i, j = np.indices((levels, levels))
+    for t in range(3):
+        for d, direction in enumerate(rs.glcm_features.valid_dirs):
+            dr, dc = offsets[direction]
+            glcm = np.zeros((levels, levels))
+            for r in range(q.shape[0] - dr):
+                for c in range(q.shape[1]):
+                    if 0 <= c + dc < q.shape[1] and q[r, c, t] >= 0 and q[r + dr, c + dc, t] >= 0:
+                        glcm[q[r, c, t], q[r + dr, c + dc, t]] += 1
+            P = glcm + glcm.T
+            P = P / P.sum()
+            mean = (P * i).sum()
+            var = (P * (i - mean) ** 2).sum()
+            nz = P > 0
+            expected = {"CON": (P * (i - j) ** 2).sum(), "DIS": (P * np.abs(i - j)).sum(),
+                        "HOM": (P / (1 + (i - j) ** 2)).sum(), "ASM": (P ** 2).sum(), "ENE": np.sqrt((P ** 2).sum()),
+                        "MAX": P.max(), "ENT": -(P[nz] * np.log(P[nz])).sum(), "MEAN": mean, "VAR": var,
+                        "STD": np.sqrt(var), "COR": (P * (i - mean) * (j - mean) / var).sum()}
+            for f, feature in enumerate(rs.glcm_features.valid_types):
+                np.testing.assert_allclose(result[0, t, f, d], expected[feature], rtol=1e-10)
+
+    # GLCM features in the spatial mixer
+    df = rs.spatial_mixer.spatial_mixer(rois, ["MEAN", "GLCM_CON_90"], [2457350.0, 2457362.0, 2457374.0],
+                                        glcm_levels=levels)
+    np.testing.assert_allclose(df["GLCM_CON_90_2457362.0000000000"].values, result[:, 1, 0, 2])
+
+    # levels=None: unit wide bins of the raw values from the minimum of each image (as HIST_2D_NAN)
+    values = rng.randint(2, 9, (6, 5, 3)).astype(np.float64)
+    q = rs.glcm_features.quantize(values, None)
+    np.testing.assert_array_equal(q, values - values.min(axis=(0, 1)))
+    result = rs.glcm_features.glcm_features({"ID_1": values}, levels=None)
+    counts = rs.glcm_features.cooccurrence([np.moveaxis(q, -1, 0)], q.max() + 1)
+    np.testing.assert_allclose(result[0], np.moveaxis(rs.glcm_features.haralick(counts[0]), -1, -2))
+
+    # unscaled values span too many grey levels
+    with pytest.raises(ValueError):
+        rs.glcm_features.glcm_features({"ID_1": values * 1000}, levels=None)
+
+
+def test_moving_stats():
+    from scipy import stats as scipy_stats
+    rng = np.random.RandomState(0)
+    x = rng.normal(loc=1000, size=(4, 3, 20))
+    x[0, 0, 3] = np.nan
+    result = rs.sub_routines.moving_stats(x, 5)
+    assert result["mean"].shape == (4, 3, 16)
+
+    for i in range(16):
+        w = x[..., i:i + 5]
+        np.testing.assert_allclose(result["mean"][..., i], np.nanmean(w, axis=-1))
+        np.testing.assert_allclose(result["variance"][..., i], np.nanvar(w, axis=-1, ddof=1), rtol=1e-6)
+        np.testing.assert_allclose(result["min"][..., i], np.nanmin(w, axis=-1))
+        np.testing.assert_allclose(result["max"][..., i], np.nanmax(w, axis=-1))
+        np.testing.assert_allclose(result["total"][..., i], np.nansum(w, axis=-1))
+        mdev = np.nanmean(np.abs(w - np.nanmean(w, axis=-1, keepdims=True)), axis=-1)
+        np.testing.assert_allclose(result["mdev"][..., i], mdev)
+
+        # MOMENT: skewness and kurtosis with the sample standard deviation
+        w = w[1:]
+        sdev = w.std(axis=-1, ddof=1)
+        skewness = scipy_stats.skew(w, axis=-1) * w.std(axis=-1) ** 3 / sdev ** 3
+        kurtosis = (scipy_stats.kurtosis(w, axis=-1) + 3) * w.std(axis=-1) ** 4 / sdev ** 4 - 3
+        np.testing.assert_allclose(result["skewness"][1:, :, i], skewness, rtol=1e-5)
+        np.testing.assert_allclose(result["kurtosis"][1:, :, i], kurtosis, rtol=1e-5)
+
+
+def test_interpolate_to():
+    s_time = np.array([10.0, 0.0, 20.0, 30.0])
+    s_values = np.array([[1.0, 10.0], [0.0, 0.0], [2.0, np.nan], [4.0, 40.0]])
+    o_time = np.array([-5.0, 0.0, 5.0, 20.0, 25.0, 30.0, 35.0])
+    result = rs.temporal_blender.interpolate_to(s_time, o_time, s_values)
+    expected = np.array([[np.nan, np.nan], [0.0, 0.0], [0.5, 5.0], [2.0, np.nan], [3.0, np.nan], [4.0, 40.0],
+                         [np.nan, np.nan]])
+    np.testing.assert_allclose(result, expected)
+    inside = (o_time >= 0) & (o_time <= 30)
+    order = np.argsort(s_time)
+    np.testing.assert_allclose(result[inside, 0], np.interp(o_time[inside], s_time[order], s_values[order, 0]))
+
+    # datetimes keep ns precision far from 1970 (float64 of the absolute ns has a resolution of 256 ns)
+    base = pd.Timestamp("2016-01-01").value
+    s_time = pd.DatetimeIndex(np.array([base, base + 1000]).view("datetime64[ns]"))
+    o_time = pd.DatetimeIndex(np.array([base + 1, base + 999]).view("datetime64[ns]"))
+    result = rs.temporal_blender.interpolate_to(s_time, o_time, np.array([0.0, 1000.0]))
+    np.testing.assert_allclose(result, [1.0, 999.0])
+
+
+def test_interpolate_to_transformer(df, df_trf):
+    df_time = rs.feature_transformers.timeindex_from_colsuffix(df).stack('ID')
+    # every second date is missing, the grid restores them by interpolation
+    df_sparse = df_time.loc[df_time.index.get_level_values("time").isin(df_time.index.levels[0][::2])]
+    grid = pd.date_range("2015-11-23", "2016-01-10", freq="12D", name="time")
+
+    shift_dict = dict(zip(["m2", "m1", "p1"], [-1, 0, 1]))
+    p1 = make_pipeline(rs.feature_transformers.InterpolateTo(grid, "ID"),
+                       rs.feature_transformers.TAFtoTRF(shift_dict, "ID"))
+    result = p1.fit_transform(df_sparse)
+    # the values of the fixture are linear in time
+    assert_frame_equal(result.loc[df_trf.index], df_trf, check_dtype=False, check_names=False)
+
+
+def test_step_cache(tmpdir, df):
+    cache = rs.step_cache.StepCache(str(tmpdir.join("cache")))
+    calls = []
+
+    def extract(data, scale):
+        calls.append(scale)
+        return data.values * scale, data * scale
+
+    a, b = cache("extract", extract, df, scale=2)
+    a2, b2 = cache("extract", extract, df, scale=2)
+    assert calls == [2]
+    assert isinstance(a2, np.memmap)
+    np.testing.assert_array_equal(a2, df.values * 2)
+    assert_frame_equal(b2, df * 2)
+
+    # another parameter or input is another step
+    cache("extract", extract, df, scale=3)
+    cache("extract", extract, df + 1, scale=3)
+    assert calls == [2, 3, 3]
+
+    # least recently used entries are evicted first
+    cache("extract", extract, df, scale=2)
+    newest = cache.entries()["size"].iloc[-1]
+    cache.evict(newest)
+    assert len(cache.entries()) == 1
+    cache("extract", extract, df, scale=2)
+    assert calls == [2, 3, 3]
+
+    # estimators with the same parameters fit to other data are other inputs
+    from sklearn.tree import DecisionTreeClassifier
+    X, y = df.values, np.array([0, 1, 1])
+    keys = [rs.step_cache.step_key("predict", DecisionTreeClassifier(random_state=0).fit(X, labels), X)
+            for labels in [y, 1 - y]]
+    assert keys[0] != keys[1]
+    unfitted = [rs.step_cache.step_key("fit", DecisionTreeClassifier(max_depth=3)) for _ in range(2)]
+    assert unfitted[0] == unfitted[1]
+
+    # the key covers the source of the step function
+    def extract(data, scale):
+        calls.append(-scale)
+        return data.values * scale
+    cache("extract", extract, df, scale=2)
+    assert calls == [2, 3, 3, -2]
+
+    # stores by their path and meta.json, RoiIndex by its arrays, no keys from the address of other objects
+    store_path = str(tmpdir.join("store"))
+    store = rs.feature_store.FeatureStore.write(store_path, df)
+    key = rs.step_cache.step_key("read", store)
+    assert rs.step_cache.step_key("read", rs.feature_store.FeatureStore(store_path)) == key
+    tmpdir.join("store", "meta.json").setmtime(0)
+    assert rs.step_cache.step_key("read", rs.feature_store.FeatureStore(store_path)) != key
+
+    labels = np.array([[0, 1], [2, 2]], dtype=np.int32)
+    bbox = np.array([[0, 1, 1, 2], [1, 2, 0, 2]])
+    roi_keys = [rs.step_cache.step_key("cut", rs.cookie_cutter.RoiIndex(np.array(["A", "B"]), l, (3, 4), bbox))
+                for l in [labels, labels.copy(), labels[::-1]]]
+    assert roi_keys[0] == roi_keys[1] != roi_keys[2]
+
+    with pytest.raises(TypeError):
+        rs.step_cache.step_key("extract", object())
+
+
+def test_lazy_imports():
+    # heavy dependencies are loaded by the functions using them, not by importing ROIseries
+    import subprocess
+    import sys
+    heavy = ("sorted(m for m in ['matplotlib', 'seaborn', 'astropy', 'imblearn', 'rasterio', 'fiona'] "
+             "if m in sys.modules)")
+    code = ("import sys; before = " + heavy + "; import ROIseries as rs; rs.feature_transformers; rs.scoring_metrics; "
+            "rs.feature_sommelier; rs.cookie_cutter; rs.spectral_indexer; rs.step_cache; "
+            "print(sorted(set(" + heavy + ") - set(before)))")
+    assert subprocess.check_output([sys.executable, "-c", code]).decode().strip() == "[]"
+
+    # the modules of the same name as their subpackages stay the modules
+    import ROIseries.cookie_cutter.cube_store
+    assert rs.cookie_cutter.__name__ == "ROIseries.cookie_cutter.cookie_cutter"
+    assert rs.sub_routines.lazy_import("rasterio").windows.Window is not None
+
+
+def test_scene_time_and_match_times():
+    ns = rs.time_axis.scene_time_to_ns(['S2A_L2A_UMV32N_20151123T120000_10m_studyarea.tif',
+                                        'S2A_L2A_UMV32N_20151205T120001_10m_studyarea.tif'])
+    julian = np.array([2457362.0, 2457350.0, 2457374.0])
+    times = rs.time_axis.julian_to_ns(julian, rs.time_axis.JULIAN_EPOCH_UTC)
+    assert times[1] == ns[0]
+
+    # one second apart: matched with a tolerance of 2 s only
+    np.testing.assert_array_equal(rs.time_axis.match_times(times, ns), [-1, 0, -1])
+    np.testing.assert_array_equal(rs.time_axis.match_times(times, ns, 2 * 10 ** 9), [1, 0, -1])
+    np.testing.assert_array_equal(rs.time_axis.match_times(times, ns[:0]), [-1, -1, -1])
+
+
+def test_ground_truth():
+    csv = io.StringIO("ID,before_harvest,after_harvest,before_ploughing,after_ploughing\n"
+                      "1,20160808,20160808,20160809,20160817\n"
+                      "2,20160805,20160808,20160809,NA\n"
+                      "4,NA,NA,20160818,20160822\n"
+                      "5,NA,NA,NA,NA\n")
+    types = ["before_harvest", "after_harvest", "before_ploughing", "after_ploughing"]
+    aggregate = {"harvest": ["before_harvest", "after_harvest"], "ploughing": ["before_ploughing", "after_ploughing"]}
+    gt = rs.book_keeper.GroundTruth.from_csv(csv, types, "ID", aggregate=aggregate)
+
+    assert len(gt.table) == 9
+    summary = gt.summary()
+    assert summary.loc[(2, "ploughing"), "count"] == 1
+    assert summary.loc[(4, "ploughing"), "last"] == pd.Timestamp("2016-08-22")
+    # every id and aggregated event type is kept, as in GROUNDTRUTH_FROM_CSV
+    assert list(gt.ids) == [1, 2, 4, 5]
+    as_dict = gt.to_dict()
+    assert list(as_dict) == [1, 2, 4, 5]
+    assert list(as_dict[4].keys()) == ["harvest", "ploughing"] and len(as_dict[4]["harvest"]) == 0
+    assert [len(d) for d in as_dict[5].values()] == [0, 0]
+    assert list(rs.book_keeper.GroundTruth.from_csv(io.StringIO("ID,a\n1,20160808\n2,NA\n"), ["a"], "ID")
+                .to_dict()[2]) == []
+    assert gt.intervals("harvest")[2].left == pd.Timestamp("2016-08-05")
+
+    ids = [1, 2, 2, 4, 99]
+    times = pd.to_datetime(["2016-08-07", "2016-08-07", "2016-09-30", "2016-09-30", "2016-09-30"])
+    label = gt.label(ids, times, "harvest")
+    np.testing.assert_array_equal(label["count"], [0, 1, 2, 0, 0])
+    np.testing.assert_array_equal(label["within"], [False, True, False, False, False])
+    np.testing.assert_array_equal(label["days_since"], [np.nan, 2, 53, np.nan, np.nan])
+    assert label["last"][2] == pd.Timestamp("2016-08-08") and pd.isnull(label["last"][0])
+
+
+def test_calendar_features(df):
+    x = rs.feature_transformers.timeindex_from_colsuffix(df).stack('ID')
+    result = rs.feature_transformers.CalendarFeatures("time", ["doy", "month", "week"]).fit_transform(x)
+
+    assert list(result.columns[-6:]) == ["doy_sin", "doy_cos", "month_sin", "month_cos", "week_sin", "week_cos"]
+    assert_frame_equal(result[x.columns], x)
+    times = x.index.get_level_values("time")
+    doy = rs.feature_transformers.doy_circular(times)
+    np.testing.assert_allclose(result["doy_sin"], doy["doy_sin"])
+    np.testing.assert_allclose(result["month_cos"], np.cos(2 * np.pi * (times.month - 1) / 12), atol=1e-6)
+    np.testing.assert_allclose(result["week_sin"], np.sin(2 * np.pi * (times.isocalendar().week.values.astype(int) - 1) / 53),
+                               atol=1e-6)